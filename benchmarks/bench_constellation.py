@@ -0,0 +1,249 @@
+"""
+Times the pure Python hot paths of a build against synthetic constellations of growing size.
+
+    python -m benchmarks.bench_constellation [--sizes 1,10,100,500] [--repeat N] [--output report.json]
+                                             [--baseline previous.json] [--tolerance 1.5]
+
+For every size (number of satellites) the suite writes a synthetic constellation (see synthetic_constellation)
+into a temporary config dir and times, best of N:
+
+- constellation: parsing [name].constellation.yaml into the models (get_constellation_clusters, cache cleared)
+- cluster-template: template_cluster_template's per cluster specialisation of templates/default.yaml
+- talos-config-patch: patching both talos machine configs of every cluster, as talos_apply_config_patches does
+- capacity-demand: check_capacity's aggregation over all node pools, and its metro x plan matrix
+- vip-addresses: rendering ip-[role]-addresses.yaml of every VIP role and reading the addresses back (get_vips)
+- multiline-whitespace: the ConfigMap whitespace fix over a Cilium sized manifest per cluster
+
+The JSON report holds every timing, and per benchmark the growth of the time per cluster from the smallest to the
+largest size (1.0 is linear). With --baseline, timings more than --tolerance times slower than the baseline's
+are reported and the exit code is 1.
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from tabulate import tabulate
+
+from benchmarks.bench_normalise import synthetic_documents
+from benchmarks.synthetic_constellation import VIP_ROLES, synthetic_ip_reservation, write_synthetic_constellation
+from tasks.cluster import _template_cluster_template
+from tasks.equinix_metal import _render_ip_addresses_file, get_capacity_demand, get_ip_addresses_file_name, \
+    render_capacity_matrix
+from tasks.helpers import clear_cache, get_constellation, get_constellation_clusters, get_vips
+from tasks.manifests import apply_transforms, normalise_multiline_whitespace, read_documents
+from tasks.talos_patch import apply_config_patches, render_talos_config
+from tasks.yaml_io import safe_load
+
+DEFAULT_SIZES = (1, 10, 100, 500)
+TALOS_EXAMPLE = os.path.join('manifest-examples', 'talos-alloy-102.yaml')
+TALOS_BASE_CONFIGS = os.path.join('tests', 'talos-alloy-102.{}.yaml')
+
+
+def _talos_inputs():
+    patches = dict()
+    for document in read_documents(TALOS_EXAMPLE):
+        if document['kind'] == 'TalosControlPlane':
+            patches['controlplane'] = document['spec']['controlPlaneConfig']['controlplane']['configPatches']
+        if document['kind'] == 'TalosConfigTemplate':
+            patches['worker'] = document['spec']['template']['spec']['configPatches']
+    configs = dict()
+    for role in patches:
+        with open(TALOS_BASE_CONFIGS.format(role), 'r') as config_file:
+            configs[role] = safe_load(config_file)
+    return configs, patches
+
+
+def bench_constellation(clusters):
+    get_constellation_clusters()
+
+
+def bench_cluster_template(clusters):
+    for cluster_spec in clusters:
+        _template_cluster_template(cluster_spec, 'default.yaml')
+
+
+def bench_talos_config_patch(clusters, talos_inputs):
+    configs, patches = talos_inputs
+    for _ in clusters:
+        for role in configs:
+            render_talos_config(apply_config_patches(configs[role], patches[role]))
+
+
+def bench_capacity_demand(clusters):
+    demand = get_capacity_demand([get_constellation()])
+    render_capacity_matrix([
+        {'metro': metro, 'plan': plan, 'quantity': quantity, 'available': True}
+        for (metro, plan), quantity in demand.items()
+    ])
+
+
+def bench_vip_addresses(clusters, vips_per_role):
+    for cluster_index, cluster_spec in enumerate(clusters):
+        for role_index, role in enumerate(VIP_ROLES):
+            _render_ip_addresses_file(
+                synthetic_ip_reservation(cluster_index, role_index, vips_per_role),
+                get_ip_addresses_file_name(cluster_spec, role))
+    for cluster_spec in clusters:
+        for role in VIP_ROLES:
+            list(get_vips(cluster_spec, role))
+
+
+def bench_multiline_whitespace(documents_per_cluster):
+    for documents in documents_per_cluster:
+        list(apply_transforms(documents, normalise_multiline_whitespace()))
+
+
+def _warm_cache():
+    """
+    Empty file cache, but for the constellation and ccontext, as in a build after its first task
+    """
+    clear_cache()
+    get_constellation_clusters()
+
+
+def _remove_vip_addresses(clusters):
+    for cluster_spec in clusters:
+        for role in VIP_ROLES:
+            os.remove(get_ip_addresses_file_name(cluster_spec, role))
+    _warm_cache()
+
+
+def _best_of(fn, repeat, setup=None):
+    """
+    Best time of fn(setup()), setup runs outside the timed section
+    """
+    timings = list()
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        started = time.perf_counter()
+        fn(argument)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run_size(satellites, repeat, vips_per_role=4, node_pools=4):
+    """
+    Number of clusters and {benchmark: seconds} for one constellation size
+    """
+    previous_root = os.environ.get('GOCY_DEFAULT_ROOT')
+    with tempfile.TemporaryDirectory() as config_dir:
+        os.environ['GOCY_DEFAULT_ROOT'] = config_dir
+        try:
+            write_synthetic_constellation(config_dir, satellites, vips_per_role, node_pools)
+            _warm_cache()
+            clusters = get_constellation_clusters()
+            talos_inputs = _talos_inputs()
+            documents = synthetic_documents(count=20, lines=200)
+            bench_vip_addresses(clusters, vips_per_role)
+            benchmarks = {
+                'constellation': (clear_cache, lambda _: bench_constellation(clusters)),
+                # the template is parsed in every run, once, as by template_cluster_template
+                'cluster-template': (_warm_cache, lambda _: bench_cluster_template(clusters)),
+                'talos-config-patch': (None, lambda _: bench_talos_config_patch(clusters, talos_inputs)),
+                'capacity-demand': (_warm_cache, lambda _: bench_capacity_demand(clusters)),
+                'vip-addresses': (
+                    lambda: _remove_vip_addresses(clusters), lambda _: bench_vip_addresses(clusters, vips_per_role)),
+                'multiline-whitespace': (
+                    lambda: [copy.deepcopy(documents) for _ in clusters], bench_multiline_whitespace),
+            }
+            return len(clusters), {name: _best_of(fn, repeat, setup) for name, (setup, fn) in benchmarks.items()}
+        finally:
+            if previous_root is None:
+                os.environ.pop('GOCY_DEFAULT_ROOT', None)
+            else:
+                os.environ['GOCY_DEFAULT_ROOT'] = previous_root
+            clear_cache()
+
+
+def run_suite(sizes=DEFAULT_SIZES, repeat=3):
+    results = list()
+    for satellites in sizes:
+        clusters, timings = run_size(satellites, repeat)
+        for name, seconds in timings.items():
+            results.append({
+                'benchmark': name,
+                'satellites': satellites,
+                'clusters': clusters,
+                'seconds': seconds,
+                'per_cluster_ms': seconds * 1000 / clusters
+            })
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+        'scaling': scaling(results)
+    }
+
+
+def scaling(results):
+    """
+    Per benchmark: time per cluster at the largest size / time per cluster at the smallest size.
+    """
+    by_benchmark = dict()
+    for result in results:
+        by_benchmark.setdefault(result['benchmark'], list()).append(result)
+    growth = dict()
+    for name, benchmark_results in by_benchmark.items():
+        smallest = min(benchmark_results, key=lambda result: result['clusters'])
+        largest = max(benchmark_results, key=lambda result: result['clusters'])
+        growth[name] = largest['per_cluster_ms'] / max(smallest['per_cluster_ms'], 1e-9)
+    return growth
+
+
+def regressions(report, baseline, tolerance):
+    previous = {(result['benchmark'], result['satellites']): result['seconds'] for result in baseline['results']}
+    slower = list()
+    for result in report['results']:
+        key = (result['benchmark'], result['satellites'])
+        if key in previous and result['seconds'] > previous[key] * tolerance:
+            slower.append((result['benchmark'], result['satellites'], previous[key], result['seconds']))
+    return slower
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    report = run_suite([int(size) for size in args.sizes.split(',')], args.repeat)
+    table = [['benchmark', 'satellites', 'total [ms]', 'per cluster [ms]']]
+    for result in report['results']:
+        table.append([
+            result['benchmark'],
+            result['satellites'],
+            '{:.2f}'.format(result['seconds'] * 1000),
+            '{:.3f}'.format(result['per_cluster_ms'])
+        ])
+    print(tabulate(table, headers='firstrow'))
+    print()
+    print(tabulate([['benchmark', 'per cluster growth']] + [
+        [name, '{:.2f}x'.format(growth)] for name, growth in report['scaling'].items()], headers='firstrow'))
+
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            slower = regressions(report, json.load(baseline_file), args.tolerance)
+        if slower:
+            print()
+            print(tabulate([['benchmark', 'satellites', 'baseline [ms]', 'now [ms]']] + [
+                [name, satellites, '{:.2f}'.format(before * 1000), '{:.2f}'.format(after * 1000)]
+                for name, satellites, before, after in slower], headers='firstrow'))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,84 @@
+"""
+Compares manifests.normalise_multiline_whitespace with the per line rstrip loop it replaced.
+
+    python -m benchmarks.bench_normalise [rendered.yaml ...]
+
+Pass rendered manifests, e.g. the helm cache's network-services-dependencies render
+(see 'Rendered ... from cache' in the build output). Without arguments a synthetic manifest, shaped like
+the Cilium render (large multiline ConfigMap/Secret data), is used.
+"""
+import copy
+import sys
+import time
+
+from tabulate import tabulate
+
+from tasks.manifests import apply_transforms, normalise_multiline_whitespace, read_documents
+
+
+def strip_data_whitespace(document):
+    if 'data' in document:
+        data_keys = document['data'].keys()
+        for key in data_keys:
+            if '\n' in document['data'][key]:
+                tmp_list = document['data'][key].split('\n')
+                for index, _ in enumerate(tmp_list):
+                    tmp_list[index] = tmp_list[index].rstrip()
+                document['data'][key] = "\n".join(tmp_list).strip()
+    return document
+
+
+def synthetic_documents(count=200, lines=400):
+    documents = list()
+    for index in range(count):
+        value = "".join("line {} of {}  \n".format(line, index) if line % 3 else "\t\n" for line in range(lines))
+        documents.append({
+            'kind': 'ConfigMap',
+            'metadata': {'name': 'config-{}'.format(index), 'namespace': 'kube-system'},
+            'data': {'config.yaml': value, 'enabled': 'true'}
+        })
+    return documents
+
+
+def _best_of(fn, documents, repeat):
+    # transforms modify documents in place, every run gets its own copy, made outside the timed section
+    copies = [copy.deepcopy(documents) for _ in range(repeat)]
+    timings = list()
+    for documents_copy in copies:
+        started = time.perf_counter()
+        fn(documents_copy)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def bench(name, documents, repeat=5):
+    loop_time = _best_of(
+        lambda documents_copy: [strip_data_whitespace(document) for document in documents_copy], documents, repeat)
+    normaliser_time = _best_of(
+        lambda documents_copy: list(apply_transforms(documents_copy, normalise_multiline_whitespace())),
+        documents, repeat)
+
+    expected = [strip_data_whitespace(document) for document in copy.deepcopy(documents)]
+    changed = list()
+    actual = list(apply_transforms(copy.deepcopy(documents), normalise_multiline_whitespace(changed)))
+    return [
+        name,
+        len(documents),
+        len(changed),
+        '{:.2f}'.format(loop_time * 1000),
+        '{:.2f}'.format(normaliser_time * 1000),
+        '{:.1f}x'.format(loop_time / max(normaliser_time, 1e-9)),
+        'yes' if actual == expected else 'NO'
+    ]
+
+
+def main(argv):
+    table = [['manifest', 'documents', 'changed', 'line loop [ms]', 'normaliser [ms]', 'speedup', 'same output']]
+    table.append(bench('synthetic', synthetic_documents()))
+    for file_name in argv:
+        table.append(bench(file_name, list(apply_transforms(read_documents(file_name)))))
+    print(tabulate(table, headers='firstrow'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
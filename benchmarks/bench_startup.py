@@ -0,0 +1,73 @@
+"""
+Measures invoke start up: importing the task collection, listing and completing tasks.
+
+    python -m benchmarks.bench_startup [--repeat N]
+
+Every command runs in a fresh interpreter from the project root, best of N wall clock times are reported, next to
+a bare 'import invoke' as the floor no task collection can go below. The slowest imports of the task collection
+(python -X importtime) are listed below the timings.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from tabulate import tabulate
+
+COMMANDS = [
+    ('import invoke', [sys.executable, '-c', 'import invoke']),
+    ('import tasks', [sys.executable, '-c', 'import tasks']),
+    ('invoke --list', [sys.executable, '-m', 'invoke', '--list']),
+    ('invoke --complete', [sys.executable, '-m', 'invoke', '--complete', '--', 'invoke', 'cluster.']),
+]
+
+
+def _project_root():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def best_of(command, repeat):
+    timings = list()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=_project_root(), stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def slowest_imports(count=10):
+    """
+    (cumulative [us], module) of the slowest imports below 'import tasks', invoke's own imports excluded
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import invoke; import tasks'],
+        cwd=_project_root(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    imports = list()
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        module = fields[2].strip()
+        if not module.startswith('invoke'):
+            imports.append((int(fields[1]), module))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    table = [['command', 'best [ms]']]
+    for name, command in COMMANDS:
+        table.append([name, '{:.1f}'.format(best_of(command, args.repeat) * 1000)])
+    print(tabulate(table, headers='firstrow'))
+    print()
+    print(tabulate(
+        [['module', 'cumulative [ms]']] + [[module, '{:.1f}'.format(us / 1000)] for us, module in slowest_imports()],
+        headers='firstrow'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
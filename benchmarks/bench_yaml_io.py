@@ -0,0 +1,55 @@
+"""
+Compares the libyaml backed loader/dumper from tasks.yaml_io with the pure Python ones.
+
+    python -m benchmarks.bench_yaml_io [extra.yaml ...]
+
+Runs over the repo's templates and manifest-examples, pass rendered manifests (e.g. network-services-dependencies.yaml)
+or project-ips.yaml as extra arguments.
+"""
+import glob
+import sys
+import timeit
+
+from tabulate import tabulate
+
+from tasks import yaml_io
+
+
+def _best_of(fn, repeat, number):
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+def bench_file(file_name, repeat=5, number=10):
+    with open(file_name, 'r') as yaml_file:
+        text = yaml_file.read()
+    documents = list(yaml_io.safe_load_all(text))
+
+    load_py = _best_of(lambda: list(yaml_io.safe_load_all(text, loader=yaml_io.PurePythonLoader)), repeat, number)
+    load_c = _best_of(lambda: list(yaml_io.safe_load_all(text)), repeat, number)
+    dump_py = _best_of(lambda: yaml_io.safe_dump_all(documents, dumper=yaml_io.PurePythonDumper), repeat, number)
+    dump_c = _best_of(lambda: yaml_io.safe_dump_all(documents), repeat, number)
+    return [
+        file_name,
+        len(text),
+        '{:.2f}'.format(load_py * 1000),
+        '{:.2f}'.format(load_c * 1000),
+        '{:.1f}x'.format(load_py / load_c),
+        '{:.2f}'.format(dump_py * 1000),
+        '{:.2f}'.format(dump_c * 1000),
+        '{:.1f}x'.format(dump_py / dump_c)
+    ]
+
+
+def main(argv):
+    if yaml_io.SafeLoader is yaml_io.PurePythonLoader:
+        print("PyYAML was built without libyaml, both columns use the pure Python implementation.")
+
+    file_names = sorted(glob.glob('templates/*.yaml')) + sorted(glob.glob('manifest-examples/*.yaml')) + argv
+    table = [['file', 'bytes', 'load py [ms]', 'load C [ms]', 'speedup', 'dump py [ms]', 'dump C [ms]', 'speedup']]
+    for file_name in file_names:
+        table.append(bench_file(file_name))
+    print(tabulate(table, headers='firstrow'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+"""
+Synthetic constellations for benchmarks: a bary and 1-500 satellites, every cluster with its own CIDR blocks,
+several VIPs per role and several worker node pools.
+"""
+import ipaddress
+import os
+
+from tasks.yaml_io import safe_dump
+
+METROS = ('am', 'da', 'fr', 'md', 'ny', 'pa', 'sg', 'sv', 'sy', 'ty')
+PLANS = ('c3.small.x86', 'm3.small.x86', 'm3.large.x86', 'n3.xlarge.x86')
+VIP_ROLES = ('cp', 'ingress', 'mesh')
+MAX_SATELLITES = 500
+
+# /20 pod and service blocks for every cluster, out of 10.0.0.0/8
+_CLUSTER_NETWORK = ipaddress.ip_network('10.0.0.0/8')
+_CLUSTER_BLOCK_PREFIX = 20
+# VIP reservations, out of the benchmarking range
+_RESERVATION_NETWORK = ipaddress.ip_network('198.18.0.0/15')
+
+
+def _cluster_block(index):
+    block_size = 2 ** (32 - _CLUSTER_BLOCK_PREFIX)
+    return ipaddress.ip_network((_CLUSTER_NETWORK.network_address + index * block_size, _CLUSTER_BLOCK_PREFIX))
+
+
+def _cluster(index, name, vips_per_role, node_pools):
+    pod_block, service_block = (_cluster_block(2 * index), _cluster_block(2 * index + 1))
+    return {
+        'name': name,
+        'metro': METROS[index % len(METROS)],
+        'cpem': 'v3.6.2',
+        'pod_cidr_blocks': [str(pod_block)],
+        'service_cidr_blocks': [str(service_block)],
+        'vips': [
+            {'role': role, 'count': vips_per_role, 'vipType': 'global_ipv4' if role == 'ingress' else 'public_ipv4'}
+            for role in VIP_ROLES
+        ],
+        'control_nodes': [{'count': 3, 'plan': PLANS[index % len(PLANS)]}],
+        'worker_nodes': [
+            {'count': 2 + pool % 3, 'plan': PLANS[(index + pool) % len(PLANS)]} for pool in range(node_pools)
+        ]
+    }
+
+
+def synthetic_constellation(satellites, vips_per_role=4, node_pools=4, name='synthetic'):
+    """
+    Constellation spec (as loaded from a .constellation.yaml) with the given number of satellites.
+    """
+    if not 1 <= satellites <= MAX_SATELLITES:
+        raise ValueError("satellites: {} not in 1..{}".format(satellites, MAX_SATELLITES))
+    return {
+        'name': name,
+        'capi': 'v1.4.2',
+        'cabpt': 'v0.6.0',
+        'cacppt': 'v0.5.0',
+        'capp': 'v0.7.1',
+        'version': '0.1.0',
+        'bary': _cluster(0, 'bary', vips_per_role, node_pools),
+        'satellites': [
+            _cluster(index, 'satellite-{:03d}'.format(index), vips_per_role, node_pools)
+            for index in range(1, satellites + 1)
+        ]
+    }
+
+
+def synthetic_ip_reservation(cluster_index, role_index, vips_per_role=4):
+    """
+    Equinix Metal IP reservation, as saved to ip-[role]-reservation.yaml, large enough for vips_per_role addresses.
+    """
+    prefix = 32 - max(2, (vips_per_role + 1).bit_length())
+    block_size = 2 ** (32 - prefix)
+    network = _RESERVATION_NETWORK.network_address + (cluster_index * len(VIP_ROLES) + role_index) * block_size
+    return {
+        'address': str(network),
+        'cidr': prefix,
+        'network': str(network),
+        'public': True,
+        'tags': ['cluster-{}'.format(cluster_index)]
+    }
+
+
+def write_synthetic_constellation(config_dir, satellites, vips_per_role=4, node_pools=4, name='synthetic'):
+    """
+    Writes [config_dir]/[name].constellation.yaml and makes it the ccontext, with a secrets directory per
+    cluster. Returns the constellation spec.
+    """
+    constellation = synthetic_constellation(satellites, vips_per_role, node_pools, name)
+    with open(os.path.join(config_dir, name + '.constellation.yaml'), 'w') as constellation_file:
+        safe_dump(constellation, constellation_file)
+    with open(os.path.join(config_dir, 'ccontext'), 'w') as ccontext_file:
+        ccontext_file.write(name)
+    for cluster in [constellation['bary']] + constellation['satellites']:
+        os.makedirs(os.path.join(config_dir, name, cluster['name']), exist_ok=True)
+    return constellation
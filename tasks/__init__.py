@@ -3,15 +3,55 @@ import os
 from invoke import Collection
 
 from . import apps
+from . import cassette
 from . import cluster
 from . import equinix_metal
 from . import gocy
 from . import helpers
 from . import k8s_context
 from . import network
+from . import tracing
 from .helpers import get_project_root, get_secrets_dir
 
-ns = Collection()
+
+class LazyConfigCollection(Collection):
+    """
+    Collection whose configuration is computed the first time it is asked for, i.e. when a task is executed.
+    Listing and completing tasks (invoke --list, --complete) never needs it.
+    """
+    _lazy_configuration = None
+
+    def configure_lazily(self, load):
+        self._lazy_configuration = load
+
+    def configuration(self, taskpath=None):
+        if self._lazy_configuration is not None:
+            load, self._lazy_configuration = self._lazy_configuration, None
+            self.configure(load())
+        return super().configuration(taskpath)
+
+
+def _configuration():
+    return {
+        'tasks': {
+            'search_root': get_project_root()
+        },
+        'core': {
+            # Max. number of clusters processed in parallel by constellation-wide tasks, override with --jobs
+            'jobs': os.cpu_count() or 1,
+            'secrets_dir': get_secrets_dir(),
+            'ca_dir': os.path.join(
+                get_secrets_dir(),
+                'ca'
+            )
+        },
+        'equinix_metal': {
+            'project_ips_file_name': os.path.join(get_secrets_dir(), 'project-ips.yaml')
+        }
+    }
+
+
+ns = LazyConfigCollection()
 ns.add_collection(cluster)
 ns.add_collection(network)
 ns.add_collection(apps)
@@ -19,19 +59,10 @@ ns.add_collection(equinix_metal)
 ns.add_collection(k8s_context)
 ns.add_collection(gocy)
 
+ns.configure_lazily(_configuration)
 
-ns.configure({
-    'tasks': {
-        'search_root': get_project_root()
-    },
-    'core': {
-        'secrets_dir': get_secrets_dir(),
-        'ca_dir': os.path.join(
-            get_secrets_dir(),
-            'ca'
-        )
-    },
-    'equinix_metal': {
-        'project_ips_file_name': os.path.join(get_secrets_dir(), 'project-ips.yaml')
-    }
-})
+if tracing.is_enabled():
+    tracing.instrument(ns, os.environ[tracing.TRACE_ENV])
+
+if cassette.is_enabled():
+    cassette.activate()
@@ -1,7 +1,13 @@
 import os
 
 from invoke import task
-from tasks.helpers import get_secrets_dir, get_cluster_spec_from_context, get_secrets
+
+from tasks import network
+from tasks.helm_cache import ensure_helm_dependencies
+from tasks.helpers import get_secrets_dir, get_cluster_spec_from_context, get_constellation_clusters, get_secrets
+from tasks.k8s_context import get_cluster_kube_context, get_kube_context, helm, kubectl
+from tasks.parallel import for_each_cluster, run_graph
+from tasks.rollout import wait_for_release
 
 
 def get_gcp_token_file_name():
@@ -34,7 +40,7 @@ def create_dns_tls_namespace(ctx):
     """
     Create namespace to be shared by external-dns and cert-manager
     """
-    ctx.run('kubectl create namespace {} | true'.format(get_dns_tls_namespace_name()), echo=True)
+    ctx.run('{} create namespace {} | true'.format(kubectl(ctx), get_dns_tls_namespace_name()), echo=True)
 
 
 @task()
@@ -53,7 +59,8 @@ def deploy_dns_management_token(ctx, provider='google'):
     if provider == 'google':
         get_google_dns_token(ctx)
 
-        ctx.run("kubectl -n {} create secret generic '{}' --from-file=credentials.json={} | true".format(
+        ctx.run("{} -n {} create secret generic '{}' --from-file=credentials.json={} | true".format(
+            kubectl(ctx),
             get_dns_tls_namespace_name(),
             os.environ.get('GCP_SA_NAME'),
             get_gcp_token_file_name()
@@ -70,16 +77,18 @@ def install_dns_and_tls_dependencies(ctx):
     """
     dns_tls_directory = os.path.join('apps', 'dns-and-tls-dependencies')
     secrets = get_secrets()
+    ensure_helm_dependencies(ctx, dns_tls_directory)
     with ctx.cd(dns_tls_directory):
-        ctx.run("helm dependency build", echo=True)
-        ctx.run("helm upgrade --wait --install --namespace {} "
+        ctx.run("{} upgrade --install --namespace {} "
                 "--set external_dns.provider.google.google_project={} "
                 "--set external_dns.provider.google.domain_filter={} "
                 "dns-and-tls-dependencies ./".format(
+                    helm(ctx),
                     get_dns_tls_namespace_name(),
                     secrets['GCP_PROJECT_ID'],
                     secrets['GCP_DOMAIN']
                 ), echo=True)
+    wait_for_release('dns-and-tls-dependencies', get_dns_tls_namespace_name(), context=get_kube_context(ctx))
 
 
 @task(install_dns_and_tls_dependencies)
@@ -90,10 +99,11 @@ def install_dns_and_tls(ctx):
     dns_tls_directory = os.path.join('apps', 'dns-and-tls')
     secrets = get_secrets()
     with ctx.cd(dns_tls_directory):
-        ctx.run("helm upgrade --install --namespace {} "
+        ctx.run("{} upgrade --install --namespace {} "
                 "--set letsencrypt.email={} "
                 "--set letsencrypt.google.project_id={} "
                 "dns-and-tls ./".format(
+                    helm(ctx),
                     get_dns_tls_namespace_name(),
                     secrets['GOCY_ADMIN_EMAIL'],
                     secrets['GCP_PROJECT_ID']
@@ -112,11 +122,12 @@ def install_whoami_app(ctx):
     print(secrets)
 
     with ctx.cd(dns_tls_directory):
-        ctx.run("kubectl apply -f namespace.yaml", echo=True)
-        ctx.run("helm upgrade --install --namespace test-application "
+        ctx.run("{} apply -f namespace.yaml".format(kubectl(ctx)), echo=True)
+        ctx.run("{} upgrade --install --namespace test-application "
                 "--set test_app.fqdn={} "
                 "--set test_app.name={} "                
                 "whoami-test-app ./".format(
+                    helm(ctx),
                     "whoami.{}.{}".format(
                         os.environ.get('GOCY_SUBDOMAIN'),
                         secrets['GCP_DOMAIN']
@@ -130,6 +141,104 @@ def install_ingress_controller(ctx):
     Install Helm chart apps/ingress-bundle
     """
     app_directory = os.path.join('apps', 'ingress-bundle')
+    ensure_helm_dependencies(ctx, app_directory)
     with ctx.cd(app_directory):
-        ctx.run("helm dependency update", echo=True)
-        ctx.run("helm upgrade --install ingress-bundle --namespace ingress-bundle --create-namespace ./", echo=True)
+        ctx.run("{} upgrade --install ingress-bundle --namespace ingress-bundle --create-namespace ./".format(
+            helm(ctx)), echo=True)
+
+
+# Rollout order of the whole app stack: step -> (task, steps it depends on). CNI comes first, nothing schedules
+# without it, then the two independent chains (network services, DNS and TLS) converge in the test application.
+APP_STACK = {
+    'ca': (network.generate_ca, []),
+    'network-services-dependencies': (network.install_network_service_dependencies, ['ca']),
+    'dockerhub-pull-secret': (network.setup_dockerhub_pull_secret, ['network-services-dependencies']),
+    'network-multitool': (network.deploy_network_multitool, ['dockerhub-pull-secret']),
+    'bgp-peer-routes': (network.hack_fix_bgp_peer_routs, ['network-multitool']),
+    'network-services': (network.install_network_service, ['bgp-peer-routes']),
+    'dns-tls-namespace': (create_dns_tls_namespace, ['network-services-dependencies']),
+    'dns-management-token': (deploy_dns_management_token, ['dns-tls-namespace']),
+    'dns-and-tls-dependencies': (install_dns_and_tls_dependencies, ['dns-management-token']),
+    'dns-and-tls': (install_dns_and_tls, ['dns-and-tls-dependencies']),
+    'ingress-bundle': (install_ingress_controller, ['network-services']),
+    'whoami': (install_whoami_app, ['dns-and-tls', 'ingress-bundle']),
+}
+# Steps producing artifacts shared by all clusters, e.g. the cluster mesh CA, run once ahead of --all-clusters
+SHARED_STEPS = ['ca']
+
+
+def get_app_stack_steps(apps=None, only=False):
+    """
+    Steps of APP_STACK needed to install apps (all of them by default), in APP_STACK order, dependencies included
+    unless only.
+    """
+    if not apps:
+        return list(APP_STACK)
+    unknown = set(apps) - set(APP_STACK)
+    if len(unknown) > 0:
+        raise ValueError("Unknown app(s): {}, expected one of: {}".format(
+            ", ".join(sorted(unknown)), ", ".join(APP_STACK)))
+    if only:
+        return [step for step in APP_STACK if step in apps]
+    steps = set()
+    pending = list(apps)
+    while len(pending) > 0:
+        step = pending.pop()
+        if step not in steps:
+            steps.add(step)
+            pending.extend(APP_STACK[step][1])
+    return [step for step in APP_STACK if step in steps]
+
+
+def _install_app_stack(ctx, steps, jobs):
+    run_graph(
+        ctx,
+        lambda job_ctx, step: APP_STACK[step][0](job_ctx),
+        steps,
+        lambda step: [dependency for dependency in APP_STACK[step][1] if dependency in steps],
+        jobs=jobs,
+        title='step')
+
+
+def _split_jobs(jobs, clusters):
+    """
+    Splits the --jobs budget between the clusters and the steps within each cluster, so that all clusters together
+    run at most jobs commands at once. Returns (cluster jobs, step jobs).
+    """
+    cluster_jobs = max(1, min(int(jobs), len(clusters)))
+    return cluster_jobs, max(1, int(jobs) // cluster_jobs)
+
+
+def _install_app_stack_on_cluster(ctx, cluster_spec, steps, jobs):
+    ctx._set(kube_context=get_cluster_kube_context(cluster_spec.name))
+    # jobs started by the steps themselves, e.g. the BGP node patches, default to core.jobs: keep them in the share too
+    config = ctx.config.clone()
+    config.core.jobs = jobs
+    ctx.config = config
+    _install_app_stack(ctx, steps, jobs)
+
+
+@task(iterable=['app'])
+def install_all(ctx, app=None, only=False, kube_context=None, all_clusters=False, jobs=None):
+    """
+    Installs the app stack, following APP_STACK. Independent charts are installed concurrently, each one as soon as
+    the charts it depends on are rolled out. --app limits the install to the given step(s) and their dependencies,
+    --only skips the dependencies.
+    Targets the current kube context, or --kube-context, or with --all-clusters every cluster in the constellation
+    at once (admin@<cluster> contexts), without switching the current context. --jobs (default: core.jobs) bounds
+    the steps running at once, with --all-clusters across all clusters together.
+    """
+    steps = get_app_stack_steps(app, only)
+    if all_clusters:
+        for step in SHARED_STEPS:
+            if step in steps:
+                APP_STACK[step][0](ctx)
+        steps = [step for step in steps if step not in SHARED_STEPS]
+        clusters = get_constellation_clusters()
+        cluster_jobs, step_jobs = _split_jobs(ctx.core.jobs if jobs is None else jobs, clusters)
+        for_each_cluster(ctx, lambda job_ctx, cluster_spec: _install_app_stack_on_cluster(
+            job_ctx, cluster_spec, steps, step_jobs), jobs=cluster_jobs, clusters=clusters)
+        return
+    if kube_context is not None:
+        ctx._set(kube_context=kube_context)
+    _install_app_stack(ctx, steps, jobs)
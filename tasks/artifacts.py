@@ -0,0 +1,148 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, locks only hold within this process
+    fcntl = None
+
+from tasks.yaml_io import safe_dump
+
+# Mode of new artifacts, as open() would create them, mkstemp's files are owner only. Reading the umask means
+# setting it, done once on import.
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+_NEW_FILE_MODE = 0o666 & ~_UMASK
+
+# One lock per artifact, taken by every writer in this process, backed by flock() for concurrent invoke processes
+_locks = dict()
+_locks_lock = threading.Lock()
+
+
+def _thread_lock(file_name):
+    with _locks_lock:
+        if file_name not in _locks:
+            _locks[file_name] = threading.Lock()
+        return _locks[file_name]
+
+
+def _get_lock_dir():
+    return os.path.join(tempfile.gettempdir(), 'toem-artifact-locks-{}'.format(os.getuid()))
+
+
+@contextlib.contextmanager
+def artifact_lock(file_name):
+    """
+    Exclusive lock on file_name, across threads and processes. Lock files are kept out of the artifact's
+    directory, in a per user temporary directory.
+    """
+    file_name = os.path.abspath(file_name)
+    with _thread_lock(file_name):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(_get_lock_dir(), exist_ok=True)
+        lock_file_name = os.path.join(
+            _get_lock_dir(), hashlib.sha256(file_name.encode('utf-8')).hexdigest()[:32] + '.lock')
+        with open(lock_file_name, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_sha256(file_name):
+    digest = hashlib.sha256()
+    try:
+        with open(file_name, 'rb') as artifact_file:
+            for chunk in iter(lambda: artifact_file.read(1 << 16), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def _fsync_directory(directory):
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+def _commit(tmp_file_name, file_name, skip_unchanged):
+    if skip_unchanged and file_sha256(tmp_file_name) == file_sha256(file_name):
+        os.remove(tmp_file_name)
+        return False
+    os.replace(tmp_file_name, file_name)
+    _fsync_directory(os.path.dirname(file_name))
+    return True
+
+
+@contextlib.contextmanager
+def artifact_path(file_name, skip_unchanged=True):
+    """
+    Yields the name of a temporary file next to file_name, which replaces the artifact once the block completes.
+    For tools writing files themselves, e.g. a 'tool > {}' shell redirection. Readers see the old or the new
+    content, never a truncated file. With skip_unchanged an identical artifact is left alone, keeping its mtime
+    (and everything cached on it). An existing artifact keeps its mode, new ones get the umask's default.
+    """
+    file_name = os.path.abspath(file_name)
+    with artifact_lock(file_name):
+        fd, tmp_file_name = tempfile.mkstemp(
+            dir=os.path.dirname(file_name), prefix='.{}.'.format(os.path.basename(file_name)), suffix='.tmp')
+        os.close(fd)
+        if os.path.exists(file_name):
+            os.chmod(tmp_file_name, os.stat(file_name).st_mode & 0o777)
+        else:
+            os.chmod(tmp_file_name, _NEW_FILE_MODE)
+        try:
+            yield tmp_file_name
+            _commit(tmp_file_name, file_name, skip_unchanged)
+        finally:
+            if os.path.exists(tmp_file_name):
+                os.remove(tmp_file_name)
+
+
+@contextlib.contextmanager
+def open_artifact(file_name, mode='w', skip_unchanged=True):
+    """
+    File object to write an artifact through, see artifact_path. Its content is fsync'ed before it replaces
+    the artifact.
+    """
+    with artifact_path(file_name, skip_unchanged) as tmp_file_name:
+        with open(tmp_file_name, mode) as artifact_file:
+            yield artifact_file
+            artifact_file.flush()
+            os.fsync(artifact_file.fileno())
+
+
+def write_artifact(file_name, content, skip_unchanged=True):
+    """
+    Atomically writes content (str or bytes) to file_name, returns False if an identical artifact was kept.
+    """
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    # checked before taking the lock, a concurrent writer of the same content makes no difference
+    if skip_unchanged and file_sha256(file_name) == hashlib.sha256(data).hexdigest():
+        return False
+    with open_artifact(file_name, 'wb', skip_unchanged) as artifact_file:
+        artifact_file.write(data)
+    return True
+
+
+def write_yaml_artifact(file_name, data, skip_unchanged=True, **kwargs):
+    return write_artifact(file_name, safe_dump(data, **kwargs), skip_unchanged)
+
+
+def write_json_artifact(file_name, data, skip_unchanged=True, **kwargs):
+    return write_artifact(file_name, json.dumps(data, **kwargs), skip_unchanged)
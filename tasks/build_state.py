@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from tasks.artifacts import write_json_artifact
+from tasks.helpers import get_secrets_dir
+
+BUILD_STATE_FILE_NAME = 'build-state.json'
+
+_build_states = dict()
+_build_states_lock = threading.Lock()
+_tool_versions = dict()
+_tool_versions_lock = threading.Lock()
+
+
+def file_content(file_name):
+    """
+    File bytes as a build input, a missing file is an input too.
+    """
+    try:
+        with open(file_name, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def _file_digest(file_name):
+    content = file_content(file_name)
+    if content is None:
+        return None
+    return hashlib.sha256(content).hexdigest()
+
+
+def _is_model(value):
+    # pydantic is imported with the constellation models, nothing can be a BaseModel before they are
+    pydantic = sys.modules.get('pydantic')
+    return pydantic is not None and isinstance(value, pydantic.BaseModel)
+
+
+def inputs_digest(*inputs):
+    """
+    Stable digest over build inputs: bytes, pydantic models and anything json serializable.
+    """
+    digest = hashlib.sha256()
+    for value in inputs:
+        if isinstance(value, bytes):
+            data = value
+        else:
+            if _is_model(value):
+                value = value.dict()
+            data = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+        digest.update(str(len(data)).encode('ascii') + b':' + data)
+    return digest.hexdigest()
+
+
+def tool_version(ctx, command):
+    """
+    Output of a '<tool> version' command, queried once per process.
+    """
+    with _tool_versions_lock:
+        if command in _tool_versions:
+            return _tool_versions[command]
+    version = ctx.run(command, hide=True, warn=True).stdout.strip()
+    with _tool_versions_lock:
+        _tool_versions[command] = version
+    return version
+
+
+class BuildState:
+    """
+    Sidecar file recording, for every produced artifact, the digest of the inputs it was built from and the digest
+    of the artifact itself. A step is up to date when its inputs did not change and its outputs were not touched.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        try:
+            with open(file_name, 'r') as state_file:
+                self._targets = json.load(state_file)
+        except (OSError, ValueError):
+            self._targets = dict()
+
+    def is_up_to_date(self, targets, digest):
+        with self._lock:
+            records = [self._targets.get(target) for target in targets]
+        for target, record in zip(targets, records):
+            if record is None or record['inputs'] != digest or record['output'] != _file_digest(target):
+                return False
+        return True
+
+    def record(self, targets, digest):
+        outputs = {target: _file_digest(target) for target in targets}
+        with self._lock:
+            for target, output in outputs.items():
+                self._targets[target] = {'inputs': digest, 'output': output}
+            self._save()
+
+    def forget(self, targets):
+        with self._lock:
+            for target in targets:
+                self._targets.pop(target, None)
+            self._save()
+
+    def _save(self):
+        write_json_artifact(self.file_name, self._targets, indent=2, sort_keys=True)
+
+
+def get_build_state():
+    file_name = os.path.join(get_secrets_dir(), BUILD_STATE_FILE_NAME)
+    with _build_states_lock:
+        if file_name not in _build_states:
+            _build_states[file_name] = BuildState(file_name)
+        return _build_states[file_name]
+
+
+def build_step(targets, inputs, build):
+    """
+    Runs build() unless all targets are up to date with inputs, returns True if the step was executed.
+    """
+    state = get_build_state()
+    digest = inputs_digest(*inputs)
+    if state.is_up_to_date(targets, digest):
+        print("Up to date, skipping: {}".format(", ".join(targets)))
+        return False
+
+    state.forget(targets)
+    build()
+    state.record(targets, digest)
+    return True
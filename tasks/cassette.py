@@ -0,0 +1,419 @@
+"""
+Records the CLI tools the tasks run (metal, kubectl, talosctl, ...) into a cassette and replays them without the
+tools, their clusters or a network, e.g. to profile or benchmark a pipeline offline.
+
+    TOEM_RECORD=build.cassette.jsonl invoke cluster.build-manifests
+    TOEM_REPLAY=build.cassette.jsonl [TOEM_REPLAY_LATENCY=1] invoke cluster.build-manifests
+
+Both put a directory of shims, one per tool, in front of PATH, so every way of starting a tool (ctx.run, a shell
+pipeline, subprocess) goes through them. While recording a shim runs the real tool and appends its argv, working
+directory, TOOL_ENV subset, stdout, stderr, exit code, duration and the files it wrote into its working directory
+to the cassette (JSON lines), the tool's output reaches the terminal as it is written. While replaying a shim looks
+the call up and plays it back, sleeping the recorded duration times TOEM_REPLAY_LATENCY (default 0). Repeated calls
+are played back in recorded order, the last recording repeats once they run out; a call that was never recorded
+fails. Paths below the project root, the config dir and the home directory are recorded relative to them, so
+cassettes replay on other machines.
+
+Secret values the tasks register (helpers.register_secret, e.g. the API key and the cluster mesh CA key) are
+recorded as ${NAME} placeholders, in arguments and output alike, and replayed as the values the replaying run
+registered. Calls working in, or redirecting their stdout into, the secrets dir record neither their files nor their
+stdout, they are generated credentials and manifests carrying them. Their replay writes nothing, so a replayed run
+needs those artifacts to be built already, unless they were recorded with TOEM_RECORD_SECRETS=1. Other output can
+still carry secrets, e.g. kubectl get secret, cassettes are created readable by their owner only and
+*.cassette.jsonl is ignored by git, do not share them.
+
+Shims load this module by its file name, without the tasks package, keep its imports to the standard library.
+"""
+import atexit
+import contextlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, concurrent shims may interleave their writes
+    fcntl = None
+
+RECORD_ENV = 'TOEM_RECORD'
+REPLAY_ENV = 'TOEM_REPLAY'
+LATENCY_ENV = 'TOEM_REPLAY_LATENCY'
+# Records the secrets dir too: generated credentials end up in the cassette, in exchange it replays from scratch
+RECORD_SECRETS_ENV = 'TOEM_RECORD_SECRETS'
+# Session file of the active shims, set for everything started below them
+SESSION_ENV = 'TOEM_CASSETTE_SESSION'
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+TOOLS = ('metal', 'kubectl', 'talosctl', 'clusterctl', 'helm', 'cilium', 'kind', 'curl')
+# Environment the tools' output depends on, part of a call's identity. Secret values, e.g. PACKET_API_KEY, stay out.
+TOOL_ENV = ('CLUSTER_NAME', 'KUBECONFIG', 'TALOSCONFIG', 'METRO', 'SERVICE_DOMAIN', 'TOEM_CP_ENDPOINT')
+# Files a tool writes into its working directory larger than this are not recorded
+MAX_FILE_SIZE = 1 << 20
+
+_SHIM = """#!{python}
+import importlib.util
+import sys
+
+spec = importlib.util.spec_from_file_location('toem_cassette', {module!r})
+cassette = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cassette)
+sys.exit(cassette.shim({session!r}, {tool!r}, sys.argv[1:]))
+"""
+
+
+class CassetteError(Exception):
+    pass
+
+
+def is_enabled():
+    return bool(os.environ.get(RECORD_ENV) or os.environ.get(REPLAY_ENV))
+
+
+@contextlib.contextmanager
+def _locked(file_name, mode):
+    with open(file_name, mode) as locked_file:
+        if fcntl is not None:
+            fcntl.flock(locked_file, fcntl.LOCK_EX)
+        try:
+            yield locked_file
+        finally:
+            if fcntl is not None:
+                fcntl.flock(locked_file, fcntl.LOCK_UN)
+
+
+def _decode(data):
+    # JSON escapes the surrogates of undecodable bytes, _encode restores them
+    return data.decode('utf-8', errors='surrogateescape')
+
+
+def _encode(text):
+    return text.encode('utf-8', errors='surrogateescape')
+
+
+def _normalise(text, placeholders):
+    for name, path in placeholders:
+        text = text.replace(path, '${' + name + '}')
+    return text
+
+
+def _denormalise(text, placeholders):
+    for name, path in placeholders:
+        text = text.replace('${' + name + '}', path)
+    return text
+
+
+def _default_placeholders():
+    from tasks.helpers import get_config_dir, get_project_root
+
+    return [
+        ['TOEM_PROJECT_ROOT', get_project_root()],
+        ['GOCY_DEFAULT_ROOT', get_config_dir()],
+        ['HOME', os.path.expanduser('~')]
+    ]
+
+
+def _default_excluded():
+    from tasks.helpers import get_secrets_dir
+
+    return [get_secrets_dir()]
+
+
+def _is_excluded(file_name, session):
+    real_file_name = os.path.realpath(file_name)
+    return any(
+        os.path.commonpath([real_file_name, excluded]) == excluded for excluded in session['excluded'])
+
+
+def _share_secrets(secret_values):
+    """
+    Merges the secrets registered in this process into the secrets file of the active session, a listener of
+    helpers.add_secret_listener. Several invoke processes may share a session, e.g. invoke started by a task.
+    """
+    session_file_name = os.environ.get(SESSION_ENV)
+    if not session_file_name or not secret_values:
+        return
+    shims = os.path.dirname(session_file_name)
+    if not os.path.isdir(shims):
+        return
+    secrets_file_name = os.path.join(shims, 'secrets.json')
+    with _locked(os.path.join(shims, 'secrets.lock'), 'a'):
+        shared = _read_secrets(secrets_file_name)
+        shared.update(secret_values)
+        # replaced as a whole, shims read it without the lock
+        temp_file_name = secrets_file_name + '.tmp'
+        with os.fdopen(os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as temp_file:
+            json.dump(shared, temp_file)
+        os.replace(temp_file_name, secrets_file_name)
+
+
+def _read_secrets(secrets_file_name):
+    try:
+        with open(secrets_file_name, 'r') as secrets_file:
+            return json.load(secrets_file)
+    except OSError:
+        return dict()
+
+
+def _secret_placeholders(session):
+    # longest first, a secret may contain another one, e.g. the CPEM config its API key
+    return sorted(
+        [[name, value] for name, value in _read_secrets(os.path.join(session['shims'], 'secrets.json')).items()
+         if value],
+        key=lambda placeholder: len(placeholder[1]), reverse=True)
+
+
+def _stdout_file_name():
+    """
+    Name of the regular file stdout is redirected to, where the OS tells (/proc), otherwise None
+    """
+    try:
+        if not stat.S_ISREG(os.fstat(sys.stdout.fileno()).st_mode):
+            return None
+        return os.readlink('/proc/self/fd/{}'.format(sys.stdout.fileno()))
+    except (OSError, ValueError):
+        return None
+
+
+def call_key(tool, argv, cwd, env):
+    return json.dumps([tool, argv, cwd, env], sort_keys=True)
+
+
+def read_cassette(file_name):
+    """
+    {call key: [recordings, in recorded order]}
+    """
+    recordings = dict()
+    with open(file_name, 'r') as cassette_file:
+        for line in cassette_file:
+            if line.strip():
+                recording = json.loads(line)
+                key = call_key(recording['tool'], recording['argv'], recording['cwd'], recording['env'])
+                recordings.setdefault(key, list()).append(recording)
+    return recordings
+
+
+def _call(session, tool, argv):
+    placeholders = session['placeholders']
+    return (
+        [_normalise(arg, placeholders) for arg in argv],
+        _normalise(os.getcwd(), placeholders),
+        {name: _normalise(os.environ[name], placeholders) for name in TOOL_ENV if name in os.environ}
+    )
+
+
+def _cwd_files():
+    files = dict()
+    with os.scandir('.') as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                entry_stat = entry.stat()
+                files[entry.name] = (entry_stat.st_mtime_ns, entry_stat.st_size, entry_stat.st_ino)
+    return files
+
+
+def _written_files(before, after):
+    """
+    Files created or changed in the working directory, but for the one stdout is redirected to
+    """
+    try:
+        stdout_stat = os.fstat(sys.stdout.fileno())
+        stdout_inode = stdout_stat.st_ino if stat.S_ISREG(stdout_stat.st_mode) else None
+    except (OSError, ValueError):
+        stdout_inode = None
+    written = dict()
+    for name, (mtime, size, inode) in after.items():
+        if before.get(name) == (mtime, size, inode) or inode == stdout_inode or size > MAX_FILE_SIZE:
+            continue
+        with open(name, 'rb') as written_file:
+            written[name] = _decode(written_file.read())
+    return written
+
+
+def _tee(source, target, chunks):
+    # read1 returns whatever the tool wrote so far, so e.g. kubectl wait's progress is not held back
+    for chunk in iter(lambda: source.read1(1 << 16), b''):
+        chunks.append(chunk)
+        target.write(chunk)
+        target.flush()
+    source.close()
+
+
+def _run_teed(command):
+    """
+    Runs command, passing its stdout and stderr through while capturing them. Returns (exit code, stdout, stderr).
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = list(), list()
+    readers = [
+        threading.Thread(target=_tee, args=(process.stdout, sys.stdout.buffer, stdout)),
+        threading.Thread(target=_tee, args=(process.stderr, sys.stderr.buffer, stderr))
+    ]
+    for reader in readers:
+        reader.start()
+    exit_code = process.wait()
+    for reader in readers:
+        reader.join()
+    return exit_code, b''.join(stdout), b''.join(stderr)
+
+
+def _record(session, tool, argv):
+    real_tool = shutil.which(tool, path=session['path'])
+    if real_tool is None:
+        sys.stderr.write("{}: command not found\n".format(tool))
+        return 127
+    call_argv, cwd, env = _call(session, tool, argv)
+    stdout_file_name = _stdout_file_name()
+    excluded = _is_excluded(os.getcwd(), session) or (
+        stdout_file_name is not None and _is_excluded(stdout_file_name, session))
+    before = _cwd_files()
+    started = time.perf_counter()
+    exit_code, stdout, stderr = _run_teed([real_tool] + argv)
+    duration = time.perf_counter() - started
+    placeholders = session['placeholders']
+    recording = {
+        'tool': tool,
+        'argv': call_argv,
+        'cwd': cwd,
+        'env': env,
+        'stdout': '' if excluded else _normalise(_decode(stdout), placeholders),
+        'stderr': _normalise(_decode(stderr), placeholders),
+        'exit_code': exit_code,
+        'duration': round(duration, 6),
+        'files': dict() if excluded else {
+            name: _normalise(content, placeholders)
+            for name, content in _written_files(before, _cwd_files()).items()
+        }
+    }
+    with _locked(session['cassette'], 'a') as cassette_file:
+        cassette_file.write(json.dumps(recording, sort_keys=True) + '\n')
+    return exit_code
+
+
+def _replay(session, tool, argv):
+    call_argv, cwd, env = _call(session, tool, argv)
+    key = call_key(tool, call_argv, cwd, env)
+    recordings = read_cassette(session['cassette']).get(key)
+    if not recordings:
+        sys.stderr.write("{}: no recording of: {} {} (cwd: {}, env: {})\n".format(
+            session['cassette'], tool, ' '.join(call_argv), cwd, env))
+        return 1
+    with _locked(os.path.join(session['shims'], 'replayed.json'), 'a+') as state_file:
+        state_file.seek(0)
+        replayed = json.loads(state_file.read() or '{}')
+        recording = recordings[min(replayed.get(key, 0), len(recordings) - 1)]
+        replayed[key] = replayed.get(key, 0) + 1
+        state_file.seek(0)
+        state_file.truncate()
+        state_file.write(json.dumps(replayed))
+    if session['latency']:
+        time.sleep(recording['duration'] * session['latency'])
+    placeholders = session['placeholders']
+    for name, content in recording['files'].items():
+        with open(name, 'wb') as replayed_file:
+            replayed_file.write(_encode(_denormalise(content, placeholders)))
+    sys.stdout.buffer.write(_encode(_denormalise(recording['stdout'], placeholders)))
+    sys.stderr.buffer.write(_encode(_denormalise(recording['stderr'], placeholders)))
+    return recording['exit_code']
+
+
+def shim(session_file_name, tool, argv):
+    """
+    Entry point of the shim of tool, returns its exit code.
+    """
+    with open(session_file_name, 'r') as session_file:
+        session = json.load(session_file)
+    # secrets before paths, a secret may well contain one
+    session['placeholders'] = _secret_placeholders(session) + session['placeholders']
+    try:
+        if session['mode'] == RECORD:
+            return _record(session, tool, argv)
+        return _replay(session, tool, argv)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def start(cassette_file_name, mode, latency=0.0, tools=TOOLS, placeholders=None, excluded=None):
+    """
+    Puts the shims of tools in front of PATH, for this process and everything it starts. Returns the session,
+    to be handed to stop. Files written below the excluded directories, by default the secrets dir, are not recorded.
+    Secrets registered by this process are shared with the shims, see _share_secrets.
+    """
+    from tasks.helpers import add_secret_listener
+
+    if mode not in (RECORD, REPLAY):
+        raise CassetteError("Unknown cassette mode: {}".format(mode))
+    cassette_file_name = os.path.abspath(cassette_file_name)
+    if mode == REPLAY and not os.path.isfile(cassette_file_name):
+        raise CassetteError("No cassette to replay: {}".format(cassette_file_name))
+    if mode == RECORD:
+        os.close(os.open(cassette_file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600))
+        os.chmod(cassette_file_name, 0o600)
+    shims = tempfile.mkdtemp(prefix='toem-shims-')
+    session = {
+        'mode': mode,
+        'cassette': cassette_file_name,
+        'latency': latency,
+        'shims': shims,
+        'path': os.environ.get('PATH', os.defpath),
+        # longest first, for paths nested in each other, e.g. a config dir in the home directory
+        'placeholders': sorted(
+            [[name, path] for name, path in (placeholders or _default_placeholders()) if path and path != os.sep],
+            key=lambda placeholder: len(placeholder[1]), reverse=True),
+        'excluded': [os.path.realpath(path) for path in (_default_excluded() if excluded is None else excluded)]
+    }
+    session_file_name = os.path.join(shims, 'session.json')
+    with open(session_file_name, 'w') as session_file:
+        json.dump(session, session_file)
+    for tool in tools:
+        shim_file_name = os.path.join(shims, tool)
+        with open(shim_file_name, 'w') as shim_file:
+            shim_file.write(_SHIM.format(
+                python=sys.executable, module=os.path.abspath(__file__), session=session_file_name, tool=tool))
+        os.chmod(shim_file_name, 0o755)
+    os.environ['PATH'] = shims + os.pathsep + session['path']
+    os.environ[SESSION_ENV] = session_file_name
+    add_secret_listener(_share_secrets)
+    return session
+
+
+def stop(session):
+    if os.environ.get(SESSION_ENV) == os.path.join(session['shims'], 'session.json'):
+        os.environ['PATH'] = session['path']
+        del os.environ[SESSION_ENV]
+    shutil.rmtree(session['shims'], ignore_errors=True)
+
+
+@contextlib.contextmanager
+def cassette(cassette_file_name, mode, latency=0.0, tools=TOOLS, placeholders=None, excluded=None):
+    session = start(cassette_file_name, mode, latency, tools, placeholders, excluded)
+    try:
+        yield session
+    finally:
+        stop(session)
+
+
+def activate():
+    """
+    Starts recording or replaying as asked for by TOEM_RECORD/TOEM_REPLAY, until the process exits. Below
+    another session, e.g. invoke started by a task, the outer session's shims are already in place, only the secrets
+    registered here are shared with them.
+    """
+    if os.environ.get(SESSION_ENV):
+        from tasks.helpers import add_secret_listener
+
+        add_secret_listener(_share_secrets)
+        return
+    if os.environ.get(REPLAY_ENV):
+        session = start(os.environ[REPLAY_ENV], REPLAY, float(os.environ.get(LATENCY_ENV) or 0))
+    else:
+        session = start(os.environ[RECORD_ENV], RECORD, excluded=[] if os.environ.get(RECORD_SECRETS_ENV) else None)
+    atexit.register(stop, session)
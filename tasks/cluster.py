@@ -1,20 +1,26 @@
+import copy
+import functools
 import glob
+import operator
 import os
 import re
 import shutil
 
-import yaml
 from invoke import task
 
+from tasks.artifacts import artifact_path, write_artifact, write_yaml_artifact
+from tasks.build_state import build_step, file_content, get_build_state, inputs_digest, tool_version
 from tasks.equinix_metal import generate_cpem_config, register_vips
-from tasks.helpers import str_presenter, get_cluster_name, get_secrets_dir, \
-    get_cpem_config_yaml, get_cp_vip_address, get_constellation_clusters, get_cluster_spec, \
-    get_cluster_spec_from_context, get_constellation
+from tasks.helpers import get_cluster_name, get_secrets_dir, \
+    get_cpem_config_yaml, get_cp_vip_address, get_cluster_spec, \
+    get_cluster_spec_from_context, get_constellation, get_constellation_clusters, _cached_load
 from tasks.k8s_context import use_kind_cluster_context, use_bary_cluster_context
-from tasks.network import build_network_service_dependencies_manifest
-
-yaml.add_representer(str, str_presenter)
-yaml.representer.SafeRepresenter.add_representer(str, str_presenter)  # to use with safe_dump
+from tasks.manifests import read_documents, apply_transforms, for_kind, process_manifest, write_documents
+from tasks.metal_api import get_metal_api
+from tasks.network import build_network_service_dependencies_manifest, get_network_manifest_file_name
+from tasks.parallel import for_each_cluster, run_graph
+from tasks.talos_patch import patch_talos_config_file
+from tasks.yaml_io import safe_dump_all, safe_load
 
 _CLUSTER_MANIFEST_FILE_NAME = "cluster-manifest.yaml"
 _CLUSTER_MANIFEST_STATIC_FILE_NAME = "cluster-manifest.static-config.yaml"
@@ -25,190 +31,353 @@ def patch_template_with_cilium_manifest(
         ctx,
         templates_dir='templates',
         cluster_template_file_name='inline-cni.yaml',
-        manifest_name='network-services-dependencies.yaml'):
+        manifest_name='network-services-dependencies'):
     """
     Patch talos machine config with cilium CNI manifest for inline installation method
     https://www.talos.dev/v1.3/kubernetes-guides/network/deploying-cilium/#method-4-helm-manifests-inline-install
     """
+    cluster_spec = get_cluster_spec(ctx, get_cluster_name())
+    network_manifest_yaml = safe_dump_all(
+        apply_transforms(read_documents(get_network_manifest_file_name(cluster_spec, manifest_name))))
+
+    def _inline_network_manifest(patches):
+        for patch in patches:
+            if 'name' in patch['value'] and patch['value']['name'] == 'network-services-dependencies':
+                patch['value']['contents'] = network_manifest_yaml
+
+    @for_kind('TalosControlPlane')
+    def _patch_control_plane(document):
+        _inline_network_manifest(document['spec']['controlPlaneConfig']['controlplane']['configPatches'])
+        return document
+
+    @for_kind('TalosConfigTemplate')
+    def _patch_config_template(document):
+        _inline_network_manifest(document['spec']['template']['spec']['configPatches'])
+        return document
+
+    process_manifest(
+        os.path.join(templates_dir, cluster_template_file_name),
+        os.path.join(templates_dir, get_cluster_name() + '.yaml'),
+        _patch_control_plane,
+        _patch_config_template
+    )
+
+
+# Where Talos config documents of a CAPI cluster template keep their configPatches
+_CONFIG_PATCHES_KEYS = {
+    'TalosControlPlane': ('spec', 'controlPlaneConfig', 'controlplane', 'configPatches'),
+    'TalosConfigTemplate': ('spec', 'template', 'spec', 'configPatches')
+}
+_CLUSTER_NETWORK_KEYS = ('spec', 'clusterNetwork')
+
+
+def _get_node(document, keys):
+    return functools.reduce(operator.getitem, keys, document)
+
 
-    with open(os.path.join(get_secrets_dir(), manifest_name), 'r') as network_manifest_file:
-        network_manifest = list(yaml.safe_load_all(network_manifest_file))
+def index_cluster_template(documents):
+    """
+    (kind, path) -> [(document index, keys)] of every node template_cluster_template specialises: the value of
+    Talos config patches by patch path (e.g. ('TalosControlPlane', '/cluster/network')) and the Cluster's
+    clusterNetwork under ('Cluster', '/spec/clusterNetwork').
+    """
+    index = dict()
+    for document_index, document in enumerate(documents):
+        kind = document.get('kind')
+        if kind in _CONFIG_PATCHES_KEYS:
+            patches_keys = _CONFIG_PATCHES_KEYS[kind]
+            for patch_index, patch in enumerate(_get_node(document, patches_keys)):
+                index.setdefault((kind, patch['path']), list()).append(
+                    (document_index, patches_keys + (patch_index, 'value')))
+        if kind == 'Cluster':
+            index.setdefault((kind, '/' + '/'.join(_CLUSTER_NETWORK_KEYS)), list()).append(
+                (document_index, _CLUSTER_NETWORK_KEYS))
+    return index
+
+
+def _load_cluster_template(file_name):
+    documents = list(read_documents(file_name))
+    return documents, index_cluster_template(documents)
+
+
+def _copy_node(documents, document_index, keys):
+    """
+    Copies the containers on the way to a node, and the node itself, everything else stays shared with the parsed
+    template. Returns the copied node.
+    """
+    node = documents[document_index] = copy.copy(documents[document_index])
+    for key in keys:
+        node[key] = copy.copy(node[key])
+        node = node[key]
+    return node
 
-    network_manifest_yaml = yaml.safe_dump_all(network_manifest)
-    with open(os.path.join(templates_dir, cluster_template_file_name), 'r') as cluster_template_file:
-        _cluster_template = list(yaml.safe_load_all(cluster_template_file))
-        for document in _cluster_template:
-            if document['kind'] == 'TalosControlPlane':
-                for patch in document['spec']['controlPlaneConfig']['controlplane']['configPatches']:
-                    if 'name' in patch['value'] and patch['value']['name'] == 'network-services-dependencies':
-                        patch['value']['contents'] = network_manifest_yaml
-            if document['kind'] == 'TalosConfigTemplate':
-                for patch in document['spec']['template']['spec']['configPatches']:
-                    if 'name' in patch['value'] and patch['value']['name'] == 'network-services-dependencies':
-                        patch['value']['contents'] = network_manifest_yaml
 
-        with open(os.path.join(templates_dir, get_cluster_name() + '.yaml'), 'w') as target:
-            yaml.safe_dump_all(_cluster_template, target)
+def specialise_cluster_template(cluster_template, cluster_spec):
+    """
+    Cluster's documents of a template loaded by _load_cluster_template. Only the indexed nodes are copied and
+    modified, the parsed template is left untouched and can be specialised for the next cluster.
+    """
+    documents, index = cluster_template
+    documents = list(documents)
+    for kind in _CONFIG_PATCHES_KEYS:
+        for document_index, keys in index.get((kind, '/cluster/network'), list()):
+            value = _copy_node(documents, document_index, keys)
+            value['dnsDomain'] = "{}.local".format(cluster_spec.name)
+            value['podSubnets'] = cluster_spec.pod_cidr_blocks
+            value['serviceSubnets'] = cluster_spec.service_cidr_blocks
+    for document_index, keys in index.get(('Cluster', '/spec/clusterNetwork'), list()):
+        cluster_network = _copy_node(documents, document_index, keys)
+        cluster_network['pods'] = dict(cluster_network['pods'], cidrBlocks=cluster_spec.pod_cidr_blocks)
+        cluster_network['services'] = dict(cluster_network['services'], cidrBlocks=cluster_spec.service_cidr_blocks)
+    return documents
+
+
+def _template_cluster_template(cluster_spec, cluster_template_name):
+    cluster_template = _cached_load(os.path.join('templates', cluster_template_name), _load_cluster_template)
+    write_documents(
+        os.path.join(get_secrets_dir(), cluster_spec.name, cluster_template_name),
+        specialise_cluster_template(cluster_template, cluster_spec))
 
 
 @task()
-def template_cluster_template(ctx, cluster_template_name='default.yaml'):
+def template_cluster_template(ctx, cluster_template_name='default.yaml', jobs=None):
     """
     Produces [secrets_dir]/[Cluster_name]/default.yaml CAPi cluster template with
     corrected dnsDomain,podSubnets,serviceSubnets
     As a result of a bug? settings in Cluster.spec.clusterNetwork do not affect the running cluster.
     Those changes need to be put in the Talos config.
     """
-    for cluster_spec in get_constellation_clusters():
-        with open(os.path.join('templates', cluster_template_name), 'r') as cluster_template_file:
-            cluster_template = list(yaml.safe_load_all(cluster_template_file))
-
-            for document in cluster_template:
-                if document['kind'] == 'TalosControlPlane':
-                    patches = document['spec']['controlPlaneConfig']['controlplane']['configPatches']
-                    for patch in patches:
-                        if patch['path'] == '/cluster/network':
-                            patch['value']['dnsDomain'] = "{}.local".format(cluster_spec.name)
-                            patch['value']['podSubnets'] = cluster_spec.pod_cidr_blocks
-                            patch['value']['serviceSubnets'] = cluster_spec.service_cidr_blocks
-                if document['kind'] == 'TalosConfigTemplate':
-                    patches = document['spec']['template']['spec']['configPatches']
-                    for patch in patches:
-                        if patch['path'] == '/cluster/network':
-                            patch['value']['dnsDomain'] = "{}.local".format(cluster_spec.name)
-                            patch['value']['podSubnets'] = cluster_spec.pod_cidr_blocks
-                            patch['value']['serviceSubnets'] = cluster_spec.service_cidr_blocks
-                if document['kind'] == 'Cluster':
-                    document['spec']['clusterNetwork']['pods']['cidrBlocks'] = cluster_spec.pod_cidr_blocks
-                    document['spec']['clusterNetwork']['services']['cidrBlocks'] = cluster_spec.service_cidr_blocks
-
-        with open(os.path.join(
-                get_secrets_dir(), cluster_spec.name, cluster_template_name), 'w') as cluster_template_file:
-            yaml.safe_dump_all(cluster_template, cluster_template_file)
+    def _template_cluster_template_step(job_ctx, cluster_spec):
+        build_step(
+            [os.path.join(get_secrets_dir(), cluster_spec.name, cluster_template_name)],
+            [
+                'cluster-template',
+                file_content(os.path.join('templates', cluster_template_name)),
+                cluster_spec.name,
+                cluster_spec.pod_cidr_blocks,
+                cluster_spec.service_cidr_blocks
+            ],
+            lambda: _template_cluster_template(cluster_spec, cluster_template_name)
+        )
+
+    for_each_cluster(ctx, _template_cluster_template_step, jobs)
+
+
+def _clusterctl_generate_cluster_manifest(
+        ctx, cluster_spec, cluster_template_file_name, cluster_manifest_file_name, env):
+    with artifact_path(cluster_manifest_file_name) as tmp_file_name:
+        ctx.run("clusterctl generate cluster {} --from {} > {}".format(
+            cluster_spec.name,
+            cluster_template_file_name,
+            tmp_file_name
+        ), echo=True, env=env)
 
 
 @task(register_vips, use_kind_cluster_context, template_cluster_template)
-def clusterctl_generate_cluster(ctx, cluster_template_name='default.yaml'):
+def clusterctl_generate_cluster(ctx, cluster_template_name='default.yaml', jobs=None):
     """
     Produces ClusterAPI manifest, to be applied on the management cluster.
     """
-    for cluster_spec in get_constellation_clusters():
-        ctx.run("clusterctl generate cluster {} --from {} > {}".format(
-            cluster_spec.name,
-            os.path.join(get_secrets_dir(), cluster_spec.name, cluster_template_name),
-            os.path.join(get_secrets_dir(), cluster_spec.name, _CLUSTER_MANIFEST_FILE_NAME)
-        ),
-            echo=True,
-            env={
-                'TOEM_CPEM_SECRET': get_cpem_config_yaml(),
-                'TOEM_CP_ENDPOINT': get_cp_vip_address(cluster_spec),
-                'SERVICE_DOMAIN': "{}.local".format(cluster_spec.name),
-                'CLUSTER_NAME': cluster_spec.name,
-                'METRO': cluster_spec.metro
-            }
+    def _clusterctl_generate_cluster(job_ctx, cluster_spec):
+        cluster_template_file_name = os.path.join(get_secrets_dir(), cluster_spec.name, cluster_template_name)
+        cluster_manifest_file_name = os.path.join(get_secrets_dir(), cluster_spec.name, _CLUSTER_MANIFEST_FILE_NAME)
+        env = {
+            'TOEM_CPEM_SECRET': get_cpem_config_yaml(),
+            'TOEM_CP_ENDPOINT': get_cp_vip_address(cluster_spec),
+            'SERVICE_DOMAIN': "{}.local".format(cluster_spec.name),
+            'CLUSTER_NAME': cluster_spec.name,
+            'METRO': cluster_spec.metro
+        }
+        build_step(
+            [cluster_manifest_file_name],
+            [
+                'clusterctl-generate-cluster',
+                file_content(cluster_template_file_name),
+                file_content(os.path.join(os.path.expanduser('~'), '.cluster-api', 'clusterctl.yaml')),
+                tool_version(job_ctx, 'clusterctl version -o short'),
+                env
+            ],
+            lambda: _clusterctl_generate_cluster_manifest(
+                job_ctx, cluster_spec, cluster_template_file_name, cluster_manifest_file_name, env)
         )
 
+    for_each_cluster(ctx, _clusterctl_generate_cluster, jobs)
+
+
+# Talos machine config roles, patched and validated independently of each other
+_TALOS_ROLES = ('worker', 'controlplane')
+
+
+def _talos_configs_match(cluster_spec_dir, cluster_name, endpoint):
+    """
+    Whether the generated configs, e.g. ones generated before they were build state targets, are for cluster_name
+    behind endpoint. Matching configs are kept, regenerating them would replace the cluster's secrets.
+    """
+    for role in _TALOS_ROLES:
+        try:
+            with open(os.path.join(cluster_spec_dir, '{}.yaml'.format(role)), 'r') as config_file:
+                cluster = safe_load(config_file).get('cluster') or dict()
+        except FileNotFoundError:
+            return False
+        if (cluster.get('controlPlane') or dict()).get('endpoint') != endpoint:
+            return False
+        if role == 'controlplane' and cluster.get('clusterName') != cluster_name:
+            return False
+    return True
+
 
 @task(register_vips)
-def talosctl_gen_config(ctx):
+def talosctl_gen_config(ctx, jobs=None):
     """
     Produces initial Talos machine configuration, that later on will be patched with custom cluster settings.
+    Regenerated when the cluster's control plane endpoint changes.
     """
-    for cluster_spec in get_constellation_clusters():
+    def _talosctl_gen_config(job_ctx, cluster_spec):
         cluster_spec_dir = os.path.join(get_secrets_dir(), cluster_spec.name)
-        with ctx.cd(cluster_spec_dir):
-            ctx.run(
-                "talosctl gen config {} https://{}:6443 | true".format(
-                    cluster_spec.name,
-                    get_cp_vip_address(cluster_spec)
-                ),
-                echo=True
-            )
+        cp_vip_address = get_cp_vip_address(cluster_spec)
+        endpoint = "https://{}:6443".format(cp_vip_address)
+
+        def _gen_config():
+            if _talos_configs_match(cluster_spec_dir, cluster_spec.name, endpoint):
+                print("Talos configs of {} match {}, keeping them".format(cluster_spec.name, endpoint))
+                return
+            with job_ctx.cd(cluster_spec_dir):
+                job_ctx.run("talosctl gen config --force {} {}".format(cluster_spec.name, endpoint), echo=True)
+
+        build_step(
+            [os.path.join(cluster_spec_dir, '{}.yaml'.format(role)) for role in _TALOS_ROLES],
+            ['talosctl-gen-config', cluster_spec.name, cp_vip_address],
+            _gen_config
+        )
 
+    for_each_cluster(ctx, _talosctl_gen_config, jobs)
 
-def add_talos_hashbang(filename):
-    with open(filename, 'r') as file:
-        data = file.read()
 
-    with open(filename, 'w') as file:
-        file.write("#!talos\n" + data)
+def _get_talos_config_targets(cluster_spec):
+    config_dir_name = os.path.join(get_secrets_dir(), cluster_spec.name)
+    return [os.path.join(config_dir_name, '{}-capi.yaml'.format(role)) for role in _TALOS_ROLES] + [
+        os.path.join(config_dir_name, _CLUSTER_MANIFEST_STATIC_FILE_NAME)]
 
 
-def _talos_apply_config_patch(ctx, cluster_spec):
-    cluster_manifest_file_name = os.path.join(get_secrets_dir(), cluster_spec.name, _CLUSTER_MANIFEST_FILE_NAME)
-    cluster_manifest_static_file_name = os.path.join(
-        get_secrets_dir(), cluster_spec.name, _CLUSTER_MANIFEST_STATIC_FILE_NAME)
+def _read_talos_config_patches(cluster_spec):
+    """
+    CAPI configPatches of both roles, as found in the cluster manifest: role -> JSON 6902 operations
+    """
     config_dir_name = os.path.join(get_secrets_dir(), cluster_spec.name)
+    patches = dict()
+    for document in read_documents(os.path.join(config_dir_name, _CLUSTER_MANIFEST_FILE_NAME)):
+        if document['kind'] == 'TalosControlPlane':
+            patches['controlplane'] = document['spec']['controlPlaneConfig']['controlplane']['configPatches']
+        if document['kind'] == 'TalosConfigTemplate':
+            patches['worker'] = document['spec']['template']['spec']['configPatches']
+    return patches
 
-    with open(cluster_manifest_file_name) as cluster_manifest_file:
-        for document in yaml.safe_load_all(cluster_manifest_file):
-            if document['kind'] == 'TalosControlPlane':
-                with open(os.path.join(config_dir_name, 'controlplane-patches.yaml'), 'w') as cp_patches_file:
-                    yaml.dump(
-                        document['spec']['controlPlaneConfig']['controlplane']['configPatches'],
-                        cp_patches_file
-                    )
-            if document['kind'] == 'TalosConfigTemplate':
-                with open(os.path.join(config_dir_name, 'worker-patches.yaml'), 'w') as worker_patches_file:
-                    yaml.dump(
-                        document['spec']['template']['spec']['configPatches'],
-                        worker_patches_file
-                    )
-
-    with ctx.cd(config_dir_name):
-        worker_capi_file_name = "worker-capi.yaml"
-        cp_capi_file_name = "controlplane-capi.yaml"
-        ctx.run(
-            "talosctl machineconfig patch worker.yaml --patch @worker-patches.yaml -o {}".format(
-                worker_capi_file_name
-            ),
-            echo=True
-        )
-        ctx.run(
-            "talosctl machineconfig patch controlplane.yaml --patch @controlplane-patches.yaml -o {}".format(
-                cp_capi_file_name
-            ),
-            echo=True
-        )
 
-        add_talos_hashbang(os.path.join(config_dir_name, worker_capi_file_name))
-        add_talos_hashbang(os.path.join(config_dir_name, cp_capi_file_name))
+def _talos_patch_machineconfig(cluster_spec, role, patches):
+    """
+    Produces [role]-capi.yaml, prefixed with #!talos, returns its content. Patched in-process, same output as
+    'talosctl machineconfig patch', written once.
+    """
+    config_dir_name = os.path.join(get_secrets_dir(), cluster_spec.name)
+    talos_config = patch_talos_config_file(os.path.join(config_dir_name, '{}.yaml'.format(role)), patches)
+    write_artifact(os.path.join(config_dir_name, '{}-capi.yaml'.format(role)), talos_config)
+    return talos_config
 
-        ctx.run("talosctl validate -m cloud -c {}".format(worker_capi_file_name))
-        ctx.run("talosctl validate -m cloud -c {}".format(cp_capi_file_name))
 
-    with open(cluster_manifest_file_name) as cluster_manifest_file:
-        documents = list()
-        for document in yaml.safe_load_all(cluster_manifest_file):
-            if document['kind'] == 'TalosControlPlane':
-                del (document['spec']['controlPlaneConfig']['controlplane']['configPatches'])
-                document['spec']['controlPlaneConfig']['controlplane']['generateType'] = "none"
-                with open(os.path.join(config_dir_name, cp_capi_file_name), 'r') as talos_cp_config_file:
-                    document['spec']['controlPlaneConfig']['controlplane']['data'] = talos_cp_config_file.read()
+def _talos_validate_machineconfig(ctx, cluster_spec, role):
+    with ctx.cd(os.path.join(get_secrets_dir(), cluster_spec.name)):
+        ctx.run("talosctl validate -m cloud -c {}-capi.yaml".format(role))
 
-            if document['kind'] == 'TalosConfigTemplate':
-                del (document['spec']['template']['spec']['configPatches'])
-                document['spec']['template']['spec']['generateType'] = 'none'
-                with open(os.path.join(config_dir_name, worker_capi_file_name), 'r') as talos_worker_config_file:
-                    document['spec']['template']['spec']['data'] = talos_worker_config_file.read().strip()
 
-            documents.append(document)
+def _build_static_cluster_manifest(cluster_spec, talos_configs):
+    """
+    Inlines the patched talos configs, as produced by _talos_patch_machineconfig, into the cluster manifest.
+    """
+    config_dir_name = os.path.join(get_secrets_dir(), cluster_spec.name)
 
-    with open(cluster_manifest_static_file_name, 'w') as static_manifest:
-        yaml.safe_dump_all(documents, static_manifest, sort_keys=True)
+    @for_kind('TalosControlPlane')
+    def _static_control_plane_config(document):
+        del (document['spec']['controlPlaneConfig']['controlplane']['configPatches'])
+        document['spec']['controlPlaneConfig']['controlplane']['generateType'] = "none"
+        document['spec']['controlPlaneConfig']['controlplane']['data'] = talos_configs['controlplane']
+        return document
+
+    @for_kind('TalosConfigTemplate')
+    def _static_worker_config(document):
+        del (document['spec']['template']['spec']['configPatches'])
+        document['spec']['template']['spec']['generateType'] = 'none'
+        document['spec']['template']['spec']['data'] = talos_configs['worker'].strip()
+        return document
+
+    process_manifest(
+        os.path.join(config_dir_name, _CLUSTER_MANIFEST_FILE_NAME),
+        os.path.join(config_dir_name, _CLUSTER_MANIFEST_STATIC_FILE_NAME),
+        _static_control_plane_config,
+        _static_worker_config,
+        sort_keys=True
+    )
 
 
 @task(talosctl_gen_config)
-def talos_apply_config_patches(ctx):
+def talos_apply_config_patches(ctx, jobs=None):
     """
     Produces [secrets_dir]/[cluster_name]/((controlplane)|(worker))-capi.yaml
     as a talos cli compatible configuration files, to be used in benchmark deployment.
-    Validate configuration files with talosctl validate
+    Configs are patched in-process (tasks.talos_patch), validated with talosctl validate
     Prepend #!talos as per
     https://www.talos.dev/v1.3/talos-guides/install/bare-metal-platforms/equinix-metal/#passing-in-the-configuration-as-user-data
+    Patch -> validate chains of every role and cluster run concurrently (up to --jobs), each cluster's static
+    manifest is built as soon as both of its configs are validated.
     """
+    build_state = get_build_state()
+    digests = dict()
+    patches = dict()
+    talos_configs = dict()
+    steps = list()
     for cluster_spec in get_constellation_clusters():
-        _talos_apply_config_patch(ctx, cluster_spec)
+        config_dir_name = os.path.join(get_secrets_dir(), cluster_spec.name)
+        targets = _get_talos_config_targets(cluster_spec)
+        digest = inputs_digest(
+            'talos-apply-config-patch',
+            'in-process',
+            file_content(os.path.join(config_dir_name, _CLUSTER_MANIFEST_FILE_NAME)),
+            file_content(os.path.join(config_dir_name, 'controlplane.yaml')),
+            file_content(os.path.join(config_dir_name, 'worker.yaml')),
+            tool_version(ctx, 'talosctl version --client')
+        )
+        if build_state.is_up_to_date(targets, digest):
+            print("Up to date, skipping: {}".format(", ".join(targets)))
+            continue
+
+        build_state.forget(targets)
+        digests[cluster_spec.name] = digest
+        patches[cluster_spec.name] = _read_talos_config_patches(cluster_spec)
+        talos_configs[cluster_spec.name] = dict()
+        for role in _TALOS_ROLES:
+            steps.append((cluster_spec, 'patch-' + role, []))
+            steps.append((cluster_spec, 'validate-' + role, ['patch-' + role]))
+        steps.append((cluster_spec, 'static-manifest', ['validate-' + role for role in _TALOS_ROLES]))
+
+    def _run_step(job_ctx, step):
+        cluster_spec, step_name, _ = step
+        action, _, role = step_name.partition('-')
+        if action == 'patch':
+            talos_configs[cluster_spec.name][role] = _talos_patch_machineconfig(
+                cluster_spec, role, patches[cluster_spec.name][role])
+        elif action == 'validate':
+            _talos_validate_machineconfig(job_ctx, cluster_spec, role)
+        else:
+            _build_static_cluster_manifest(cluster_spec, talos_configs[cluster_spec.name])
+            build_state.record(_get_talos_config_targets(cluster_spec), digests[cluster_spec.name])
+
+    run_graph(
+        ctx,
+        _run_step,
+        steps,
+        lambda step: ["{}/{}".format(step[0].name, dependency) for dependency in step[2]],
+        label=lambda step: "{}/{}".format(step[0].name, step[1]),
+        jobs=jobs,
+        title='step')
 
 
 @task(use_kind_cluster_context)
@@ -222,24 +391,17 @@ def get_cluster_secrets(ctx, talosconfig='talosconfig', cluster_name=None):
         ))
         return
 
-    device_list_file_name = os.path.join(
-        get_secrets_dir(),
-        "device-list.yaml"
-    )
-
-    ctx.run("metal device get -o yaml > {}".format(device_list_file_name))
     ip_addresses = dict()
     role_control_plane = 'control-plane'
     role_worker = 'worker'
-    with open(device_list_file_name, 'r') as device_list_file:
-        for element in yaml.safe_load(device_list_file):
-            if cluster_name in element['hostname']:
-                for ip_address in element['ip_addresses']:
-                    if ip_address['address_family'] == 4 and ip_address['public'] is True:
-                        if role_control_plane in element['hostname']:
-                            ip_addresses[ip_address['address']] = role_control_plane
-                        else:
-                            ip_addresses[ip_address['address']] = role_worker
+    for element in get_metal_api().get_devices():
+        if cluster_name in element['hostname']:
+            for ip_address in element['ip_addresses']:
+                if ip_address['address_family'] == 4 and ip_address['public'] is True:
+                    if role_control_plane in element['hostname']:
+                        ip_addresses[ip_address['address']] = role_control_plane
+                    else:
+                        ip_addresses[ip_address['address']] = role_worker
 
     if len(ip_addresses) == 0:
         print("No devices found for cluster {}, setup failed.".format(cluster_name))
@@ -247,7 +409,7 @@ def get_cluster_secrets(ctx, talosconfig='talosconfig', cluster_name=None):
 
     cluster_config_dir = os.path.join(get_secrets_dir(), cluster_name)
     with open(os.path.join(cluster_config_dir, talosconfig), 'r') as talos_config_file:
-        talos_config_data = yaml.safe_load(talos_config_file)
+        talos_config_data = safe_load(talos_config_file)
         talos_config_data['contexts'][cluster_name]['nodes'] = list()
         talos_config_data['contexts'][cluster_name]['endpoints'] = list()
 
@@ -259,8 +421,7 @@ def get_cluster_secrets(ctx, talosconfig='talosconfig', cluster_name=None):
             talos_config_data['contexts'][cluster_name]['endpoints'].append(key)
             control_plane_node = key
 
-    with open(os.path.join(cluster_config_dir, talosconfig), 'w') as talos_config_file:
-        yaml.dump(talos_config_data, talos_config_file)
+    write_yaml_artifact(os.path.join(cluster_config_dir, talosconfig), talos_config_data)
 
     if control_plane_node is None:
         print('Could not produce ' + os.path.join(cluster_config_dir, cluster_name + ".kubeconfig"))
@@ -365,6 +526,15 @@ def build_manifests(ctx):
     """
 
 
+@task(use_kind_cluster_context, generate_cpem_config, register_vips,
+      clusterctl_generate_cluster, talos_apply_config_patches)
+def build_manifests_incremental(ctx):
+    """
+    Produces cluster manifests without cleaning up first, steps whose inputs did not change since the last build
+    (as recorded in [secrets_dir]/build-state.json) are skipped.
+    """
+
+
 @task(use_kind_cluster_context)
 def apply_bary_manifest(ctx, cluster_manifest_static_file_name=_CLUSTER_MANIFEST_STATIC_FILE_NAME):
     """
@@ -1,17 +1,30 @@
+from __future__ import annotations
+
 import glob
 import json
 import os
+import threading
+from typing import TYPE_CHECKING
 
-import ipcalc
-import yaml
 from invoke import task
+from invoke.exceptions import Exit
+
+from tasks.artifacts import write_yaml_artifact
+from tasks.build_state import build_step, file_content
+from tasks.helpers import get_secrets_dir, \
+    get_cpem_config, get_cfg, get_constellation_clusters, get_constellation, register_secret
+from tasks.metal_api import get_metal_api
+from tasks.parallel import for_each_cluster
+from tasks.vips import vip_addresses_from_reservation
+from tasks.yaml_io import safe_load
 
-from tasks.constellation_v01 import Cluster, VipRole, VipType
-from tasks.helpers import str_presenter, get_secrets_dir, \
-    get_cpem_config, get_cfg, get_constellation_clusters, get_constellation
+if TYPE_CHECKING:
+    from tasks.constellation_v01 import Cluster, VipRole, VipType
 
-yaml.add_representer(str, str_presenter)
-yaml.representer.SafeRepresenter.add_representer(str, str_presenter)  # to use with safe_dump
+# Satellites share a single global_ipv4, clusters registering VIPs in parallel must not race to request it.
+_global_vip_lock = threading.Lock()
+# IP reservations as fetched by get_project_ips
+_project_ips = None
 
 
 @task()
@@ -20,27 +33,28 @@ def generate_cpem_config(ctx, cpem_config_file_name="cpem/cpem.yaml"):
     Produces [secrets_dir]/cpem/cpem.yaml - 'Cloud Provider for Equinix Metal' config spec
     """
     cpem_config = get_cpem_config()
-    ctx.run("mkdir -p {}".format(
-        os.path.join(
-            get_secrets_dir(),
-            'cpem'
-        )
-    ), echo=True)
+    cpem_config_file_name = os.path.join(get_secrets_dir(), cpem_config_file_name)
 
-    command = "kubectl create -o yaml \
-    --dry-run='client' secret generic -n kube-system metal-cloud-config \
-    --from-literal='cloud-sa.json={}'"
+    def _generate_cpem_config():
+        ctx.run("mkdir -p {}".format(
+            os.path.dirname(cpem_config_file_name)
+        ), echo=True)
 
-    print(command.format('[REDACTED]'))
-    k8s_secret = ctx.run(command.format(
-        json.dumps(cpem_config)
-    ), hide='stdout', echo=False)
+        command = "kubectl create -o yaml \
+        --dry-run='client' secret generic -n kube-system metal-cloud-config \
+        --from-literal='cloud-sa.json={}'"
 
-    yaml_k8s_secret = yaml.safe_load(k8s_secret.stdout)
-    del yaml_k8s_secret['metadata']['creationTimestamp']
+        print(command.format('[REDACTED]'))
+        k8s_secret = ctx.run(command.format(
+            register_secret('CPEM_CONFIG', json.dumps(cpem_config))
+        ), hide='stdout', echo=False)
 
-    with open(os.path.join(get_secrets_dir(), cpem_config_file_name), 'w') as cpem_config_file:
-        yaml.dump(yaml_k8s_secret, cpem_config_file)
+        yaml_k8s_secret = safe_load(k8s_secret.stdout)
+        del yaml_k8s_secret['metadata']['creationTimestamp']
+
+        write_yaml_artifact(cpem_config_file_name, yaml_k8s_secret)
+
+    build_step([cpem_config_file_name], ['cpem-config', cpem_config], _generate_cpem_config)
 
 
 @task()
@@ -63,20 +77,44 @@ def get_project_ips(ctx, project_ips_file_name=None):
     """
 
     project_ips_file_name = get_cfg(project_ips_file_name, ctx.equinix_metal.project_ips_file_name)
-    ctx.run("metal ip get -o yaml > {}".format(project_ips_file_name), echo=True)
+    project_ips = get_metal_api().get_project_ips()
+    write_yaml_artifact(project_ips_file_name, project_ips)
+    global _project_ips
+    _project_ips = project_ips
+    return project_ips
+
+
+def load_project_ips(ctx, project_ips_file_name=None):
+    """
+    IP reservations fetched by get_project_ips in this process, or read from project_ips_file_name if given.
+    """
+    if project_ips_file_name is None and _project_ips is not None:
+        return _project_ips
+    project_ips_file_name = get_cfg(project_ips_file_name, ctx.equinix_metal.project_ips_file_name)
+    with open(project_ips_file_name, 'r') as project_ips_file:
+        return safe_load(project_ips_file)
 
 
-def _render_ip_addresses_file(ip_reservation, addresses, ip_addresses_file_name):
-    for address in ipcalc.Network('{}/{}'.format(ip_reservation['address'], ip_reservation['cidr'])):
-        addresses.append(str(address))
-    with open(ip_addresses_file_name, 'w') as ip_addresses_file:
-        yaml.dump(addresses, ip_addresses_file)
+def save_ip_reservation(ip_reservation, ip_reservations_file_name):
+    write_yaml_artifact(ip_reservations_file_name, ip_reservation)
+
+
+def _render_ip_addresses_file(ip_reservation, ip_addresses_file_name):
+    write_yaml_artifact(ip_addresses_file_name, vip_addresses_from_reservation(ip_reservation).to_record())
 
 
 def render_ip_addresses_file(ip_reservations_file_name, ip_addresses_file_name):
-    addresses = list()
     with open(ip_reservations_file_name, 'r') as ip_reservations_file:
-        _render_ip_addresses_file(yaml.safe_load(ip_reservations_file), addresses, ip_addresses_file_name)
+        _render_ip_addresses_file(safe_load(ip_reservations_file), ip_addresses_file_name)
+
+
+def _save_and_render_ip_reservation(ip_reservation, ip_reservations_file_name, ip_addresses_file_name):
+    save_ip_reservation(ip_reservation, ip_reservations_file_name)
+    build_step(
+        [ip_addresses_file_name],
+        ['vip-addresses', file_content(ip_reservations_file_name)],
+        lambda: _render_ip_addresses_file(ip_reservation, ip_addresses_file_name)
+    )
 
 
 def get_ip_addresses_file_name(cluster_spec: Cluster, address_role):
@@ -95,55 +133,89 @@ def get_ip_reservation_file_name(cluster_spec: Cluster, address_role):
     )
 
 
-def register_global_vip(ctx, cluster: Cluster, cp_tags, ip_reservations_file_name):
+class ProjectIpIndex:
+    """
+    Project IP reservations indexed by (first tag, metro code, global flag), first reservation in API order wins.
+    Global reservations are indexed without a metro, they match clusters in any metro.
+    """
+
+    def __init__(self, project_ips):
+        self._index = dict()
+        for position, ip_spec in enumerate(project_ips or list()):
+            tags = ip_spec.get('tags') or list()
+            if len(tags) == 0:
+                continue
+            if ip_spec['global_ip']:
+                key = (tags[0], None, True)
+            elif 'metro' in ip_spec:
+                key = (tags[0], ip_spec['metro']['code'], False)
+            else:
+                continue
+            self._index.setdefault(key, (position, ip_spec))
+
+    def lookup(self, tag, metro):
+        candidates = [
+            candidate for candidate in (self._index.get((tag, None, True)), self._index.get((tag, metro, False)))
+            if candidate is not None
+        ]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda candidate: candidate[0])[1]
+
+
+class GlobalReservationIndex:
+    """
+    global_ipv4 reservations per VIP role and cluster, as found in [secrets_dir]/[cluster]/ip-[role]-reservation.yaml
+    when the index was built, plus any requested since. Not thread safe, guard with _global_vip_lock.
+    """
+
+    def __init__(self, secrets_dir):
+        self._reservations = dict()
+        for ip_reservation_file_name in glob.glob(os.path.join(secrets_dir, '*', 'ip-*-reservation.yaml')):
+            with open(ip_reservation_file_name) as ip_reservation_file:
+                ip_reservation = safe_load(ip_reservation_file)
+            if ip_reservation is not None and ip_reservation.get('type') == 'global_ipv4':
+                cluster_name = os.path.basename(os.path.dirname(ip_reservation_file_name))
+                role = os.path.basename(ip_reservation_file_name)[len('ip-'):-len('-reservation.yaml')]
+                self.add(role, cluster_name, ip_reservation)
+
+    def add(self, role, cluster_name, ip_reservation):
+        self._reservations.setdefault("{}".format(role), dict())[cluster_name] = ip_reservation
+
+    def lookup_other(self, role, cluster_name):
+        for other_cluster_name, ip_reservation in self._reservations.get("{}".format(role), dict()).items():
+            if other_cluster_name != cluster_name:
+                return ip_reservation
+        return None
+
+
+def register_global_vip(ctx, cluster: Cluster, cp_tags, address_role, global_reservations: GlobalReservationIndex):
     """
     We want to ensure that only one global_ipv4 is registered for all satellites. Following behaviour should not
     affect the management cluster (bary).
+    Returns the IP reservation to be used by the cluster.
     """
+    with _global_vip_lock:
+        return _register_global_vip(ctx, cluster, cp_tags, address_role, global_reservations)
+
+
+def _register_global_vip(ctx, cluster: Cluster, cp_tags, address_role, global_reservations: GlobalReservationIndex):
     constellation = get_constellation()
     if cluster.name != constellation.bary.name:
-        existing_ip_reservation_file_names = glob.glob(
-            os.path.join(
-                get_secrets_dir(),
-                '**',
-                os.path.basename(ip_reservations_file_name)
-            ),
-            recursive=True)
-        for existing_ip_reservation_file_name in existing_ip_reservation_file_names:
-            if cluster.name not in existing_ip_reservation_file_name:
-                with open(existing_ip_reservation_file_name) as existing_ip_reservation_file:
-                    existing_ip_reservation = yaml.safe_load(existing_ip_reservation_file)
-                    if existing_ip_reservation['type'] == 'global_ipv4':
-                        print('Global IP reservation file already exists. Copying config for satellite: '
-                              + cluster.name)
-                        ctx.run('cp {} {}'.format(
-                            existing_ip_reservation_file_name,
-                            ip_reservations_file_name
-                        ), echo=True)
-                        return
-
-    # Todo: There is a bug in Metal CLI that prevents us from using the CLI in this case.
-    #       Thankfully API endpoint works.
-    #       https://deploy.equinix.com/developers/docs/metal/networking/global-anycast-ips/
-    payload = {
-        "type": "global_ipv4",
-        "quantity": 1,
-        "fail_on_approval_required": "false",
-        "tags": cp_tags
-    }
-    ctx.run("curl -s -X POST "
-            "-H 'Content-Type: application/json' "
-            "-H \"X-Auth-Token: {}\" "
-            "\"https://api.equinix.com/metal/v1/projects/{}/ips\" "
-            "-d '{}' | yq e -P - > {}".format(
-                "${METAL_AUTH_TOKEN}",
-                "${METAL_PROJECT_ID}",
-                json.dumps(payload),
-                ip_reservations_file_name
-            ), echo=True)
-
-
-def register_vip(ctx, cluster: Cluster, project_ips_file_name,
+        existing_ip_reservation = global_reservations.lookup_other(address_role, cluster.name)
+        if existing_ip_reservation is not None:
+            print('Global IP reservation already exists. Copying config for satellite: ' + cluster.name)
+            return existing_ip_reservation
+
+    # Metal CLI can not request global IPs, the API endpoint works.
+    # https://deploy.equinix.com/developers/docs/metal/networking/global-anycast-ips/
+    print("Requesting global_ipv4 for: " + cluster.name)
+    ip_reservation = get_metal_api().request_ips('global_ipv4', 1, cp_tags)
+    global_reservations.add(address_role, cluster.name, ip_reservation)
+    return ip_reservation
+
+
+def register_vip(ctx, cluster: Cluster, project_ip_index: ProjectIpIndex, global_reservations: GlobalReservationIndex,
                  address_role: VipRole, address_type: VipType, address_count: int):
     cluster_metro = cluster.metro
 
@@ -158,49 +230,48 @@ def register_vip(ctx, cluster: Cluster, project_ips_file_name,
         cp_tags = ["gocy:vip:{}".format(address_role.name), "gocy:cluster:{}".format(cluster.name)]
 
     if os.path.isfile(ip_reservations_file_name):
-        render_ip_addresses_file(ip_reservations_file_name, ip_addresses_file_name)
+        build_step(
+            [ip_addresses_file_name],
+            ['vip-addresses', file_content(ip_reservations_file_name)],
+            lambda: render_ip_addresses_file(ip_reservations_file_name, ip_addresses_file_name)
+        )
         return
 
-    with open(project_ips_file_name, 'r') as all_ips_file:
-        no_reservations = False
-        addresses = list()
-        # ToDo: OMG FIX or DELETE ME!
-        for ip_spec in yaml.safe_load(all_ips_file):
-            if (ip_spec['global_ip'] or ('metro' in ip_spec and ip_spec['metro']['code'] == cluster_metro))\
-                    and 'tags' in ip_spec and len(ip_spec.get('tags')) > 0 and ip_spec.get('tags')[0] == cp_tags[0]:
-                _render_ip_addresses_file(ip_spec, addresses, ip_addresses_file_name)
-                no_reservations = False
-                break
-            else:
-                no_reservations = True
-
-        if no_reservations:
-            if address_type == 'public_ipv4':
-                ctx.run("metal ip request --type {} --quantity {} --metro {} --tags '{}' -o yaml > {}".format(
-                    address_type,
-                    address_count,
-                    cluster_metro,
-                    ",".join(cp_tags),
-                    ip_reservations_file_name
-                ), echo=True)
-            elif address_type == 'global_ipv4':
-                register_global_vip(ctx, cluster, cp_tags, ip_reservations_file_name)
-            else:
-                print("Unsupported address_type: " + address_type)
+    ip_spec = project_ip_index.lookup(cp_tags[0], cluster_metro)
+    if ip_spec is not None:
+        build_step(
+            [ip_addresses_file_name],
+            ['vip-addresses', ip_spec],
+            lambda: _render_ip_addresses_file(ip_spec, ip_addresses_file_name)
+        )
+        return
+
+    if address_type == 'public_ipv4':
+        print("Requesting {} x {} in {} for: {}".format(address_count, address_type, cluster_metro, cluster.name))
+        ip_reservation = get_metal_api().request_ips(address_type, address_count, cp_tags, cluster_metro)
+    elif address_type == 'global_ipv4':
+        ip_reservation = register_global_vip(ctx, cluster, cp_tags, address_role, global_reservations)
+    else:
+        print("Unsupported address_type: " + address_type)
+        return
 
-            render_ip_addresses_file(ip_reservations_file_name, ip_addresses_file_name)
+    _save_and_render_ip_reservation(ip_reservation, ip_reservations_file_name, ip_addresses_file_name)
 
 
 @task(get_project_ips, create_config_dirs)
-def register_vips(ctx, project_ips_file_name=None):
+def register_vips(ctx, project_ips_file_name=None, jobs=None):
     """
     Registers VIPs as per constellation spec in invoke.yaml
     """
-    project_ips_file_name = get_cfg(project_ips_file_name, ctx.equinix_metal.project_ips_file_name)
-    constellation_spec = get_constellation_clusters()
-    for cluster_spec in constellation_spec:
+    project_ip_index = ProjectIpIndex(load_project_ips(ctx, project_ips_file_name))
+    global_reservations = GlobalReservationIndex(get_secrets_dir())
+
+    def _register_vips(job_ctx, cluster_spec):
         for vip in cluster_spec.vips:
-            register_vip(ctx, cluster_spec, project_ips_file_name, vip.role, vip.vipType, vip.count)
+            register_vip(job_ctx, cluster_spec, project_ip_index, global_reservations,
+                         vip.role, vip.vipType, vip.count)
+
+    for_each_cluster(ctx, _register_vips, jobs)
 
 
 @task()
@@ -211,40 +282,60 @@ def list_facilities(ctx):
     ctx.run('metal facilities get', echo=True)
 
 
-@task()
-def check_capacity(ctx):
+def get_capacity_demand(constellations):
     """
-    Check device capacity for clusters specified in invoke.yaml
+    Total node count per (metro, plan) over all clusters of the given constellations.
     """
     nodes_total = dict()
-    constellation = get_constellation()
-    bary_metro = constellation.bary.metro
-    nodes_total[bary_metro] = dict()
-    bary_nodes = constellation.bary.control_nodes
-    bary_nodes.extend(constellation.bary.worker_nodes)
-
-    for node in bary_nodes:
-        if node.plan not in nodes_total[bary_metro]:
-            nodes_total[bary_metro][node.plan] = node.count
-        else:
-            nodes_total[bary_metro][node.plan] = nodes_total[bary_metro][node.plan] + node.count
-
-    for satellite in constellation.satellites:
-        if satellite.metro not in nodes_total:
-            nodes_total[satellite.metro] = dict()
-
-        satellite_nodes = satellite.worker_nodes
-        satellite_nodes.extend(satellite.control_nodes)
-        for node in satellite_nodes:
-            if node.plan not in nodes_total[satellite.metro]:
-                nodes_total[satellite.metro][node.plan] = node.count
-            else:
-                nodes_total[satellite.metro][node.plan] = nodes_total[satellite.metro][node.plan] + node.count
+    for constellation in constellations:
+        for cluster in [constellation.bary] + constellation.satellites:
+            for node in cluster.control_nodes + cluster.worker_nodes:
+                key = (cluster.metro, node.plan)
+                nodes_total[key] = nodes_total.get(key, 0) + node.count
+    return nodes_total
 
-    for metro in nodes_total:
-        for node_type, count in nodes_total[metro].items():
-            ctx.run("metal capacity check --metros {} --plans {} --quantity {}".format(
-                metro, node_type, count
-            ), echo=True)
+
+def render_capacity_matrix(servers):
+    """
+    metro x plan table, each cell shows requested quantity and whether it is available.
+    """
+    from tabulate import tabulate
+
+    plans = sorted(set(server['plan'] for server in servers))
+    metros = sorted(set(server['metro'] for server in servers))
+    cells = {(server['metro'], server['plan']): server for server in servers}
+    table = [['metro'] + plans]
+    for metro in metros:
+        row = [metro]
+        for plan in plans:
+            server = cells.get((metro, plan))
+            if server is None:
+                row.append('')
+            else:
+                row.append("{} {}".format(server['quantity'], 'ok' if server['available'] else 'FAILED'))
+        table.append(row)
+    return tabulate(table, headers='firstrow')
 
 
+@task(iterable=['constellation'])
+def check_capacity(ctx, constellation=None):
+    """
+    Check device capacity for clusters specified in the constellation spec, -c can be repeated to check the
+    combined demand of several constellations. All metros and plans are checked in one API call.
+    """
+    if not constellation:
+        constellations = [get_constellation()]
+    else:
+        constellations = [get_constellation(name) for name in constellation]
+
+    servers = [
+        {'metro': metro, 'plan': plan, 'quantity': quantity}
+        for (metro, plan), quantity in get_capacity_demand(constellations).items()
+    ]
+    servers = get_metal_api().check_capacity(servers)
+    print(render_capacity_matrix(servers))
+    if not all(server['available'] for server in servers):
+        raise Exit("Not enough capacity for: {}".format(", ".join(
+            "{}/{}".format(server['metro'], server['plan']) for server in servers if not server['available'])),
+            code=1)
+    return servers
@@ -1,14 +1,12 @@
 import glob
 import os
 
-import yaml
 from invoke import task
-from pydantic import ValidationError
-from tabulate import tabulate
 
-from tasks.constellation_v01 import Constellation
+from tasks.artifacts import write_artifact
 from tasks.helpers import get_config_dir, get_secrets_file_name, available_constellation_specs, \
-    get_constellation_context_file_name, get_ccontext
+    get_constellation_context_file_name, get_ccontext, clear_cache
+from tasks.yaml_io import safe_load
 
 
 @task()
@@ -42,7 +40,7 @@ def secret_source(ctx):
     """
     source = []
     with open(get_secrets_file_name()) as secrets_file:
-        secrets = dict(yaml.safe_load(secrets_file))
+        secrets = dict(safe_load(secrets_file))
         for name, value in secrets['env'].items():
             source.append('export {}={}'.format(name, value))
 
@@ -54,14 +52,17 @@ def ccontext_set(ctx, ccontext: str):
     """
     Set default Constellation Context by {.name} as specified in ~/[GOCY_DIR]/*.constellation.yaml
     """
+    from pydantic import ValidationError
+    from tasks.constellation_v01 import Constellation
+
     written = False
     for available_constellation in available_constellation_specs():
         try:
             constellation = Constellation.parse_raw(available_constellation.read())
             if constellation.name == ccontext:
-                with open(get_constellation_context_file_name(), 'w') as cc_file:
-                    cc_file.write(ccontext)
-                    written = True
+                write_artifact(get_constellation_context_file_name(), ccontext)
+                written = True
+                clear_cache()
         except ValidationError:
             pass
 
@@ -84,6 +85,10 @@ def list_constellations(ctx):
     """
     List available constellation config specs from ~/[GOCY_DIR]/*.constellation.yaml
     """
+    from pydantic import ValidationError
+    from tabulate import tabulate
+    from tasks.constellation_v01 import Constellation
+
     table = [['file', 'valid', 'name', 'version', 'ccontext']]
     ccontext = get_ccontext()
     for available_constellation in available_constellation_specs():
@@ -0,0 +1,119 @@
+import glob
+import os
+import shutil
+import tempfile
+
+from tasks.artifacts import artifact_lock, artifact_path
+from tasks.build_state import file_content, inputs_digest, tool_version
+from tasks.helpers import get_config_dir
+
+
+def get_helm_cache_dir():
+    return os.path.join(get_config_dir(), 'cache', 'helm')
+
+
+def chart_digest(chart_directory):
+    """
+    Digest over the chart's own files: Chart.yaml/Chart.lock, values and templates. Fetched dependency
+    archives (charts/) are excluded, they are determined by Chart.lock.
+    """
+    inputs = list()
+    for root, directories, file_names in os.walk(chart_directory):
+        if root == chart_directory and 'charts' in directories:
+            directories.remove('charts')
+        directories.sort()
+        for file_name in sorted(file_names):
+            path = os.path.join(root, file_name)
+            inputs.append(os.path.relpath(path, chart_directory))
+            inputs.append(file_content(path))
+    return inputs_digest(*inputs)
+
+
+def _dependencies_key(chart_directory):
+    return inputs_digest(
+        file_content(os.path.join(chart_directory, 'Chart.yaml')),
+        file_content(os.path.join(chart_directory, 'Chart.lock')))
+
+
+def _archives(directory):
+    return sorted(glob.glob(os.path.join(directory, '*.tgz')))
+
+
+def _replace_directory(source_directory, target_directory):
+    """
+    Moves a fully populated temporary directory into place, concurrent builds race for it harmlessly.
+    """
+    try:
+        os.replace(source_directory, target_directory)
+    except OSError:
+        # target exists (another build got there first) and is not empty
+        shutil.rmtree(source_directory, ignore_errors=True)
+
+
+def ensure_helm_dependencies(ctx, chart_directory):
+    """
+    Puts the chart's dependency archives in place, from the local cache keyed by Chart.yaml and Chart.lock.
+    Only a cache miss runs 'helm dependency build' (network), which then fills the cache. Concurrent installs of
+    the chart, e.g. into several clusters, take turns.
+    """
+    with artifact_lock(os.path.join(chart_directory, 'charts')):
+        _ensure_helm_dependencies(ctx, chart_directory)
+
+
+def _ensure_helm_dependencies(ctx, chart_directory):
+    cache_directory = os.path.join(get_helm_cache_dir(), 'dependencies', _dependencies_key(chart_directory))
+    charts_directory = os.path.join(chart_directory, 'charts')
+    cached_archives = _archives(cache_directory)
+    if len(cached_archives) > 0:
+        os.makedirs(charts_directory, exist_ok=True)
+        for archive in cached_archives:
+            target = os.path.join(charts_directory, os.path.basename(archive))
+            if file_content(target) != file_content(archive):
+                shutil.copyfile(archive, target)
+        print("Helm dependencies of {} from cache".format(chart_directory))
+        return
+
+    with ctx.cd(chart_directory):
+        if os.path.isfile(os.path.join(chart_directory, 'Chart.lock')):
+            ctx.run("helm dependency build", echo=True)
+        else:
+            ctx.run("helm dependency update", echo=True)
+
+    archives = _archives(charts_directory)
+    if len(archives) == 0:
+        return
+    os.makedirs(os.path.dirname(cache_directory), exist_ok=True)
+    tmp_directory = tempfile.mkdtemp(dir=os.path.dirname(cache_directory))
+    for archive in archives:
+        shutil.copyfile(archive, os.path.join(tmp_directory, os.path.basename(archive)))
+    _replace_directory(tmp_directory, cache_directory)
+
+
+def render_chart(ctx, chart_directory, release_name, namespace, set_values=None):
+    """
+    'helm template' output of the chart, served from the local cache when the chart files, the dependencies and
+    set_values (list of 'key=value', as passed to --set) did not change. Returns the cached manifest file name,
+    treat it as read only.
+    """
+    set_values = list(set_values or list())
+    key = inputs_digest(
+        chart_digest(chart_directory),
+        release_name,
+        namespace,
+        set_values,
+        tool_version(ctx, 'helm version --short'))
+    manifest_file_name = os.path.join(get_helm_cache_dir(), 'rendered', key + '.yaml')
+    if os.path.isfile(manifest_file_name):
+        print("Rendered {} from cache".format(chart_directory))
+        return manifest_file_name
+
+    ensure_helm_dependencies(ctx, chart_directory)
+    os.makedirs(os.path.dirname(manifest_file_name), exist_ok=True)
+    with artifact_path(manifest_file_name) as tmp_file_name, ctx.cd(chart_directory):
+        ctx.run("helm template --namespace {} {}{} ./ > {}".format(
+            namespace,
+            "".join("--set {} ".format(set_value) for set_value in set_values),
+            release_name,
+            tmp_file_name
+        ), echo=True)
+    return manifest_file_name
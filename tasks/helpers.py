@@ -1,24 +1,32 @@
+from __future__ import annotations
+
 import base64
 import glob
 import json
 import os
+import threading
+from typing import TYPE_CHECKING
 
-import git
-import yaml
+from tasks.kube_api import get_current_context
+from tasks.vips import load_vip_addresses
+from tasks.yaml_io import safe_load
 
-from tasks.constellation_v01 import Constellation, Cluster
+if TYPE_CHECKING:
+    from tasks.constellation_v01 import Cluster, Constellation
 
 
 CONSTELLATION_FILE_SUFFIX = '.constellation.yaml'
 
-
-def str_presenter(dumper, data):
-    """configures yaml for dumping multiline strings
-    Ref: https://stackoverflow.com/questions/8640959/how-can-i-control-what-scalar-form-pyyaml-uses-for-my-data"""
-    lines = data.splitlines()
-    if len(lines) > 1:  # check for multiline string
-        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
+# Process wide cache of parsed config files: (loader, file name) -> ((mtime, size), value)
+_file_cache = dict()
+_file_cache_lock = threading.Lock()
+# Project root per working directory, see get_project_root
+_project_roots = dict()
+# Secret values handed to tools, name -> value, see register_secret
+_secret_values = dict()
+_secret_values_lock = threading.Lock()
+# Called with {name: value} of the registered secrets whenever one is registered, see add_secret_listener
+_secret_listeners = list()
 
 
 def get_cfg(value, default):
@@ -27,24 +35,97 @@ def get_cfg(value, default):
     return value
 
 
+def _file_signature(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _cached_load(file_name, loader):
+    """
+    Returns loader(file_name), re-using the previous result for as long as the file's mtime and size do not change.
+    Values are shared between callers, treat them as read only.
+    """
+    key = (loader, file_name)
+    signature = _file_signature(file_name)
+    with _file_cache_lock:
+        entry = _file_cache.get(key)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+
+    value = loader(file_name)
+    with _file_cache_lock:
+        _file_cache[key] = (signature, value)
+    return value
+
+
+def clear_cache():
+    """
+    Drops all memoized config files, next access re-reads them from disk.
+    """
+    with _file_cache_lock:
+        _file_cache.clear()
+
+
 def get_cluster_spec(ctx, name):
-    for cluster_spec in get_constellation_clusters():
-        if cluster_spec.name == name:
-            return cluster_spec
+    return _get_constellation_index(get_ccontext())['clusters_by_name'].get(name)
 
 
 def get_cluster_spec_from_context(ctx) -> Cluster:
-    context = ctx.run("kubectl config current-context", hide='stdout', echo=True).stdout
+    context = getattr(ctx, 'kube_context', None) or get_current_context() or ''
     for cluster_spec in get_constellation_clusters():
         if cluster_spec.name in context:
             return cluster_spec
 
-    print("k8s context: '{}' not in constellation".format(context.strip()))
+    print("k8s context: '{}' not in constellation".format(context))
+
+
+def _is_git_dir_file(file_name):
+    """
+    .git file of a linked worktree or submodule: 'gitdir: <path to the actual git directory>'
+    """
+    try:
+        with open(file_name, 'r') as git_file:
+            return git_file.readline().startswith('gitdir:')
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def find_git_work_tree(directory):
+    """
+    Top level directory of the git work tree directory is in, like 'git rev-parse --show-toplevel', found by
+    looking for .git (a directory, or a gitdir file in worktrees and submodules) upwards. None outside of git.
+    """
+    directory = os.path.realpath(directory)
+    while True:
+        git_path = os.path.join(directory, '.git')
+        if os.path.isdir(git_path) or (os.path.isfile(git_path) and _is_git_dir_file(git_path)):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
 
 
 def get_project_root():
-    git_repo = git.Repo(os.getcwd(), search_parent_directories=True)
-    return git_repo.git.rev_parse("--show-toplevel")
+    """
+    TOEM_PROJECT_ROOT if set, otherwise the git work tree of the current directory, memoized per directory. Outside
+    of git, e.g. an exported source tree in CI, the directory holding the tasks package.
+    """
+    project_root = os.environ.get('TOEM_PROJECT_ROOT')
+    if project_root:
+        return project_root
+
+    cwd = os.getcwd()
+    with _file_cache_lock:
+        if cwd in _project_roots:
+            return _project_roots[cwd]
+    project_root = find_git_work_tree(cwd) or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with _file_cache_lock:
+        _project_roots[cwd] = project_root
+    return project_root
 
 
 def get_config_dir(default_config_dir_name=".gocy"):
@@ -64,12 +145,54 @@ def get_secrets_file_name(name='secrets.yaml'):
 
 def get_secrets():
     with open(get_secrets_file_name()) as secrets_file:
-        return dict(yaml.safe_load(secrets_file))['env']
+        return dict(safe_load(secrets_file))['env']
+
+
+def register_secret(name, value):
+    """
+    Records a secret value the tasks hand to tools, and its base64 encoding as name + '_B64', so that traces and
+    cassettes keep them out, see redact_secrets and add_secret_listener. Returns value.
+    """
+    if not value:
+        return value
+    text = value.decode('utf-8') if isinstance(value, bytes) else str(value)
+    with _secret_values_lock:
+        _secret_values[name] = text
+        _secret_values[name + '_B64'] = base64.b64encode(text.encode('utf-8')).decode('ascii')
+        for listener in _secret_listeners:
+            listener(dict(_secret_values))
+    return value
+
+
+def add_secret_listener(listener):
+    """
+    Calls listener({name: value}) with the secrets registered so far, and again whenever another one is registered,
+    before register_secret returns. Listeners run one at a time, they must not register secrets themselves.
+    """
+    with _secret_values_lock:
+        if listener not in _secret_listeners:
+            _secret_listeners.append(listener)
+        listener(dict(_secret_values))
+
+
+def get_secret_values():
+    """
+    {name: value} of the registered secrets
+    """
+    with _secret_values_lock:
+        return dict(_secret_values)
+
+
+def redact_secrets(text, replacement='[REDACTED]'):
+    # longest first, a secret may contain another one, e.g. the CPEM config its API key
+    for value in sorted(get_secret_values().values(), key=len, reverse=True):
+        text = text.replace(value, replacement)
+    return text
 
 
 def get_cpem_config():
     return {
-        'apiKey': os.environ.get('PACKET_API_KEY'),
+        'apiKey': register_secret('PACKET_API_KEY', os.environ.get('PACKET_API_KEY')),
         'projectID': os.environ.get('PROJECT_ID'),
         'eipTag': '',
         'eipHealthCheckUseHostIP': True
@@ -78,7 +201,7 @@ def get_cpem_config():
 
 def get_cpem_config_yaml():
     return base64.b64encode(
-        json.dumps(get_cpem_config()).encode('ascii'))
+        register_secret('CPEM_CONFIG', json.dumps(get_cpem_config())).encode('ascii'))
 
 
 def get_file_content_as_b64(filename):
@@ -86,13 +209,21 @@ def get_file_content_as_b64(filename):
         return base64.b64encode(file.read()).decode('utf-8')
 
 
+def _load_yaml_file(file_name):
+    with open(file_name, 'r') as yaml_file:
+        return safe_load(yaml_file)
+
+
+def _load_vip_addresses_file(file_name):
+    return load_vip_addresses(_load_yaml_file(file_name))
+
+
 def get_vips(cluster_spec, role):
-    with open(os.path.join(
-            get_secrets_dir(),
-            cluster_spec.name,
-            'ip-{}-addresses.yaml'.format(role)
-    ), 'r') as cp_address:
-        return yaml.safe_load(cp_address)
+    return _cached_load(os.path.join(
+        get_secrets_dir(),
+        cluster_spec.name,
+        'ip-{}-addresses.yaml'.format(role)
+    ), _load_vip_addresses_file)
 
 
 def get_cp_vip_address(cluster_spec):
@@ -119,15 +250,19 @@ def get_constellation_context_file_name(name="ccontext"):
     return os.path.join(get_config_dir(), name)
 
 
-def get_ccontext(default_ccontext='jupiter'):
+def _load_ccontext(file_name):
     try:
-        with open(get_constellation_context_file_name()) as cc_file:
-            ccontext = cc_file.read()
-            if ccontext == '':
-                raise OSError
-            return ccontext
+        with open(file_name) as cc_file:
+            return cc_file.read()
     except OSError:
+        return ''
+
+
+def get_ccontext(default_ccontext='jupiter'):
+    ccontext = _cached_load(get_constellation_context_file_name(), _load_ccontext)
+    if ccontext == '':
         return default_ccontext
+    return ccontext
 
 
 def get_secrets_dir():
@@ -137,17 +272,52 @@ def get_secrets_dir():
     )
 
 
+def _load_constellation_index(file_name):
+    # pydantic models are imported on first use, listing and completing tasks does not need them
+    from tasks.constellation_v01 import Constellation
+
+    with open(file_name) as constellation_file:
+        constellation = Constellation.parse_raw(constellation_file.read())
+
+    clusters = list()
+    clusters.append(constellation.bary)
+    clusters.extend(constellation.satellites)
+    return {
+        'constellation': constellation,
+        'clusters': clusters,
+        'clusters_by_name': {cluster.name: cluster for cluster in clusters}
+    }
+
+
+def _get_constellation_index(name):
+    return _cached_load(
+        os.path.join(get_config_dir(), name + CONSTELLATION_FILE_SUFFIX),
+        _load_constellation_index
+    )
+
+
 def get_constellation(name=None) -> Constellation:
+    """
+    Parsed [config_dir]/[name].constellation.yaml, memoized until the file changes. The returned object is shared,
+    do not modify it in place.
+    """
     if name is None:
         name = get_ccontext()
 
-    with open(os.path.join(get_config_dir(), name + CONSTELLATION_FILE_SUFFIX)) as constellation_file:
-        return Constellation.parse_raw(constellation_file.read())
+    return _get_constellation_index(name)['constellation']
 
 
 def get_constellation_clusters() -> list[Cluster]:
-    clusters = list()
-    constellation = get_constellation()
-    clusters.append(constellation.bary)
-    clusters.extend(constellation.satellites)
-    return clusters
+    return list(_get_constellation_index(get_ccontext())['clusters'])
+
+
+def get_cluster_id(cluster_spec: Cluster):
+    """
+    Cilium cluster id, unique within the constellation. We have to count form one:
+    Error: Unable to connect cluster:
+      local cluster has the default name (cluster name: jupiter) and/or ID 0 (cluster ID: 0)
+    """
+    for index, other_cluster_spec in enumerate(get_constellation_clusters()):
+        if other_cluster_spec == cluster_spec:
+            return index + 1
+    return 1
@@ -0,0 +1,189 @@
+import http.client
+import json
+import select
+import ssl
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+# A kept alive connection the server closed in the meantime. Raised while sending, the request did not reach the
+# server. Raised while waiting for the response (RemoteDisconnected), the server may have processed it.
+_STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected)
+
+
+def _is_dropped(sock):
+    # an idle kept alive connection has nothing to read, anything there is the server closing it
+    try:
+        return len(select.select([sock], [], [], 0)[0]) > 0
+    except (OSError, ValueError):
+        return True
+
+
+class HttpError(Exception):
+    def __init__(self, method, url, status, body):
+        super().__init__("{} {} failed with HTTP {}: {}".format(method, url, status, body[:500]))
+        self.method = method
+        self.url = url
+        self.status = status
+        self.body = body
+
+
+class JsonClient:
+    """
+    Minimal JSON over HTTP(S) client built on http.client. Every thread keeps one keep-alive connection to the
+    server, so a session costs a single TCP/TLS handshake per worker. Requests are retried with exponential backoff
+    on connection errors, 429 and 5xx; non-idempotent requests are only retried on 429, which the server did not
+    process, and once on a fresh connection when a re-used one turns out to be closed while sending. A re-used
+    connection the server already closed is replaced before sending.
+    """
+
+    def __init__(self, base_url, headers=None, ssl_context=None, timeout=30, retries=5, backoff=0.5):
+        url = urllib.parse.urlsplit(base_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.headers = {
+            'Accept': 'application/json',
+            'Connection': 'keep-alive'
+        }
+        self.headers.update(headers or dict())
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+        self._connections = list()
+        self._connections_lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.scheme == 'https':
+                connection = http.client.HTTPSConnection(
+                    self.host, self.port, timeout=self.timeout,
+                    context=self.ssl_context or ssl.create_default_context())
+            else:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def reset_connection(self):
+        """
+        Drops the calling thread's connection, e.g. after abandoning a streamed response half way.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            with self._connections_lock:
+                self._connections.remove(connection)
+            self._local.connection = None
+
+    def url(self, path, params=None):
+        if path.startswith(self.base_path + '/'):
+            url = path
+        else:
+            url = self.base_path + path
+        if params:
+            url = "{}{}{}".format(url, '&' if '?' in url else '?', urllib.parse.urlencode(params, doseq=True))
+        return url
+
+    def _delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.getheader('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return float(retry_after)
+        return self.backoff * (2 ** attempt)
+
+    def open(self, method, path, params=None, body=None, headers=None, idempotent=None, read_timeout=None):
+        """
+        Sends the request and returns the http.client.HTTPResponse, unread, for the caller to consume, e.g. as
+        a stream. The response must be read to the end before the thread's connection can be used again.
+        read_timeout replaces the client's timeout while waiting for the response, e.g. for a stream that is
+        quiet for long stretches.
+        """
+        if idempotent is None:
+            idempotent = method in _IDEMPOTENT_METHODS
+        url = self.url(path, params)
+        request_headers = dict(self.headers)
+        request_headers.update(headers or dict())
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            request_headers['Content-Type'] = 'application/json'
+
+        attempt = 0
+        stale_connection_retried = False
+        while True:
+            connection = self._connection()
+            reused = connection.sock is not None
+            if reused and _is_dropped(connection.sock):
+                self.reset_connection()
+                connection = self._connection()
+                reused = False
+            sent = False
+            try:
+                if not reused:
+                    connection.connect()
+                connection.sock.settimeout(self.timeout if read_timeout is None else read_timeout)
+                connection.request(method, url, body=data, headers=request_headers)
+                sent = True
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError) as error:
+                self.reset_connection()
+                if reused and not stale_connection_retried and isinstance(error, _STALE_CONNECTION_ERRORS) and \
+                        (idempotent or not sent):
+                    stale_connection_retried = True
+                    continue
+                if not idempotent or attempt >= self.retries:
+                    raise
+                time.sleep(self._delay(attempt))
+                attempt = attempt + 1
+                continue
+
+            retryable = response.status == 429 or (idempotent and response.status >= 500)
+            if retryable and attempt < self.retries:
+                response.read()
+                time.sleep(self._delay(attempt, response))
+                attempt = attempt + 1
+                continue
+
+            if response.status >= 400:
+                raise HttpError(method, url, response.status, response.read().decode('utf-8', 'replace'))
+            return response
+
+    def request(self, method, path, params=None, body=None, headers=None, idempotent=None):
+        response = self.open(method, path, params, body, headers, idempotent)
+        data = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self.reset_connection()
+        if len(data) == 0:
+            return None
+        return json.loads(data)
+
+    def get(self, path, params=None):
+        return self.request('GET', path, params=params)
+
+    def post(self, path, body, idempotent=None):
+        return self.request('POST', path, body=body, idempotent=idempotent)
+
+    def map(self, fn, items, workers=8):
+        """
+        Applies fn to items concurrently, each worker thread re-using its own connection, results in items order.
+        """
+        items = list(items)
+        if len(items) <= 1 or workers <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+            return list(executor.map(fn, items))
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
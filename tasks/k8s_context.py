@@ -5,6 +5,33 @@ from invoke import task
 from tasks.helpers import get_constellation_clusters, get_constellation
 
 
+def get_cluster_kube_context(cluster_name):
+    if 'kind' in cluster_name:
+        return cluster_name
+    return "admin@" + cluster_name
+
+
+def get_kube_context(ctx):
+    """
+    The kube context a task runs against: set per job by constellation-wide runs, None means kubeconfig's current one.
+    """
+    return getattr(ctx, 'kube_context', None)
+
+
+def kubectl(ctx):
+    kube_context = get_kube_context(ctx)
+    if kube_context is None:
+        return "kubectl"
+    return "kubectl --context {}".format(kube_context)
+
+
+def helm(ctx):
+    kube_context = get_kube_context(ctx)
+    if kube_context is None:
+        return "helm"
+    return "helm --kube-context {}".format(kube_context)
+
+
 def _use_cluster_context(ctx, cluster_data, kind_cluster_name="kind-toem-capi-local"):
 
     if type(cluster_data) is dict:
@@ -24,10 +51,7 @@ def _use_cluster_context(ctx, cluster_data, kind_cluster_name="kind-toem-capi-lo
         pprint('Cluster context unrecognised: {}'.format(cluster_name))
         return
 
-    if 'kind' in cluster_name:
-        ctx.run("kconf use " + cluster_name, echo=True)
-    else:
-        ctx.run("kconf use admin@" + cluster_name, echo=True)
+    ctx.run("kconf use " + get_cluster_kube_context(cluster_name), echo=True)
 
 
 @task()
@@ -0,0 +1,239 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import tempfile
+import threading
+
+from tasks.http_client import HttpError, JsonClient
+from tasks.yaml_io import safe_load
+
+# Parsed kubeconfig files: file name -> ((mtime, size), config), 'kconf use' rewrites the file, so the
+# signature is checked on every access.
+_kubeconfig_cache = dict()
+# One API client per context: context name -> (credentials digest, KubeApi)
+_clients = dict()
+_lock = threading.Lock()
+# How long a watch may stay silent past its timeoutSeconds before the client gives up on the server ending it
+WATCH_READ_TIMEOUT_MARGIN = 30
+
+
+class KubeConfigError(Exception):
+    pass
+
+
+def get_kubeconfig_file_names():
+    kubeconfig = os.environ.get('KUBECONFIG')
+    if kubeconfig:
+        return [file_name for file_name in kubeconfig.split(os.pathsep) if file_name != '']
+    return [os.path.join(os.path.expanduser('~'), '.kube', 'config')]
+
+
+def _load_kubeconfig_file(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        entry = _kubeconfig_cache.get(file_name)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+
+    with open(file_name, 'r') as kubeconfig_file:
+        kubeconfig = safe_load(kubeconfig_file) or dict()
+    with _lock:
+        _kubeconfig_cache[file_name] = (signature, kubeconfig)
+    return kubeconfig
+
+
+def load_kubeconfig():
+    """
+    Merges the files listed in KUBECONFIG the way kubectl does: the first file to define a cluster, user, context
+    or current-context wins.
+    """
+    merged = {'current-context': None, 'clusters': dict(), 'users': dict(), 'contexts': dict()}
+    for file_name in get_kubeconfig_file_names():
+        kubeconfig = _load_kubeconfig_file(file_name)
+        if kubeconfig is None:
+            continue
+        if merged['current-context'] is None:
+            merged['current-context'] = kubeconfig.get('current-context') or None
+        base_dir = os.path.dirname(os.path.abspath(file_name))
+        for section, key in (('clusters', 'cluster'), ('users', 'user'), ('contexts', 'context')):
+            for entry in kubeconfig.get(section) or list():
+                # relative certificate/token paths are relative to the kubeconfig file they appear in
+                merged[section].setdefault(entry['name'], dict(entry.get(key) or dict(), _base_dir=base_dir))
+    return merged
+
+
+def get_current_context():
+    """
+    In-process 'kubectl config current-context', None if there is no kubeconfig or no current context.
+    """
+    return load_kubeconfig()['current-context']
+
+
+def _resolve(entry, key):
+    file_name = entry.get(key)
+    if file_name is None or os.path.isabs(file_name):
+        return file_name
+    return os.path.join(entry['_base_dir'], file_name)
+
+
+def _read_data(entry, key):
+    if entry.get(key + '-data') is not None:
+        return base64.b64decode(entry[key + '-data'])
+    file_name = _resolve(entry, key)
+    if file_name is not None:
+        with open(file_name, 'rb') as data_file:
+            return data_file.read()
+    return None
+
+
+def _ssl_context(cluster, user):
+    ssl_context = ssl.create_default_context()
+    if cluster.get('insecure-skip-tls-verify'):
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    else:
+        ca_data = _read_data(cluster, 'certificate-authority')
+        if ca_data is not None:
+            ssl_context.load_verify_locations(cadata=ca_data.decode('utf-8'))
+
+    cert_data = _read_data(user, 'client-certificate')
+    key_data = _read_data(user, 'client-key')
+    if cert_data is not None and key_data is not None:
+        # ssl only loads client certificates from files, they are removed as soon as they are loaded
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cert_file_name = os.path.join(tmp_dir, 'client.crt')
+            key_file_name = os.path.join(tmp_dir, 'client.key')
+            for file_name, data in ((cert_file_name, cert_data), (key_file_name, key_data)):
+                with open(os.open(file_name, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as data_file:
+                    data_file.write(data)
+            ssl_context.load_cert_chain(cert_file_name, key_file_name)
+    return ssl_context
+
+
+def _headers(user):
+    token = user.get('token')
+    if token is None and user.get('tokenFile') is not None:
+        with open(_resolve(user, 'tokenFile'), 'r') as token_file:
+            token = token_file.read().strip()
+    if token is not None:
+        return {'Authorization': 'Bearer ' + token}
+    if user.get('username') is not None:
+        credentials = "{}:{}".format(user['username'], user.get('password', ''))
+        return {'Authorization': 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')}
+    if user.get('exec') is not None or user.get('auth-provider') is not None:
+        raise KubeConfigError("exec/auth-provider credentials are not supported, use kubectl")
+    return dict()
+
+
+class KubeApi:
+    """
+    Kubernetes API client for one kubeconfig context, over the pooled connections of a JsonClient.
+    """
+
+    def __init__(self, server, ssl_context=None, headers=None, page_size=500, **kwargs):
+        self.page_size = page_size
+        self.client = JsonClient(server, headers=headers, ssl_context=ssl_context, **kwargs)
+
+    def list_collection(self, path, label_selector=None, field_selector=None):
+        """
+        Lists the items of a collection, e.g. /api/v1/nodes, filtered server side, following 'continue' tokens.
+        Returns the items and the collection's resourceVersion, to start a watch from.
+        """
+        params = self._selectors(label_selector, field_selector)
+        params['limit'] = self.page_size
+        items = list()
+        while True:
+            page = self.client.get(path, params)
+            items.extend(page.get('items') or list())
+            metadata = page.get('metadata') or dict()
+            if not metadata.get('continue'):
+                return items, metadata.get('resourceVersion')
+            params['continue'] = metadata['continue']
+
+    def list(self, path, label_selector=None, field_selector=None):
+        return self.list_collection(path, label_selector, field_selector)[0]
+
+    def watch(self, path, resource_version=None, label_selector=None, field_selector=None, timeout_seconds=60):
+        """
+        Streams watch events ({'type': .., 'object': ..}) of a collection as the API server pushes them, until the
+        server ends the watch after timeout_seconds. Quiet stretches without events do not end the watch, a stream
+        still silent WATCH_READ_TIMEOUT_MARGIN seconds after timeout_seconds ends as if the server had ended it,
+        the caller watches again from the last resourceVersion. Raises HttpError(410) when resource_version is too
+        old, the caller should list again. Closing the generator early drops the streaming connection.
+        """
+        params = self._selectors(label_selector, field_selector)
+        params.update({'watch': 1, 'allowWatchBookmarks': 'true', 'timeoutSeconds': timeout_seconds})
+        if resource_version is not None:
+            params['resourceVersion'] = resource_version
+        response = self.client.open('GET', path, params, read_timeout=timeout_seconds + WATCH_READ_TIMEOUT_MARGIN)
+        completed = False
+        try:
+            while True:
+                try:
+                    line = response.readline()
+                except socket.timeout:
+                    return
+                if not line:
+                    completed = True
+                    return
+                event = json.loads(line)
+                if event.get('type') == 'ERROR':
+                    status = event.get('object') or dict()
+                    raise HttpError('WATCH', path, status.get('code', 500), status.get('message', ''))
+                yield event
+        finally:
+            if not completed:
+                self.client.reset_connection()
+
+    @staticmethod
+    def _selectors(label_selector, field_selector):
+        params = dict()
+        if label_selector:
+            params['labelSelector'] = label_selector
+        if field_selector:
+            params['fieldSelector'] = field_selector
+        return params
+
+    def list_nodes(self, label_selector=None, field_selector=None):
+        return self.list('/api/v1/nodes', label_selector, field_selector)
+
+    def list_pods(self, namespace, label_selector=None, field_selector=None):
+        return self.list('/api/v1/namespaces/{}/pods'.format(namespace), label_selector, field_selector)
+
+    def close(self):
+        self.client.close()
+
+
+def get_kube_api(context=None) -> KubeApi:
+    """
+    Shared client for context, current context by default. Re-created only when the context's server or
+    credentials change in kubeconfig.
+    """
+    kubeconfig = load_kubeconfig()
+    if context is None:
+        context = kubeconfig['current-context']
+    if context not in kubeconfig['contexts']:
+        raise KubeConfigError("k8s context: '{}' not found in kubeconfig".format(context))
+    context_spec = kubeconfig['contexts'][context]
+    cluster = kubeconfig['clusters'].get(context_spec.get('cluster'))
+    user = kubeconfig['users'].get(context_spec.get('user'), dict(_base_dir=''))
+    if cluster is None or cluster.get('server') is None:
+        raise KubeConfigError("k8s context: '{}' has no cluster server".format(context))
+
+    digest = hashlib.sha256(repr((sorted(cluster.items()), sorted(user.items()))).encode('utf-8')).hexdigest()
+    with _lock:
+        entry = _clients.get(context)
+        if entry is not None and entry[0] == digest:
+            return entry[1]
+        if entry is not None:
+            entry[1].close()
+        kube_api = KubeApi(cluster['server'], _ssl_context(cluster, user), _headers(user))
+        _clients[context] = (digest, kube_api)
+        return kube_api
@@ -0,0 +1,93 @@
+import os
+import threading
+
+from tasks.http_client import JsonClient
+
+METAL_API_URL = 'https://api.equinix.com/metal/v1'
+
+_metal_api = None
+_metal_api_lock = threading.Lock()
+
+
+class MetalApi:
+    """
+    In-process Equinix Metal API client, replaces 'metal' CLI and curl shell-outs.
+    https://deploy.equinix.com/developers/api/metal/
+    """
+
+    def __init__(self, token, project_id, base_url=METAL_API_URL, per_page=250, workers=8, **kwargs):
+        self.project_id = project_id
+        self.per_page = per_page
+        self.workers = workers
+        self.client = JsonClient(base_url, headers={'X-Auth-Token': token}, **kwargs)
+
+    def paginate(self, path, key, params=None):
+        """
+        Fetches the first page, then all the remaining ones concurrently.
+        """
+        params = dict(params or dict())
+        params['per_page'] = self.per_page
+        first_page = self.client.get(path, dict(params, page=1))
+        items = list(first_page.get(key, list()))
+        last_page = (first_page.get('meta') or dict()).get('last_page') or 1
+        pages = self.client.map(
+            lambda page: self.client.get(path, dict(params, page=page)),
+            range(2, last_page + 1),
+            self.workers
+        )
+        for page in pages:
+            items.extend(page.get(key, list()))
+        return items
+
+    def get_project_ips(self):
+        return self.paginate('/projects/{}/ips'.format(self.project_id), 'ip_addresses')
+
+    def get_devices(self):
+        return self.paginate('/projects/{}/devices'.format(self.project_id), 'devices')
+
+    def request_ips(self, ip_type, quantity, tags, metro=None):
+        """
+        Requests an IP reservation, returns the reservation as 'metal ip request -o yaml' would.
+        """
+        payload = {
+            'type': ip_type,
+            'quantity': quantity,
+            'fail_on_approval_required': False,
+            'tags': tags
+        }
+        if metro is not None:
+            payload['metro'] = metro
+        return self.client.post('/projects/{}/ips'.format(self.project_id), payload)
+
+    def check_capacity(self, servers, batch_size=100):
+        """
+        servers: list of {'metro': .., 'plan': .., 'quantity': ..}, returns the same list with 'available' set.
+        Checked in a single request, or for very large lists, in concurrent batches of batch_size.
+        """
+        batches = [servers[index:index + batch_size] for index in range(0, len(servers), batch_size)]
+        results = list()
+        for batch in self.client.map(
+                lambda batch: self.client.post('/capacity/metros', {'servers': batch}, idempotent=True)['servers'],
+                batches,
+                self.workers):
+            results.extend(batch)
+        return results
+
+    def close(self):
+        self.client.close()
+
+
+def get_metal_api() -> MetalApi:
+    """
+    Process wide client, configured from the same ENVs 'metal' CLI uses: METAL_AUTH_TOKEN, METAL_PROJECT_ID.
+    METAL_API_URL points it at a different server, e.g. a local fake in tests.
+    """
+    global _metal_api
+    with _metal_api_lock:
+        if _metal_api is None:
+            _metal_api = MetalApi(
+                os.environ.get('METAL_AUTH_TOKEN', os.environ.get('PACKET_API_KEY')),
+                os.environ.get('METAL_PROJECT_ID', os.environ.get('PROJECT_ID')),
+                os.environ.get('METAL_API_URL', METAL_API_URL)
+            )
+        return _metal_api
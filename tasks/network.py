@@ -2,15 +2,20 @@ import base64
 import json
 import os
 
-import yaml
 from invoke import task
+from invoke.exceptions import Exit
 
-from tasks.helpers import str_presenter, get_secrets_dir, get_cp_vip_address, \
-    get_cluster_spec_from_context, get_constellation_clusters, get_vips, get_file_content_as_b64, get_constellation
-from tasks.k8s_context import use_bary_cluster_context
-
-yaml.add_representer(str, str_presenter)
-yaml.representer.SafeRepresenter.add_representer(str, str_presenter)  # to use with safe_dum
+from tasks.artifacts import write_json_artifact, write_yaml_artifact
+from tasks.helm_cache import ensure_helm_dependencies, render_chart
+from tasks.helpers import get_secrets_dir, get_cp_vip_address, \
+    get_cluster_spec_from_context, get_constellation_clusters, get_vips, get_file_content_as_b64, get_constellation, \
+    get_cluster_id, get_project_root, register_secret
+from tasks.k8s_context import use_bary_cluster_context, get_kube_context, helm, kubectl
+from tasks.kube_api import get_kube_api
+from tasks.manifests import apply_transforms, read_documents, write_documents, normalise_multiline_whitespace
+from tasks.parallel import JobResult, for_each_cluster, print_report, run_parallel
+from tasks.rollout import wait_for_release
+from tasks.yaml_io import safe_load
 
 
 @task()
@@ -30,11 +35,11 @@ def setup_dockerhub_pull_secret(ctx, namespace="network-services"):
     }
 
     docker_config_file_name = os.path.join(get_secrets_dir(), "docker.config.json")
-    with open(docker_config_file_name, 'w') as docker_config_file:
-        json.dump(docker_config, docker_config_file)
+    write_json_artifact(docker_config_file_name, docker_config)
 
     secret_name = "dockerhub"
-    ctx.run("kubectl -n {} create secret docker-registry --from-file=.dockerconfigjson=\"{}\" {} | true".format(
+    ctx.run("{} -n {} create secret docker-registry --from-file=.dockerconfigjson=\"{}\" {} | true".format(
+        kubectl(ctx),
         namespace,
         docker_config_file_name,
         secret_name
@@ -47,7 +52,8 @@ def setup_dockerhub_pull_secret(ctx, namespace="network-services"):
             }
         ]
     }
-    ctx.run("kubectl patch sa default -n {} -p '{}' | true".format(
+    ctx.run("{} patch sa default -n {} -p '{}' | true".format(
+        kubectl(ctx),
         namespace,
         json.dumps(payload)
     ), echo=True)
@@ -60,9 +66,11 @@ def deploy_network_multitool(ctx, namespace="network-services"):
     """
     chart_directory = os.path.join('apps', 'network-multitool')
     with ctx.cd(chart_directory):
-        ctx.run("helm upgrade --install --wait --namespace {} network-multitool ./".format(
+        ctx.run("{} upgrade --install --namespace {} network-multitool ./".format(
+            helm(ctx),
             namespace
         ), echo=True)
+    wait_for_release('network-multitool', namespace, context=get_kube_context(ctx))
 
 
 @task()
@@ -78,177 +86,221 @@ def apply_kubespan_patch(ctx):
     ), echo=True)
 
 
+def _discover_gateway(ctx, debug_pod, namespace):
+    return ctx.run(
+        "{} -n {} exec {} -- /bin/bash "
+        "-c \"curl -s https://metadata.platformequinix.com/metadata | "
+        "jq -r '.network.addresses[] | "
+        "select(.public == false and .address_family == 4) | .gateway'\"".format(
+            kubectl(ctx),
+            namespace,
+            debug_pod['name'])
+        , echo=True).stdout.strip()
+
+
+def _render_bgp_patch(templates_directory, hostname, gateway):
+    if 'control-plane' in hostname:
+        template_name, patch_index = 'control-plane.pt.yaml', 0
+    elif 'worker' in hostname:
+        template_name, patch_index = 'worker.pt.yaml', 1
+    else:
+        return None
+    with open(os.path.join(templates_directory, template_name), 'r') as talos_patch_file:
+        talos_patch = safe_load(talos_patch_file)
+    for route in talos_patch[patch_index]['value']['routes']:
+        route['gateway'] = gateway
+    return talos_patch
+
+
+def _plan_node_patches(node_patch_data, templates_directory, patches_directory):
+    """
+    Writes the BGP patch of every node. Returns the nodes to patch, and a failed JobResult for every node that
+    can not be patched.
+    """
+    nodes = list()
+    skipped = list()
+    for hostname in node_patch_data:
+        gateway = node_patch_data[hostname]['gateway']
+        if not gateway:
+            skipped.append(JobResult(hostname, error=RuntimeError(
+                "no gateway discovered, node will NOT be patched")))
+            continue
+        talos_patch = _render_bgp_patch(templates_directory, hostname, gateway)
+        if talos_patch is None:
+            skipped.append(JobResult(hostname, error=RuntimeError(
+                'unrecognised node role, should be "control-plane" OR "worker", node will NOT be patched')))
+            continue
+
+        patch_file_name = os.path.join(patches_directory, "{}.yaml".format(hostname))
+        write_yaml_artifact(patch_file_name, talos_patch)
+        nodes.append({
+            'hostname': hostname,
+            'addresses': node_patch_data[hostname]['addresses'],
+            'patch_file_name': patch_file_name
+        })
+    return nodes, skipped
+
+
+def _patch_node(ctx, node, talosconfig_file_name):
+    """
+    Applies the node's patch to every one of its addresses, an address failing does not stop the others.
+    """
+    failed = list()
+    for address in node['addresses']:
+        result = ctx.run("talosctl --talosconfig {} patch mc --nodes {} --patch @{}".format(
+            talosconfig_file_name,
+            address,
+            node['patch_file_name']
+        ), echo=True, warn=True)
+        if not result.ok:
+            failed.append(address)
+    if len(failed) > 0:
+        raise RuntimeError("patch failed for: {}".format(", ".join(failed)))
+    return node['addresses']
+
+
 # @task(deploy_network_multitool, post=[apply_kubespan_patch])
 @task(deploy_network_multitool)
-def hack_fix_bgp_peer_routs(ctx, talosconfig_file_name='talosconfig', namespace='network-services'):
+def hack_fix_bgp_peer_routs(ctx, talosconfig_file_name='talosconfig', namespace='network-services', jobs=None):
     """
     Adds a static route to the node configuration, so that BGP peers could connect.
     Something like https://github.com/kubernetes-sigs/cluster-api-provider-packet/blob/main/templates/cluster-template-kube-vip.yaml#L195
+    Gateway discovery and node patching run concurrently, up to --jobs at a time (default: core.jobs). Nodes left
+    unpatched, e.g. without a discovered gateway, are reported and make the task exit non-zero.
     """
     cluster_spec = get_cluster_spec_from_context(ctx)
     cluster_cfg_dir = os.path.join(get_secrets_dir(), cluster_spec.name)
 
     with open(os.path.join(cluster_cfg_dir, talosconfig_file_name), 'r') as talosconfig_file:
-        talosconfig = yaml.safe_load(talosconfig_file)
+        talosconfig = safe_load(talosconfig_file)
 
     templates_directory = os.path.join('patch-templates', 'bgp')
     patches_directory = os.path.join(get_secrets_dir(), 'patch', 'bgp')
     ctx.run("mkdir -p " + patches_directory, echo=True)
 
-    with ctx.cd(templates_directory):
-        pods_raw = ctx.run(
-            "kubectl -n {} get pods -o yaml".format(namespace),
-            hide='stdout', echo=True).stdout
-
-        debug_pods = list()
-        for pod in yaml.safe_load(pods_raw)['items']:
-            if 'debug' in pod['metadata']['name']:
-                debug_pods.append({
-                    "name": pod['metadata']['name'],
-                    'node': pod['spec']['nodeName']
-                })
-        if len(debug_pods) == 0:
-            print("This task requires debug pods from 'network.deploy-network-multitool' "
-                  "something went wrong, exiting.")
-            return
-
-        for debug_pod in debug_pods:
-            if 'debug' in debug_pod['name']:
-                debug_pod['gateway'] = ctx.run(
-                    "kubectl -n {} exec {} -- /bin/bash "
-                    "-c \"curl -s https://metadata.platformequinix.com/metadata | "
-                    "jq -r '.network.addresses[] | "
-                    "select(.public == false and .address_family == 4) | .gateway'\"".format(
-                        namespace,
-                        debug_pod['name'])
-                    , echo=True).stdout.strip()
-
-        node_patch_data = dict()
-        for pod in debug_pods:
-            node_patch_data[pod['node']] = dict()
-            node_patch_data[pod['node']]['gateway'] = pod['gateway']
-
-        nodes_raw = ctx.run("kubectl get nodes -o yaml", hide='stdout', echo=True).stdout
-        node_patch_addresses = list()
-        for node in yaml.safe_load(nodes_raw)['items']:
-            node_addresses = node['status']['addresses']
-            node_addresses = list(filter(lambda address: address['type'] == 'ExternalIP', node_addresses))
-            node_addresses = list(map(lambda address: address['address'], node_addresses))
-            node_patch_data[
-                node['metadata']['labels']['kubernetes.io/hostname']]['addresses'] = node_addresses
-            node_patch_addresses.extend(node_addresses)
-
-        cp_vip = get_cp_vip_address(cluster_spec)
-        try:
-            node_patch_addresses.remove(cp_vip)
-        except ValueError:
-            pass
-
-        talosconfig_addresses = talosconfig['contexts'][cluster_spec.name]['nodes']
-        try:
-            talosconfig_addresses.remove(cp_vip)
-        except ValueError:
-            pass
-
-        # from pprint import pprint
-        # print("#### node_patch_data")
-        # pprint(node_patch_addresses)
-        # print("#### talosconfig")
-        # pprint(talosconfig_addresses)
-        # return
-
-        if len(set(node_patch_addresses) - set(talosconfig_addresses)) > 0:
-            print("Node list returned by kubectl is out of sync with your talosconfig! Fix before patching.")
-            return
-
-        for hostname in node_patch_data:
-            patch_name = "{}.yaml".format(hostname)
-            talos_patch = None
-            if 'control-plane' in hostname:
-                with open(os.path.join(
-                        templates_directory,
-                        'control-plane.pt.yaml'), 'r') as talos_cp_patch_file:
-                    talos_patch = yaml.safe_load(talos_cp_patch_file)
-                    for route in talos_patch[0]['value']['routes']:
-                        route['gateway'] = node_patch_data[hostname]['gateway']
-            elif 'worker' in hostname:
-                with open(os.path.join(
-                        templates_directory,
-                        'worker.pt.yaml'), 'r') as talos_cp_patch_file:
-                    talos_patch = yaml.safe_load(talos_cp_patch_file)
-                    for route in talos_patch[1]['value']['routes']:
-                        route['gateway'] = node_patch_data[hostname]['gateway']
-            else:
-                print('Unrecognised node role: {}, should be "control-plane" OR "worker. '
-                      'Node will NOT be patched.'.format(hostname))
-
-            if talos_patch is not None:
-                patch_file_name = os.path.join(patches_directory, patch_name)
-                with open(patch_file_name, 'w') as patch_file:
-                    yaml.safe_dump(talos_patch, patch_file)
-
-                for address in node_patch_data[hostname]['addresses']:
-                    ctx.run("talosctl --talosconfig {} patch mc --nodes {} --patch @{}".format(
-                        os.path.join(
-                            os.environ.get('TOEM_PROJECT_ROOT'),
-                            cluster_cfg_dir,
-                            talosconfig_file_name),
-                        address,
-                        patch_file_name
-                    ), echo=True)
+    kube_api = get_kube_api(get_kube_context(ctx))
+    debug_pods = list()
+    for pod in kube_api.list_pods(namespace, label_selector='name=debug', field_selector='status.phase=Running'):
+        debug_pods.append({
+            "name": pod['metadata']['name'],
+            'node': pod['spec']['nodeName']
+        })
+    if len(debug_pods) == 0:
+        print("This task requires debug pods from 'network.deploy-network-multitool' "
+              "something went wrong, exiting.")
+        return
+
+    gateway_results = run_parallel(
+        ctx,
+        lambda job_ctx, debug_pod: _discover_gateway(job_ctx, debug_pod, namespace),
+        debug_pods,
+        label=lambda debug_pod: debug_pod['node'],
+        jobs=jobs,
+        title='gateway',
+        raise_on_error=False)
+
+    node_patch_data = dict()
+    for pod, result in zip(debug_pods, gateway_results):
+        node_patch_data[pod['node']] = {'gateway': result.value, 'addresses': list()}
+
+    node_patch_addresses = list()
+    for node in kube_api.list_nodes():
+        node_addresses = node['status']['addresses']
+        node_addresses = list(filter(lambda address: address['type'] == 'ExternalIP', node_addresses))
+        node_addresses = list(map(lambda address: address['address'], node_addresses))
+        node_patch_data.setdefault(
+            node['metadata']['labels']['kubernetes.io/hostname'],
+            {'gateway': None})['addresses'] = node_addresses
+        node_patch_addresses.extend(node_addresses)
+
+    cp_vip = get_cp_vip_address(cluster_spec)
+    try:
+        node_patch_addresses.remove(cp_vip)
+    except ValueError:
+        pass
+
+    talosconfig_addresses = talosconfig['contexts'][cluster_spec.name]['nodes']
+    try:
+        talosconfig_addresses.remove(cp_vip)
+    except ValueError:
+        pass
+
+    if len(set(node_patch_addresses) - set(talosconfig_addresses)) > 0:
+        print("Node list returned by kubectl is out of sync with your talosconfig! Fix before patching.")
+        return
+
+    nodes, skipped = _plan_node_patches(node_patch_data, templates_directory, patches_directory)
+    if len(skipped) > 0:
+        print_report(skipped, 'node')
+
+    patch_results = run_parallel(
+        ctx,
+        lambda job_ctx, node: _patch_node(
+            job_ctx,
+            node,
+            os.path.join(get_project_root(), cluster_cfg_dir, talosconfig_file_name)),
+        nodes,
+        label=lambda node: node['hostname'],
+        jobs=jobs,
+        title='node',
+        raise_on_error=False)
+
+    failed = list()
+    for result in gateway_results + skipped + patch_results:
+        if not result.ok and result.label not in failed:
+            failed.append(result.label)
+    if len(failed) > 0:
+        raise Exit("BGP route patch failed for: {}".format(", ".join(failed)), code=1)
+
+
+def get_network_manifest_values(cluster_spec):
+    """
+    helm --set values of the cluster's network manifest. Rendered per cluster: besides these values, the chart
+    generates hubble TLS certificates issued for the cluster name, by a CA of the cluster's own.
+    """
+    return [
+        'cilium.bpf.masquerade=true',
+        'cilium.kubeProxyReplacement=strict',
+        'cilium.k8sServiceHost={}'.format(get_cp_vip_address(cluster_spec)),
+        'cilium.k8sServicePort={}'.format('6443'),
+        'cilium.cluster.name={}'.format(cluster_spec.name),
+        'cilium.cluster.id={}'.format(get_cluster_id(cluster_spec)),
+        'cilium.hubble.peerService.clusterDomain={}.local'.format(cluster_spec.name)
+    ]
+
+
+def get_network_manifest_file_name(cluster_spec, manifest_name='network-services-dependencies'):
+    return os.path.join(get_secrets_dir(), cluster_spec.name, manifest_name + '.yaml')
 
 
 @task()
-def build_network_service_dependencies_manifest(ctx, manifest_name='network-services-dependencies'):
+def build_network_service_dependencies_manifest(ctx, manifest_name='network-services-dependencies', cluster=None,
+                                                jobs=None):
     """
-    Produces [secrets_dir]/network-services-dependencies.yaml - Helm cilium manifest to be used
+    Produces [secrets_dir]/[cluster]/network-services-dependencies.yaml - Helm cilium manifest to be used
     as inlineManifest is Talos machine specification (Helm manifests inline install).
     https://www.talos.dev/v1.4/kubernetes-guides/network/deploying-cilium/#method-4-helm-manifests-inline-install
+    The chart is templated for every cluster in the constellation (or just --cluster), concurrently, renders are
+    served from the helm cache while the chart and the cluster's values do not change.
     """
     chart_directory = os.path.join('apps', manifest_name)
-    manifest_file_name = os.path.join(
-        get_secrets_dir(),
-        manifest_name + '.yaml')
-    with ctx.cd(chart_directory):
-        ctx.run("helm dependencies update", echo=True)
-        ctx.run("helm template --namespace network-services "
-                "--set cilium.bpf.masquerade=true "
-                "--set cilium.kubeProxyReplacement=strict "
-                "--set cilium.k8sServiceHost={} "
-                "--set cilium.k8sServicePort={} "
-                " {} ./ > {}".format(
-                    get_cp_vip_address(),
-                    '6443',
-                    manifest_name,
-                    manifest_file_name
-                ), echo=True)
-
-    # Talos controller chokes on the '\n' in yaml
-    # [talos] controller failed {
-    #       "component": "controller-runtime",
-    #       "controller": "k8s.ExtraManifestController",
-    #       "error": "1 error occurred:\x5cn\x5ct* error updating manifests:
-    #           invalid Yaml document separator: null\x5cn\x5cn"
-    #   }
-    # Helm does not mind those, we need to fix them.
-    manifest = list()
-    with open(manifest_file_name, 'r') as manifest_file:
-        _manifest = list(yaml.safe_load_all(manifest_file))
-
-        for document in _manifest:
-            if document is not None:
-                if 'data' in document:
-                    data_keys = document['data'].keys()
-                    for key in data_keys:
-                        if '\n' in document['data'][key]:
-                            tmp_list = document['data'][key].split('\n')
-                            for index, _ in enumerate(tmp_list):
-                                tmp_list[index] = tmp_list[index].rstrip()
-                            document['data'][key] = "\n".join(tmp_list).strip()
-                manifest.append(document)
-
-    with open(manifest_file_name, 'w') as manifest_file:
-        yaml.safe_dump_all(manifest, manifest_file)
+
+    def _build_network_manifest(job_ctx, cluster_spec):
+        rendered_manifest_file_name = render_chart(
+            job_ctx, chart_directory, manifest_name, 'network-services', get_network_manifest_values(cluster_spec))
+        # Talos controller chokes on trailing whitespace in multiline values
+        changed = list()
+        os.makedirs(os.path.join(get_secrets_dir(), cluster_spec.name), exist_ok=True)
+        write_documents(
+            get_network_manifest_file_name(cluster_spec, manifest_name),
+            apply_transforms(read_documents(rendered_manifest_file_name), normalise_multiline_whitespace(changed)))
+        if len(changed) > 0:
+            print("Normalised whitespace in: {}".format(", ".join(changed)))
+
+    clusters = get_constellation_clusters()
+    if cluster is not None:
+        clusters = [cluster_spec for cluster_spec in clusters if cluster_spec.name == cluster]
+    for_each_cluster(ctx, _build_network_manifest, jobs, clusters=clusters)
 
 
 @task()
@@ -275,23 +327,16 @@ def install_network_service_dependencies(ctx):
     """
     chart_directory = os.path.join('apps', 'network-services-dependencies')
     cluster_spec = get_cluster_spec_from_context(ctx)
-    constellation_spec = get_constellation_clusters()
-
-    # We have to count form one
-    # Error: Unable to connect cluster:
-    #   local cluster has the default name (cluster name: jupiter) and/or ID 0 (cluster ID: 0)
-    cluster_id = 1
-    for index, value in enumerate(constellation_spec):
-        if value == cluster_spec:
-            cluster_id = cluster_id + index
+    cluster_id = get_cluster_id(cluster_spec)
 
     ca_crt = get_file_content_as_b64(os.path.join(ctx.core.ca_dir, 'ca.crt'))
-    ca_key = get_file_content_as_b64(os.path.join(ctx.core.ca_dir, 'ca.key'))
+    ca_key = register_secret(
+        'CLUSTER_MESH_CA_KEY', get_file_content_as_b64(os.path.join(ctx.core.ca_dir, 'ca.key')))
 
+    ensure_helm_dependencies(ctx, chart_directory)
     with ctx.cd(chart_directory):
-        ctx.run("helm dependencies update", echo=True)
-        ctx.run("kubectl apply -f namespace.yaml")
-        ctx.run("helm upgrade --install "
+        ctx.run("{} apply -f namespace.yaml".format(kubectl(ctx)))
+        ctx.run("{} upgrade --install "
                 "--set cilium.k8sServiceHost={} "
                 "--set cilium.k8sServicePort={} "
                 "--set cilium.cluster.name={} "
@@ -300,7 +345,8 @@ def install_network_service_dependencies(ctx):
                 "--set cilium.tls.ca.cert={} "
                 "--set cilium.tls.ca.key={} "
                 "--namespace network-services network-services-dependencies ./".format(
-                    get_cp_vip_address(get_cluster_spec_from_context(ctx)),
+                    helm(ctx),
+                    get_cp_vip_address(cluster_spec),
                     '6443',
                     cluster_spec.name,
                     cluster_id,
@@ -324,7 +370,7 @@ def install_network_service(ctx):
     ingress_vips = get_vips(cluster_spec, 'ingress')
     chart_directory = os.path.join('apps', 'network-services')
     with open(os.path.join(chart_directory, 'values.template.yaml'), 'r') as value_template_file:
-        chart_values = dict(yaml.safe_load(value_template_file))
+        chart_values = dict(safe_load(value_template_file))
         chart_values['metallb']['clusterName'] = cluster_spec.name
         chart_values['metallb']['pools'] = list()
         chart_values['metallb']['pools'].append({
@@ -337,14 +383,14 @@ def install_network_service(ctx):
         })
 
     network_services_values_file_name = os.path.join(
-        os.environ.get('TOEM_PROJECT_ROOT'),
+        get_project_root(),
         cluster_cfg_dir,
         'values.network-services.yaml')
-    with open(network_services_values_file_name, 'w') as value_template_file:
-        yaml.safe_dump(chart_values, value_template_file)
+    write_yaml_artifact(network_services_values_file_name, chart_values)
 
     with ctx.cd(chart_directory):
-        ctx.run("helm upgrade --install --values {} --namespace network-services network-services ./".format(
+        ctx.run("{} upgrade --install --values {} --namespace network-services network-services ./".format(
+            helm(ctx),
             network_services_values_file_name
         ), echo=True)
 
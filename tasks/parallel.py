@@ -0,0 +1,205 @@
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from invoke import Context
+from invoke.exceptions import Exit, UnexpectedExit
+
+from tasks.helpers import get_constellation_clusters
+from tasks.tracing import get_tracer
+
+_print_lock = threading.Lock()
+
+
+class LabelledContext(Context):
+    """
+    Context handed to a single parallel job. Commands run with their output captured, so that concurrent jobs
+    do not interleave on the terminal, the captured output is printed as one labelled block once the job is done.
+    Has its own cwd/prefix stack, so ctx.cd() in one job does not leak into the others.
+    """
+
+    def __init__(self, config, label, kube_context=None):
+        super().__init__(config=config)
+        self._set(label=label, output=list(), kube_context=kube_context)
+
+    def run(self, command, **kwargs):
+        echo = kwargs.pop('echo', False)
+        hide = kwargs.pop('hide', None)
+        if echo:
+            self.output.append('$ ' + command)
+        # Concurrent jobs must not compete for the terminal's stdin
+        kwargs.setdefault('in_stream', False)
+        try:
+            result = super().run(command, hide=True, echo=False, **kwargs)
+        except UnexpectedExit as error:
+            self._collect(error.result, hide)
+            raise
+        self._collect(result, hide)
+        return result
+
+    def _collect(self, result, hide):
+        if hide not in ('out', 'stdout', 'both', True) and result.stdout:
+            self.output.append(result.stdout.rstrip('\n'))
+        if hide not in ('err', 'stderr', 'both', True) and result.stderr:
+            self.output.append(result.stderr.rstrip('\n'))
+
+    def print_output(self):
+        with _print_lock:
+            for chunk in self.output:
+                for line in chunk.splitlines():
+                    print("[{}] {}".format(self.label, line))
+            self.output.clear()
+
+
+class JobResult:
+    def __init__(self, label, value=None, error=None, duration=0.0):
+        self.label = label
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _run_job(ctx, label, fn, item):
+    # Jobs started from within a job keep its kube context and are labelled below it, e.g. [jupiter/cni]
+    if isinstance(ctx, LabelledContext):
+        label = "{}/{}".format(ctx.label, label)
+    job_ctx = LabelledContext(ctx.config, label, getattr(ctx, 'kube_context', None))
+    started = time.monotonic()
+    try:
+        with get_tracer().span(label, 'job', label=label, cluster=job_ctx.kube_context):
+            value = fn(job_ctx, item)
+        error = None
+    except Exception as exc:
+        value = None
+        error = exc
+        if not isinstance(exc, UnexpectedExit):
+            job_ctx.output.append(traceback.format_exc().rstrip('\n'))
+    job_ctx.print_output()
+    return JobResult(label, value, error, time.monotonic() - started)
+
+
+def _describe_error(error):
+    if isinstance(error, UnexpectedExit):
+        return "'{}' exited with {}".format(error.result.command, error.result.exited)
+    return "{}: {}".format(type(error).__name__, error)
+
+
+def print_report(results, title='job'):
+    from tabulate import tabulate
+
+    table = [[title, 'status', 'time [s]', 'error']]
+    for result in results:
+        table.append([
+            result.label,
+            'ok' if result.ok else 'FAILED',
+            '{:.1f}'.format(result.duration),
+            '' if result.ok else _describe_error(result.error)
+        ])
+    print(tabulate(table, headers='firstrow'))
+
+
+def _finish(results, title, report, raise_on_error):
+    failed = [result for result in results if not result.ok]
+    if report and (len(results) > 1 or len(failed) > 0):
+        print_report(results, title)
+    if raise_on_error and len(failed) > 0:
+        raise Exit("{} of {} {}(s) failed: {}".format(
+            len(failed), len(results), title, ", ".join(result.label for result in failed)), code=1)
+    return results
+
+
+def run_parallel(ctx, fn, items, label=str, jobs=None, title='job', report=True, raise_on_error=True):
+    """
+    Runs fn(job_ctx, item) for every item on a bounded worker pool and returns a list of JobResult, in items order.
+    With jobs=1 items run one after another, exactly as a plain for loop would. A failure of one item does not stop
+    the remaining ones, failures are reported per item and, if raise_on_error, turned into a non-zero exit at the end.
+    """
+    items = list(items)
+    if jobs is None:
+        jobs = ctx.core.jobs
+    jobs = max(1, min(int(jobs), len(items) or 1))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(get_tracer().propagate(_run_job), ctx, label(item), fn, item) for item in items]
+        results = [future.result() for future in futures]
+
+    return _finish(results, title, report, raise_on_error)
+
+
+def _check_acyclic(dependencies):
+    """
+    Raises ValueError naming the items on or behind a dependency cycle, label -> labels it depends on.
+    """
+    remaining = dict(dependencies)
+    while len(remaining) > 0:
+        ready = [item_label for item_label, item_dependencies in remaining.items()
+                 if item_dependencies.isdisjoint(remaining)]
+        if len(ready) == 0:
+            raise ValueError("dependency cycle between: {}".format(", ".join(sorted(remaining))))
+        for item_label in ready:
+            del remaining[item_label]
+
+
+def run_graph(ctx, fn, items, depends_on, label=str, jobs=None, title='job', report=True, raise_on_error=True):
+    """
+    Like run_parallel, but an item only starts once every item it depends on succeeded. depends_on(item) returns
+    the labels of those items. Independent items run concurrently, so the whole graph takes as long as its longest
+    chain. Items that depend on a failed item are skipped and reported as failed too. Dependency cycles raise
+    ValueError before anything runs. Results are returned in items order.
+    """
+    items = list(items)
+    labels = [label(item) for item in items]
+    dependencies = dict()
+    for item_label, item in zip(labels, items):
+        dependencies[item_label] = set(depends_on(item))
+        unknown = dependencies[item_label] - set(labels)
+        if len(unknown) > 0:
+            raise ValueError("{} depends on unknown {}(s): {}".format(item_label, title, ", ".join(sorted(unknown))))
+    _check_acyclic(dependencies)
+    if jobs is None:
+        jobs = ctx.core.jobs
+    jobs = max(1, min(int(jobs), len(items) or 1))
+
+    results = dict()
+    pending = dict(zip(labels, items))
+    running = dict()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # a skipped item fails the items depending on it in turn, whatever their order in items
+            skipped = True
+            while skipped:
+                skipped = False
+                for item_label in list(pending):
+                    failed_dependencies = [dependency for dependency in dependencies[item_label]
+                                           if dependency in results and not results[dependency].ok]
+                    if len(failed_dependencies) > 0:
+                        results[item_label] = JobResult(item_label, error=RuntimeError(
+                            "skipped, depends on failed: {}".format(", ".join(sorted(failed_dependencies)))))
+                        del pending[item_label]
+                        skipped = True
+                    elif all(dependency in results for dependency in dependencies[item_label]):
+                        running[executor.submit(get_tracer().propagate(_run_job), ctx, item_label, fn,
+                                                pending.pop(item_label))] = item_label
+            if len(running) == 0:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    results = [results[item_label] for item_label in labels]
+    return _finish(results, title, report, raise_on_error)
+
+
+def for_each_cluster(ctx, fn, jobs=None, clusters=None, **kwargs):
+    """
+    Fans fn(job_ctx, cluster_spec) out over every cluster in the constellation, see run_parallel.
+    """
+    if clusters is None:
+        clusters = get_constellation_clusters()
+    return run_parallel(ctx, fn, clusters, label=lambda cluster_spec: cluster_spec.name, jobs=jobs,
+                        title='cluster', **kwargs)
@@ -0,0 +1,93 @@
+import time
+
+from tasks.http_client import HttpError
+from tasks.kube_api import get_kube_api
+
+# Workload kinds a release is ready with, and the API collection they are listed/watched through
+WORKLOADS = {
+    'Deployment': '/apis/apps/v1/namespaces/{}/deployments',
+    'DaemonSet': '/apis/apps/v1/namespaces/{}/daemonsets',
+    'StatefulSet': '/apis/apps/v1/namespaces/{}/statefulsets'
+}
+HELM_MANAGED_SELECTOR = 'app.kubernetes.io/managed-by=Helm'
+HELM_RELEASE_ANNOTATION = 'meta.helm.sh/release-name'
+
+
+def is_ready(workload):
+    """
+    Same readiness rules as 'helm --wait' / 'kubectl rollout status'.
+    """
+    kind = workload.get('kind')
+    spec = workload.get('spec') or dict()
+    status = workload.get('status') or dict()
+    if status.get('observedGeneration', 0) < workload['metadata'].get('generation', 0):
+        return False
+    if kind == 'Deployment':
+        replicas = spec.get('replicas', 1)
+        return status.get('updatedReplicas', 0) >= replicas and status.get('availableReplicas', 0) >= replicas
+    if kind == 'DaemonSet':
+        desired = status.get('desiredNumberScheduled', 0)
+        return status.get('updatedNumberScheduled', 0) >= desired and status.get('numberAvailable', 0) >= desired
+    if kind == 'StatefulSet':
+        replicas = spec.get('replicas', 1)
+        return status.get('readyReplicas', 0) >= replicas and status.get('updatedReplicas', 0) >= replicas
+    return True
+
+
+def _release_workloads(items, release):
+    workloads = dict()
+    for item in items:
+        if (item['metadata'].get('annotations') or dict()).get(HELM_RELEASE_ANNOTATION) == release:
+            workloads[item['metadata']['name']] = item
+    return workloads
+
+
+def _wait_for_kind(kube_api, kind, release, namespace, deadline):
+    path = WORKLOADS[kind].format(namespace)
+    while True:
+        items, resource_version = kube_api.list_collection(path, label_selector=HELM_MANAGED_SELECTOR)
+        for item in items:
+            item.setdefault('kind', kind)
+        workloads = _release_workloads(items, release)
+        if all(is_ready(workload) for workload in workloads.values()):
+            return list(workloads)
+
+        try:
+            while True:
+                remaining = int(deadline - time.monotonic())
+                if remaining <= 0:
+                    raise TimeoutError("{} {} not ready: {}".format(release, kind, ", ".join(
+                        sorted(name for name, workload in workloads.items() if not is_ready(workload)))))
+                # an ended watch, by the server or after a silent stretch, resumes from the last resourceVersion
+                for event in kube_api.watch(path, resource_version, label_selector=HELM_MANAGED_SELECTOR,
+                                            timeout_seconds=min(remaining, 300)):
+                    workload = event['object']
+                    resource_version = workload['metadata'].get('resourceVersion', resource_version)
+                    if event['type'] == 'BOOKMARK':
+                        continue
+                    workload.setdefault('kind', kind)
+                    name = workload['metadata']['name']
+                    if event['type'] == 'DELETED':
+                        workloads.pop(name, None)
+                    elif _release_workloads([workload], release):
+                        workloads[name] = workload
+                    if all(is_ready(workload) for workload in workloads.values()):
+                        return list(workloads)
+        except HttpError as error:
+            if error.status != 410:
+                raise
+            # resourceVersion expired, list again
+
+
+def wait_for_release(release, namespace, timeout=600, context=None):
+    """
+    Blocks until every Deployment, DaemonSet and StatefulSet of a helm release is rolled out, driven by watch
+    events instead of polling. Replaces 'helm upgrade --wait', without holding the helm process.
+    """
+    kube_api = get_kube_api(context)
+    deadline = time.monotonic() + timeout
+    started = time.monotonic()
+    ready = list()
+    for kind in WORKLOADS:
+        ready.extend(_wait_for_kind(kube_api, kind, release, namespace, deadline))
+    print("Release {} ready after {:.1f}s: {}".format(release, time.monotonic() - started, ", ".join(ready)))
@@ -0,0 +1,175 @@
+import copy
+
+import yaml
+
+from tasks.yaml_io import Dumper, safe_dump, safe_load, str_presenter
+
+TALOS_HASHBANG = "#!talos\n"
+# Plain scalars starting with one of these would not read back as the same string
+_YAML_INDICATORS = tuple('-?:,[]{}#&*!|>\'"%@`')
+
+
+class TalosPatchError(Exception):
+    pass
+
+
+def _is_plain(dumper, data):
+    return data != '' and data == data.strip() and '\n' not in data and ': ' not in data and ' #' not in data and \
+        not data.startswith(_YAML_INDICATORS) and \
+        dumper.resolve(yaml.ScalarNode, data, (True, False)) == 'tag:yaml.org,2002:str'
+
+
+def talos_str_presenter(dumper, data):
+    """
+    Quotes strings the way talosctl (go-yaml) does, in double quotes: key: "" rather than PyYAML's key: ''
+    """
+    if len(data.splitlines()) > 1 or _is_plain(dumper, data):
+        return str_presenter(dumper, data)
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='"')
+
+
+class TalosDumper(Dumper):
+    pass
+
+
+TalosDumper.add_representer(str, talos_str_presenter)
+
+
+def _pointer_tokens(path):
+    """
+    RFC 6901 JSON pointer to its reference tokens: '/machine/network/interfaces/0' -> ['machine', ...].
+    """
+    if path == '':
+        return []
+    if not path.startswith('/'):
+        raise TalosPatchError("invalid JSON pointer: {}".format(path))
+    return [token.replace('~1', '/').replace('~0', '~') for token in path[1:].split('/')]
+
+
+def _list_index(container, token, path, allow_end=False):
+    if token == '-' and allow_end:
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise TalosPatchError("invalid list index '{}' in: {}".format(token, path))
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise TalosPatchError("list index out of range in: {}".format(path))
+    return index
+
+
+def _parent(document, path):
+    tokens = _pointer_tokens(path)
+    if len(tokens) == 0:
+        raise TalosPatchError("can not patch the document root: {}".format(path))
+    container = document
+    for token in tokens[:-1]:
+        if isinstance(container, dict):
+            if token not in container:
+                raise TalosPatchError("missing path: {}".format(path))
+            container = container[token]
+        elif isinstance(container, list):
+            container = container[_list_index(container, token, path)]
+        else:
+            raise TalosPatchError("missing path: {}".format(path))
+    if not isinstance(container, (dict, list)):
+        raise TalosPatchError("missing path: {}".format(path))
+    return container, tokens[-1]
+
+
+def _get(document, path):
+    container, token = _parent(document, path)
+    if isinstance(container, dict):
+        if token not in container:
+            raise TalosPatchError("missing path: {}".format(path))
+        return container[token]
+    return container[_list_index(container, token, path)]
+
+
+def _add(document, path, value):
+    container, token = _parent(document, path)
+    if isinstance(container, dict):
+        container[token] = value
+    else:
+        container.insert(_list_index(container, token, path, allow_end=True), value)
+
+
+def _remove(document, path):
+    container, token = _parent(document, path)
+    if isinstance(container, dict):
+        if token not in container:
+            raise TalosPatchError("missing path: {}".format(path))
+        return container.pop(token)
+    return container.pop(_list_index(container, token, path))
+
+
+def apply_json_patch(document, operations):
+    """
+    Applies RFC 6902 operations (add, remove, replace, move, copy, test) in order, returns the patched copy.
+    The input document is left untouched.
+    """
+    document = copy.deepcopy(document)
+    for operation in operations:
+        op = operation.get('op')
+        path = operation.get('path')
+        if op == 'add':
+            _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            _remove(document, path)
+        elif op == 'replace':
+            _remove(document, path)
+            _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            _add(document, path, _remove(document, operation['from']))
+        elif op == 'copy':
+            _add(document, path, copy.deepcopy(_get(document, operation['from'])))
+        elif op == 'test':
+            if _get(document, path) != operation['value']:
+                raise TalosPatchError("test failed: {}".format(path))
+        else:
+            raise TalosPatchError("unsupported patch operation: {}".format(op))
+    return document
+
+
+def merge_patch(document, patch):
+    """
+    Talos style strategic merge of a partial config into document: maps are merged key by key, lists are
+    appended to, anything else is replaced. Returns the merged copy.
+    """
+    if isinstance(document, dict) and isinstance(patch, dict):
+        merged = dict(document)
+        for key, value in patch.items():
+            merged[key] = merge_patch(document[key], value) if key in document else copy.deepcopy(value)
+        return merged
+    if isinstance(document, list) and isinstance(patch, list):
+        return copy.deepcopy(document) + copy.deepcopy(patch)
+    return copy.deepcopy(patch)
+
+
+def is_json_patch(patches):
+    return isinstance(patches, list) and all(isinstance(patch, dict) and 'op' in patch for patch in patches)
+
+
+def apply_config_patches(config, patches):
+    """
+    Patches a machine config the way 'talosctl machineconfig patch' does: patches is either a list of JSON 6902
+    operations, as found in CAPI configPatches, or a list of partial configs merged in order.
+    """
+    if is_json_patch(patches):
+        return apply_json_patch(config, patches)
+    for patch in patches:
+        config = merge_patch(config, patch)
+    return config
+
+
+def render_talos_config(config):
+    """
+    Machine config as user data, prefixed with #!talos, see
+    https://www.talos.dev/v1.3/talos-guides/install/bare-metal-platforms/equinix-metal/#passing-in-the-configuration-as-user-data
+    """
+    return TALOS_HASHBANG + safe_dump(config, dumper=TalosDumper)
+
+
+def patch_talos_config_file(config_file_name, patches):
+    with open(config_file_name, 'r') as config_file:
+        config = safe_load(config_file)
+    return render_talos_config(apply_config_patches(config, patches))
@@ -0,0 +1,320 @@
+"""
+Timed spans of invoke tasks, parallel jobs and ctx.run commands, exported as Chrome trace JSON (chrome://tracing,
+https://ui.perfetto.dev), with a critical path summary printed at the end of the run.
+
+Enabled by TOEM_TRACE=<trace file name>, e.g. TOEM_TRACE=build.trace.json invoke cluster.build-manifests
+"""
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+from invoke import Call, Executor, Local, Task
+from invoke.exceptions import UnexpectedExit
+
+from tasks.helpers import redact_secrets
+
+TRACE_ENV = 'TOEM_TRACE'
+
+
+class Span:
+    def __init__(self, name, category, parent=None, **args):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.args = {key: value for key, value in args.items() if value is not None}
+        self.children = list()
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+        # Span of a task opened before its pre-tasks ran, the task's own body runs inside it
+        self.umbrella = False
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class Tracer:
+    """
+    Collects spans, nested per thread. Spans of parallel jobs are children of the span that started them, see
+    propagate.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.root = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Task -> tasks it was expanded as a pre-task of, outermost first (see _expand_calls)
+        self.task_owners = dict()
+
+    def enable(self, name='invoke'):
+        self.enabled = True
+        self.root = Span(name, 'invoke')
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else self.root
+
+    def open(self, name, category, parent=None, **args):
+        parent = parent or self.current()
+        span = Span(name, category, parent, **args)
+        with self._lock:
+            parent.children.append(span)
+        self._stack().append(span)
+        return span
+
+    def close(self, span):
+        stack = self._stack()
+        if span not in stack:
+            span.end = time.perf_counter()
+            return
+        while stack:
+            closed = stack.pop()
+            closed.end = time.perf_counter()
+            if closed is span:
+                return
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        if not self.enabled:
+            yield None
+            return
+        span = self.open(name, category, **args)
+        try:
+            yield span
+        finally:
+            self.close(span)
+
+    def propagate(self, fn):
+        """
+        fn, run in another thread, with its spans nested below the span current at the time of this call
+        """
+        if not self.enabled:
+            return fn
+        parent = self.current()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            stack = self._stack()
+            stack.append(parent)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stack.remove(parent)
+        return wrapper
+
+    def task_span(self, task, ctx):
+        """
+        Span of a task's body. A task the executor runs at the top level is nested below the tasks it was a
+        pre-task of, their spans start with their first pre-task.
+        """
+        current = self.current()
+        if current is self.root or current.umbrella:
+            for owner in self.task_owners.get(task, ()):
+                if not any(span.umbrella and span.args.get('task') == owner.name for span in self._stack()):
+                    self.open(owner.name, 'task', task=owner.name).umbrella = True
+            for span in self._stack():
+                if span.umbrella and span.args.get('task') == task.name:
+                    return span
+        return self.open(task.name, 'task', task=task.name, cluster=_cluster(ctx))
+
+    def finish(self):
+        end = time.perf_counter()
+        for span in self.spans():
+            if span.end is None:
+                span.end = end
+
+    def spans(self):
+        pending = [self.root]
+        while pending:
+            span = pending.pop()
+            yield span
+            pending.extend(span.children)
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    return _tracer
+
+
+def is_enabled():
+    return bool(os.environ.get(TRACE_ENV))
+
+
+def _cluster(ctx):
+    return getattr(ctx, 'kube_context', None) or os.environ.get('CLUSTER_NAME')
+
+
+def _command_name(command):
+    # 'cd <dir> && <command>' as put together by ctx.cd()
+    return command.split('&&')[-1].split()[0] if command.strip() else command
+
+
+def trace_task(task):
+    """
+    Wraps the body of task in a span, invoke still sees the original signature.
+    """
+    body = task.body
+    if getattr(body, 'traced', False):
+        return task
+
+    @functools.wraps(body)
+    def traced(*args, **kwargs):
+        tracer = get_tracer()
+        if not tracer.enabled:
+            return body(*args, **kwargs)
+        span = tracer.task_span(task, args[0] if args else None)
+        try:
+            return body(*args, **kwargs)
+        except BaseException as error:
+            span.args['error'] = type(error).__name__
+            raise
+        finally:
+            tracer.close(span)
+
+    traced.traced = True
+    task.body = traced
+    return task
+
+
+class TracingLocal(Local):
+    """
+    Runner timing every ctx.run in a span: command, cluster and exit code. Registered secrets are redacted from the
+    command, see helpers.register_secret.
+    """
+
+    def run(self, command, **kwargs):
+        tracer = get_tracer()
+        with tracer.span(_command_name(command), 'run', command=redact_secrets(command), cluster=_cluster(self.context),
+                         label=getattr(self.context, 'label', None)) as span:
+            try:
+                result = super().run(command, **kwargs)
+            except UnexpectedExit as error:
+                if span is not None:
+                    span.args['exit_code'] = error.result.exited
+                raise
+            if span is not None and hasattr(result, 'exited'):
+                span.args['exit_code'] = result.exited
+            return result
+
+
+def _expand_calls(self, calls, owners=()):
+    """
+    Executor.expand_calls, recording which tasks every pre-task was pulled in by, see Tracer.task_span.
+    """
+    expanded = list()
+    for call in calls:
+        if isinstance(call, Task):
+            call = Call(task=call)
+        expanded.extend(self.expand_calls(call.pre, owners + (call.task,)))
+        expanded.append(call)
+        get_tracer().task_owners.setdefault(call.task, owners)
+        expanded.extend(self.expand_calls(call.post, owners))
+    return expanded
+
+
+def critical_path(span):
+    """
+    Spans the end of span waits on: walking back from its end, the child finishing last, then the child
+    finishing last before that one started, and so on, down to leaf spans.
+    """
+    path = list()
+    cursor = span.end
+    for child in sorted(span.children, key=lambda child: child.end, reverse=True):
+        if child.end <= cursor:
+            path.append(child)
+            cursor = child.start
+    leaves = list()
+    for child in reversed(path):
+        leaves.extend(critical_path(child) if child.children else [child])
+    return leaves
+
+
+def chrome_trace(tracer):
+    """
+    Chrome trace event format: complete ('X') events in microseconds, one track per thread.
+    """
+    threads = dict()
+    events = list()
+    origin = tracer.root.start
+    for span in tracer.spans():
+        tid = threads.setdefault(span.thread, len(threads) + 1)
+        events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': round((span.start - origin) * 1e6, 1),
+            'dur': round(span.duration * 1e6, 1),
+            'pid': 1,
+            'tid': tid,
+            'args': span.args
+        })
+    for thread, tid in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                       'args': {'name': 'main' if tid == 1 else 'worker-{}'.format(tid - 1)}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def print_critical_path(tracer):
+    from tabulate import tabulate
+
+    total = tracer.root.duration
+    table = [['span', 'kind', 'cluster', 'time [s]', 'share']]
+    for span in critical_path(tracer.root):
+        table.append([
+            span.args.get('command', span.name)[:80],
+            span.category,
+            span.args.get('label', span.args.get('cluster', '')),
+            '{:.2f}'.format(span.duration),
+            '{:.0%}'.format(span.duration / total if total else 0)
+        ])
+    print("Critical path of {:.2f}s:".format(total))
+    print(tabulate(table, headers='firstrow'))
+
+
+def export(tracer, file_name):
+    if not tracer.root.children:
+        # nothing ran, e.g. invoke --list
+        return
+    tracer.finish()
+    # commands may still carry secrets that were never registered, keep the trace to its owner
+    trace_fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(file_name, 0o600)
+    with os.fdopen(trace_fd, 'w') as trace_file:
+        json.dump(chrome_trace(tracer), trace_file)
+    print_critical_path(tracer)
+    print("Trace written to: {}".format(file_name))
+
+
+def instrument(collection, trace_file_name):
+    """
+    Traces every task of collection and the commands they run, the trace is exported to trace_file_name when the
+    process exits.
+    Pre-task nesting needs invoke's Executor.expand_calls, which is patched on the class for the rest of the
+    process: invoke's Program reads tasks.executor_class before any collection configuration is loaded, so an
+    Executor subclass could only be set in invoke.yaml, an env var or a flag, not by the collection.
+    """
+    tracer = get_tracer()
+    if not tracer.enabled:
+        tracer.enable()
+        Executor.expand_calls = _expand_calls
+        atexit.register(export, tracer, trace_file_name)
+    pending = [collection]
+    while pending:
+        current = pending.pop()
+        for task in current.tasks.values():
+            trace_task(task)
+        pending.extend(current.collections.values())
+    collection.configure({'runners': {'local': TracingLocal}})
@@ -0,0 +1,55 @@
+import ipaddress
+from collections.abc import Sequence
+
+
+class VipAddresses(Sequence):
+    """
+    Usable addresses of a VIP reservation, computed on access instead of being listed one by one.
+    Matches what ipcalc.Network iteration used to render: network and broadcast addresses are left out,
+    except for /31, /32 (/127, /128) where every address is usable. IPv6 addresses are exploded.
+    """
+
+    def __init__(self, network, prefix):
+        self.network = ipaddress.ip_network('{}/{}'.format(network, prefix), strict=False)
+        if self.network.max_prefixlen - self.network.prefixlen < 2:
+            self._first = 0
+            self.size = self.network.num_addresses
+        else:
+            self._first = 1
+            self.size = self.network.num_addresses - 2
+
+    def __len__(self):
+        # len() is capped at sys.maxsize, use size for IPv6 blocks like /56
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index = index + self.size
+        if index < 0 or index >= self.size:
+            raise IndexError('VIP address index out of range')
+        return (self.network.network_address + self._first + index).exploded
+
+    def __repr__(self):
+        return 'VipAddresses({})'.format(self.network)
+
+    def to_record(self):
+        return {
+            'network': str(self.network.network_address),
+            'prefix': self.network.prefixlen
+        }
+
+
+def vip_addresses_from_reservation(ip_reservation):
+    return VipAddresses(ip_reservation['address'], ip_reservation['cidr'])
+
+
+def load_vip_addresses(data):
+    """
+    Accepts both formats of ip-<role>-addresses.yaml: the compact {network, prefix} record,
+    or the plain list of addresses older versions rendered.
+    """
+    if isinstance(data, dict):
+        return VipAddresses(data['network'], data['prefix'])
+    return tuple(data or list())
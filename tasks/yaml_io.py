@@ -0,0 +1,47 @@
+import yaml
+
+# Project wide YAML I/O, backed by libyaml when PyYAML was built with it.
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader, SafeDumper
+
+
+def str_presenter(dumper, data):
+    """configures yaml for dumping multiline strings
+    Ref: https://stackoverflow.com/questions/8640959/how-can-i-control-what-scalar-form-pyyaml-uses-for-my-data"""
+    lines = data.splitlines()
+    if len(lines) > 1:  # check for multiline string
+        return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data)
+
+
+class Dumper(SafeDumper):
+    pass
+
+
+class PurePythonDumper(yaml.SafeDumper):
+    pass
+
+
+PurePythonLoader = yaml.SafeLoader
+
+
+Dumper.add_representer(str, str_presenter)
+PurePythonDumper.add_representer(str, str_presenter)
+
+
+def safe_load(stream, loader=SafeLoader):
+    return yaml.load(stream, Loader=loader)
+
+
+def safe_load_all(stream, loader=SafeLoader):
+    return yaml.load_all(stream, Loader=loader)
+
+
+def safe_dump(data, stream=None, dumper=Dumper, **kwargs):
+    return yaml.dump(data, stream, Dumper=dumper, **kwargs)
+
+
+def safe_dump_all(documents, stream=None, dumper=Dumper, **kwargs):
+    return yaml.dump_all(documents, stream, Dumper=dumper, **kwargs)
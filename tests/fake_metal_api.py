@@ -0,0 +1,128 @@
+import json
+import socket
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeMetalApi:
+    """
+    Local stand-in for the Equinix Metal API, serves paginated devices/ips, IP requests and capacity checks.
+    'failures' makes the next N requests answer with HTTP 429, 'drop_connections' closes every connection after its
+    response without telling the client, as servers do with idle keep-alive connections, and releases 'dropped' for
+    each. 'lost_responses' makes the
+    next N requests close their connection instead of answering, after they were processed.
+    """
+
+    def __init__(self, token='token', devices=None, ips=None, per_page_limit=2):
+        self.token = token
+        self.devices = devices or list()
+        self.ips = ips or list()
+        self.per_page_limit = per_page_limit
+        self.capacity = dict()
+        self.failures = 0
+        self.drop_connections = False
+        self.dropped = threading.Semaphore(0)
+        self.lost_responses = 0
+        self.requests = list()
+        self.connections = set()
+        self._lock = threading.RLock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/metal/v1'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _page(self, items, key, query):
+        per_page = min(int(query.get('per_page', ['10'])[0]), self.per_page_limit)
+        page = int(query.get('page', ['1'])[0])
+        last_page = max(1, (len(items) + per_page - 1) // per_page)
+        return {
+            key: items[(page - 1) * per_page:page * per_page],
+            'meta': {'current_page': page, 'last_page': last_page, 'total': len(items)}
+        }
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=None):
+                with api._lock:
+                    if api.lost_responses > 0:
+                        api.lost_responses = api.lost_responses - 1
+                        self.close_connection = True
+                        return
+                data = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if status == 429:
+                    self.send_header('Retry-After', '0')
+                self.end_headers()
+                self.wfile.write(data)
+                if api.drop_connections:
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_WR)
+                    api.dropped.release()
+
+            def _handle(self, method):
+                url = urllib.parse.urlsplit(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length)) if length > 0 else None
+                with api._lock:
+                    api.requests.append((method, url.path, body))
+                    api.connections.add(self.client_address)
+                    if api.failures > 0:
+                        api.failures = api.failures - 1
+                        return self._send(429, {'errors': ['slow down']})
+
+                if self.headers.get('X-Auth-Token') != api.token:
+                    return self._send(401, {'errors': ['unauthorized']})
+
+                path = url.path[len('/metal/v1'):]
+                if method == 'GET' and path.endswith('/devices'):
+                    return self._send(200, api._page(api.devices, 'devices', query))
+                if method == 'GET' and path.endswith('/ips'):
+                    return self._send(200, api._page(api.ips, 'ip_addresses', query))
+                if method == 'POST' and path.endswith('/ips'):
+                    reservation = {
+                        'address': '10.0.0.{}'.format(len(api.ips) + 1),
+                        'cidr': 32,
+                        'type': body['type'],
+                        'global_ip': body['type'] == 'global_ipv4',
+                        'tags': body['tags']
+                    }
+                    if 'metro' in body:
+                        reservation['metro'] = {'code': body['metro']}
+                    api.ips.append(reservation)
+                    return self._send(201, reservation)
+                if method == 'POST' and path == '/capacity/metros':
+                    servers = list()
+                    for server in body['servers']:
+                        available = api.capacity.get((server['metro'], server['plan']), 0) >= server['quantity']
+                        servers.append(dict(server, available=available))
+                    return self._send(200, {'servers': servers})
+                return self._send(404, {'errors': ['not found']})
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+        return Handler
@@ -0,0 +1,50 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from invoke import Config, Context
+
+from tasks import apps
+from tasks.apps import get_app_stack_steps, install_all, APP_STACK
+from tasks.k8s_context import helm, kubectl
+
+
+def test_app_stack_steps_include_dependencies():
+    assert get_app_stack_steps() == list(APP_STACK)
+    assert get_app_stack_steps(['dns-and-tls']) == [
+        'ca', 'network-services-dependencies', 'dns-tls-namespace', 'dns-management-token',
+        'dns-and-tls-dependencies', 'dns-and-tls']
+    assert get_app_stack_steps(['ingress-bundle', 'ca'], only=True) == ['ca', 'ingress-bundle']
+
+
+def test_commands_target_explicit_kube_context():
+    ctx = Context()
+    assert kubectl(ctx) == 'kubectl'
+    ctx._set(kube_context='admin@ganymede')
+    assert kubectl(ctx) == 'kubectl --context admin@ganymede'
+    assert helm(ctx) == 'helm --kube-context admin@ganymede'
+
+
+def test_all_clusters_share_the_jobs_budget(monkeypatch):
+    lock = threading.Lock()
+    running = list()
+    seen = {'most_running': 0, 'step_jobs': set()}
+
+    def step(ctx):
+        with lock:
+            running.append(ctx.kube_context)
+            seen['most_running'] = max(seen['most_running'], len(running))
+            seen['step_jobs'].add(ctx.core.jobs)
+        time.sleep(0.1)
+        with lock:
+            running.remove(ctx.kube_context)
+
+    monkeypatch.setattr(apps, 'APP_STACK', {name: (step, []) for name in ('a', 'b', 'c', 'd')})
+    monkeypatch.setattr(apps, 'get_constellation_clusters', lambda: [
+        SimpleNamespace(name=name) for name in ('jupiter', 'ganymede', 'callisto')])
+    ctx = Context(config=Config(overrides={'core': {'jobs': 8}, 'run': {'in_stream': False}}))
+
+    install_all(ctx, all_clusters=True, jobs=6)
+    assert seen['most_running'] <= 6
+    assert seen['step_jobs'] == {2}
+    assert ctx.core.jobs == 8
@@ -0,0 +1,65 @@
+import os
+import threading
+
+import pytest
+
+from tasks.artifacts import artifact_path, open_artifact, write_artifact, write_yaml_artifact
+
+
+def test_unchanged_artifact_is_not_rewritten(tmp_path):
+    file_name = str(tmp_path / 'ip-cp-addresses.yaml')
+    assert write_yaml_artifact(file_name, {'network': '10.0.0.0', 'prefix': 30})
+    os.utime(file_name, ns=(0, 0))
+    assert not write_yaml_artifact(file_name, {'network': '10.0.0.0', 'prefix': 30})
+    assert os.stat(file_name).st_mtime_ns == 0
+    assert write_yaml_artifact(file_name, {'network': '10.0.0.0', 'prefix': 31})
+    with open(file_name) as artifact_file:
+        assert artifact_file.read() == 'network: 10.0.0.0\nprefix: 31\n'
+    assert os.listdir(tmp_path) == ['ip-cp-addresses.yaml']
+
+
+def test_interrupted_write_leaves_artifact_untouched(tmp_path):
+    file_name = str(tmp_path / 'cluster-manifest.yaml')
+    write_artifact(file_name, 'complete\n')
+    with pytest.raises(RuntimeError):
+        with open_artifact(file_name) as artifact_file:
+            artifact_file.write('trunc')
+            raise RuntimeError('interrupted')
+    with pytest.raises(RuntimeError):
+        with artifact_path(file_name) as tmp_file_name:
+            with open(tmp_file_name, 'w') as tmp_file:
+                tmp_file.write('trunc')
+            raise RuntimeError('clusterctl failed')
+    with open(file_name) as artifact_file:
+        assert artifact_file.read() == 'complete\n'
+    assert os.listdir(tmp_path) == ['cluster-manifest.yaml']
+
+
+def test_concurrent_writers_never_interleave(tmp_path):
+    file_name = str(tmp_path / 'build-state.json')
+    contents = ["{}\n".format(str(index) * 100000) for index in range(8)]
+
+    def _write(content):
+        with open_artifact(file_name) as artifact_file:
+            for offset in range(0, len(content), 4096):
+                artifact_file.write(content[offset:offset + 4096])
+
+    threads = [threading.Thread(target=_write, args=(content,)) for content in contents]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(file_name) as artifact_file:
+        assert artifact_file.read() in contents
+
+
+def test_new_artifacts_get_the_umask_default_and_existing_ones_keep_their_mode(tmp_path):
+    umask = os.umask(0o022)
+    os.umask(umask)
+    file_name = str(tmp_path / 'default.yaml')
+    write_artifact(file_name, 'kind: Cluster\n')
+    assert os.stat(file_name).st_mode & 0o777 == 0o666 & ~umask
+
+    os.chmod(file_name, 0o640)
+    write_artifact(file_name, 'kind: Cluster\nmetadata: {}\n')
+    assert os.stat(file_name).st_mode & 0o777 == 0o640
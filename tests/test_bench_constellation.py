@@ -0,0 +1,24 @@
+from benchmarks.bench_constellation import regressions, run_suite
+from benchmarks.synthetic_constellation import synthetic_constellation
+from tasks.constellation_v01 import Constellation
+
+
+def test_synthetic_constellation_is_valid():
+    constellation = Constellation.parse_obj(synthetic_constellation(500))
+    clusters = [constellation.bary] + constellation.satellites
+    assert len(clusters) == 501
+    pod_blocks = [cluster.pod_cidr_blocks[0] for cluster in clusters]
+    service_blocks = [cluster.service_cidr_blocks[0] for cluster in clusters]
+    assert len(set(pod_blocks + service_blocks)) == 2 * len(clusters)
+    assert all(vip.count == 4 for vip in constellation.satellites[-1].vips)
+
+
+def test_suite_reports_every_benchmark_and_size():
+    report = run_suite(sizes=(1, 3), repeat=1)
+    assert {result['benchmark'] for result in report['results']} == set(report['scaling'])
+    assert {(result['satellites'], result['clusters']) for result in report['results']} == {(1, 2), (3, 4)}
+    assert len(report['results']) == 2 * len(report['scaling'])
+
+    baseline = {'results': [dict(result, seconds=result['seconds'] / 10) for result in report['results']]}
+    assert len(regressions(report, baseline, 1.5)) == len(report['results'])
+    assert regressions(report, report, 1.5) == []
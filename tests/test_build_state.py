@@ -0,0 +1,35 @@
+import os
+
+from tasks.build_state import build_step, inputs_digest
+from tasks.helpers import clear_cache, get_secrets_dir
+
+
+def test_build_step_skips_until_inputs_or_output_change(monkeypatch, tmp_path):
+    monkeypatch.setenv('GOCY_DEFAULT_ROOT', str(tmp_path))
+    clear_cache()
+    os.makedirs(get_secrets_dir())
+    target = os.path.join(get_secrets_dir(), 'artifact.yaml')
+    builds = list()
+
+    def build():
+        builds.append(1)
+        with open(target, 'w') as target_file:
+            target_file.write('built')
+
+    assert build_step([target], ['step', b'template', {'a': 1}], build) is True
+    assert build_step([target], ['step', b'template', {'a': 1}], build) is False
+    assert build_step([target], ['step', b'template', {'a': 2}], build) is True
+
+    with open(target, 'w') as target_file:
+        target_file.write('truncat')
+    assert build_step([target], ['step', b'template', {'a': 2}], build) is True
+
+    os.remove(target)
+    assert build_step([target], ['step', b'template', {'a': 2}], build) is True
+    assert len(builds) == 4
+
+
+def test_inputs_digest_is_stable():
+    assert inputs_digest({'a': 1, 'b': [1, 2]}) == inputs_digest({'b': [1, 2], 'a': 1})
+    assert inputs_digest(b'ab', b'c') != inputs_digest(b'a', b'bc')
+    assert inputs_digest(None) != inputs_digest(b'')
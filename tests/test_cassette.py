@@ -0,0 +1,164 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from tasks import helpers
+from tasks.cassette import RECORD, REPLAY, CassetteError, cassette
+
+FAKE_KUBECTL = """#!{python}
+import sys
+import time
+
+time.sleep(0.2)
+if sys.argv[1:] == ['apply', '-f', 'broken.yaml']:
+    sys.stderr.write('error: broken\\n')
+    sys.exit(3)
+if sys.argv[1:] == ['wait']:
+    print('waiting', flush=True)
+    time.sleep(1)
+with open('applied.txt', 'a') as applied_file:
+    applied_file.write(' '.join(sys.argv[1:]) + '\\n')
+print('kubectl ' + ' '.join(sys.argv[1:]))
+"""
+
+FAKE_CLUSTERCTL = """#!{python}
+import base64
+import sys
+
+api_key = sys.argv[sys.argv.index('--api-key') + 1]
+print('kind: Secret')
+print('apiKey: ' + base64.b64encode(api_key.encode()).decode())
+"""
+
+
+@pytest.fixture
+def fake_kubectl(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    kubectl = bin_dir / 'kubectl'
+    kubectl.write_text(FAKE_KUBECTL.format(python=sys.executable))
+    kubectl.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('KUBECONFIG', str(tmp_path / 'project' / 'kubeconfig'))
+    work_dir = tmp_path / 'project' / 'work'
+    work_dir.mkdir(parents=True)
+    monkeypatch.chdir(work_dir)
+    return kubectl
+
+
+def run(command):
+    return subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def test_replays_recorded_calls_without_the_tool(tmp_path, fake_kubectl):
+    cassette_file_name = str(tmp_path / 'test.cassette.jsonl')
+    placeholders = [['TOEM_PROJECT_ROOT', str(tmp_path / 'project')]]
+
+    with cassette(cassette_file_name, RECORD, placeholders=placeholders):
+        recorded = [run("kubectl get nodes"), run("kubectl apply -f broken.yaml"), run("kubectl get nodes")]
+    with open(cassette_file_name, 'r') as cassette_file:
+        recordings = [json.loads(line) for line in cassette_file]
+    assert recordings[0]['cwd'] == '${TOEM_PROJECT_ROOT}/work'
+    assert recordings[0]['env'] == {'KUBECONFIG': '${TOEM_PROJECT_ROOT}/kubeconfig'}
+    assert recordings[0]['files'] == {'applied.txt': 'get nodes\n'}
+    assert recordings[0]['duration'] >= 0.2
+
+    fake_kubectl.unlink()
+    os.remove('applied.txt')
+    with cassette(cassette_file_name, REPLAY, placeholders=placeholders):
+        started = time.perf_counter()
+        replayed = [run("kubectl get nodes"), run("kubectl apply -f broken.yaml"), run("kubectl get nodes")]
+        assert time.perf_counter() - started < 0.6
+        unknown = run("kubectl delete nodes")
+
+    assert [(result.returncode, result.stdout, result.stderr) for result in replayed] == [
+        (result.returncode, result.stdout, result.stderr) for result in recorded]
+    assert replayed[1].returncode == 3
+    with open('applied.txt', 'r') as applied_file:
+        assert applied_file.read() == 'get nodes\nget nodes\n'
+    assert unknown.returncode == 1
+    assert 'no recording of: kubectl delete nodes' in unknown.stderr
+
+
+def test_replays_recorded_latency(tmp_path, fake_kubectl):
+    cassette_file_name = str(tmp_path / 'test.cassette.jsonl')
+    with cassette(cassette_file_name, RECORD, placeholders=[]):
+        run("kubectl version")
+    fake_kubectl.unlink()
+
+    with cassette(cassette_file_name, REPLAY, latency=1.0, placeholders=[]) as session:
+        assert os.environ['PATH'].startswith(session['shims'])
+        started = time.perf_counter()
+        assert run("kubectl version").stdout == 'kubectl version\n'
+        assert time.perf_counter() - started >= 0.2
+    assert session['shims'] not in os.environ['PATH']
+
+    with pytest.raises(CassetteError):
+        with cassette(str(tmp_path / 'missing.cassette.jsonl'), REPLAY):
+            pass
+
+
+def test_secrets_stay_out_of_the_cassette(tmp_path, fake_kubectl):
+    cassette_file_name = str(tmp_path / 'test.cassette.jsonl')
+    secrets_dir = tmp_path / 'project' / 'secrets'
+    secrets_dir.mkdir()
+
+    with cassette(cassette_file_name, RECORD, placeholders=[], excluded=[str(secrets_dir)]):
+        run("kubectl get secrets > {}".format(secrets_dir / 'secrets.yaml'))
+        run("cd {} && kubectl apply -f secret.yaml".format(secrets_dir))
+        run("kubectl get nodes")
+    with open(cassette_file_name, 'r') as cassette_file:
+        recordings = [json.loads(line) for line in cassette_file]
+    assert [(recording['stdout'], recording['files']) for recording in recordings] == [
+        ('', {}), ('', {}), ('kubectl get nodes\n', {'applied.txt': 'get secrets\nget nodes\n'})]
+    assert (secrets_dir / 'secrets.yaml').read_text() == 'kubectl get secrets\n'
+    assert os.stat(cassette_file_name).st_mode & 0o777 == 0o600
+
+
+def test_records_while_passing_output_through(tmp_path, fake_kubectl):
+    with cassette(str(tmp_path / 'test.cassette.jsonl'), RECORD, placeholders=[], excluded=[]):
+        started = time.perf_counter()
+        process = subprocess.Popen(['kubectl', 'wait'], stdout=subprocess.PIPE, text=True)
+        assert process.stdout.readline() == 'waiting\n'
+        assert time.perf_counter() - started < 1.0
+        assert process.stdout.read() == 'kubectl wait\n'
+        assert process.wait() == 0
+
+
+def test_replays_a_pipeline_through_the_secrets_dir(tmp_path, fake_kubectl, monkeypatch):
+    monkeypatch.setattr(helpers, '_secret_values', dict())
+    monkeypatch.setattr(helpers, '_secret_listeners', list())
+    clusterctl = fake_kubectl.parent / 'clusterctl'
+    clusterctl.write_text(FAKE_CLUSTERCTL.format(python=sys.executable))
+    clusterctl.chmod(0o755)
+    cassette_file_name = str(tmp_path / 'test.cassette.jsonl')
+    manifest_file_name = tmp_path / 'project' / 'secrets' / 'cluster.yaml'
+    manifest_file_name.parent.mkdir()
+
+    def build_manifests(api_key):
+        helpers.register_secret('PACKET_API_KEY', api_key)
+        generated = run("clusterctl generate cluster --api-key {} > {}".format(api_key, manifest_file_name))
+        # the next step works on what the first one generated
+        manifest = manifest_file_name.read_text()
+        applied = run("kubectl apply -f {}".format(manifest_file_name))
+        return generated.returncode, manifest, applied.stdout
+
+    with cassette(cassette_file_name, RECORD, placeholders=[], excluded=[]):
+        recorded = build_manifests('s3cr3t-key')
+    with open(cassette_file_name, 'r') as cassette_file:
+        recordings = cassette_file.read()
+    assert 's3cr3t' not in recordings
+    assert helpers.get_secret_values()['PACKET_API_KEY_B64'] not in recordings
+
+    fake_kubectl.unlink()
+    clusterctl.unlink()
+    manifest_file_name.unlink()
+    with cassette(cassette_file_name, REPLAY, placeholders=[]):
+        replayed = build_manifests('other-key')
+
+    assert recorded[1] == 'kind: Secret\napiKey: czNjcjN0LWtleQ==\n'
+    assert replayed == (recorded[0], 'kind: Secret\napiKey: b3RoZXIta2V5\n', recorded[2])
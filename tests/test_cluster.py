@@ -0,0 +1,131 @@
+import copy
+import os
+import shutil
+import stat
+
+from invoke import Context, Config
+
+from tasks.build_state import get_build_state
+from tasks.cluster import _load_cluster_template, specialise_cluster_template, talos_apply_config_patches, \
+    talosctl_gen_config
+from tasks.helpers import clear_cache, get_constellation_clusters, get_secrets_dir
+from tasks.manifests import read_documents
+
+FAKE_TALOSCTL = """#!/bin/sh
+echo "$@" >> "{log}"
+case "$1" in
+  version) echo "Tag: v1.4.0" ;;
+esac
+"""
+
+
+def test_talos_configs_are_patched_validated_and_inlined(monkeypatch, tmp_path):
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    talosctl = bin_directory / 'talosctl'
+    talosctl.write_text(FAKE_TALOSCTL.format(log=tmp_path / 'talosctl.log'))
+    talosctl.chmod(talosctl.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', "{}{}{}".format(bin_directory, os.pathsep, os.environ['PATH']))
+    monkeypatch.setenv('GOCY_DEFAULT_ROOT', str(tmp_path))
+    shutil.copy(os.path.join('tests', 'demo.v0.1.constellation.yaml'), tmp_path / 'demo.constellation.yaml')
+    (tmp_path / 'ccontext').write_text('demo')
+    clear_cache()
+
+    clusters = get_constellation_clusters()
+    for cluster_spec in clusters:
+        config_dir_name = os.path.join(get_secrets_dir(), cluster_spec.name)
+        os.makedirs(config_dir_name)
+        shutil.copy(os.path.join('manifest-examples', 'talos-alloy-102.yaml'),
+                    os.path.join(config_dir_name, 'cluster-manifest.yaml'))
+        for role in ('controlplane', 'worker'):
+            shutil.copy(os.path.join('tests', 'talos-alloy-102.{}.yaml'.format(role)),
+                        os.path.join(config_dir_name, '{}.yaml'.format(role)))
+
+    ctx = Context(config=Config(overrides={'core': {'jobs': 4}, 'run': {'in_stream': False}}))
+    talos_apply_config_patches(ctx)
+
+    log = (tmp_path / 'talosctl.log').read_text().splitlines()
+    assert len([line for line in log if line.startswith('validate')]) == 2 * len(clusters)
+    assert len([line for line in log if line.startswith('machineconfig')]) == 0
+    static_manifest_file_name = os.path.join(get_secrets_dir(), clusters[1].name, 'cluster-manifest.static-config.yaml')
+    for document in read_documents(static_manifest_file_name):
+        if document['kind'] == 'TalosControlPlane':
+            assert document['spec']['controlPlaneConfig']['controlplane']['data'].startswith('#!talos\ncluster:')
+            assert 'configPatches' not in document['spec']['controlPlaneConfig']['controlplane']
+        if document['kind'] == 'TalosConfigTemplate':
+            assert document['spec']['template']['spec']['data'].endswith('version: v1alpha1')
+    with open(os.path.join(get_secrets_dir(), clusters[0].name, 'worker-capi.yaml')) as worker_config_file:
+        assert worker_config_file.read().startswith('#!talos\ncluster:')
+
+    talos_apply_config_patches(ctx)
+    assert (tmp_path / 'talosctl.log').read_text().splitlines() == log
+
+
+def test_cluster_template_is_parsed_once_and_specialised_per_cluster(monkeypatch, tmp_path):
+    monkeypatch.setenv('GOCY_DEFAULT_ROOT', str(tmp_path))
+    shutil.copy(os.path.join('tests', 'demo.v0.1.constellation.yaml'), tmp_path / 'demo.constellation.yaml')
+    (tmp_path / 'ccontext').write_text('demo')
+    clear_cache()
+
+    cluster_template = _load_cluster_template(os.path.join('templates', 'default.yaml'))
+    documents = copy.deepcopy(cluster_template[0])
+    assert len(cluster_template[1][('TalosControlPlane', '/cluster/network')]) == 1
+    for cluster_spec in get_constellation_clusters():
+        specialised = specialise_cluster_template(cluster_template, cluster_spec)
+        assert cluster_template[0] == documents
+        for document in specialised:
+            if document['kind'] == 'Cluster':
+                assert document['spec']['clusterNetwork']['pods']['cidrBlocks'] == cluster_spec.pod_cidr_blocks
+            if document['kind'] == 'TalosConfigTemplate':
+                network = [patch['value'] for patch in document['spec']['template']['spec']['configPatches']
+                           if patch['path'] == '/cluster/network'][0]
+                assert network['dnsDomain'] == "{}.local".format(cluster_spec.name)
+                assert network['serviceSubnets'] == cluster_spec.service_cidr_blocks
+
+
+FAKE_TALOSCTL_GEN_CONFIG = """#!/bin/sh
+echo "$@" >> "{log}"
+for role in controlplane worker; do
+  printf 'cluster:\\n  clusterName: %s\\n  controlPlane:\\n    endpoint: %s\\n' "$4" "$5" > $role.yaml
+done
+"""
+
+
+def test_talos_configs_are_regenerated_when_the_control_plane_endpoint_changes(monkeypatch, tmp_path):
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    talosctl = bin_directory / 'talosctl'
+    talosctl.write_text(FAKE_TALOSCTL_GEN_CONFIG.format(log=tmp_path / 'talosctl.log'))
+    talosctl.chmod(talosctl.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', "{}{}{}".format(bin_directory, os.pathsep, os.environ['PATH']))
+    monkeypatch.setenv('GOCY_DEFAULT_ROOT', str(tmp_path))
+    shutil.copy(os.path.join('tests', 'demo.v0.1.constellation.yaml'), tmp_path / 'demo.constellation.yaml')
+    (tmp_path / 'ccontext').write_text('demo')
+    clear_cache()
+    clusters = get_constellation_clusters()
+    for cluster_spec in clusters:
+        os.makedirs(os.path.join(get_secrets_dir(), cluster_spec.name))
+    vips = {cluster_spec.name: '192.0.2.{}'.format(index) for index, cluster_spec in enumerate(clusters)}
+    monkeypatch.setattr('tasks.cluster.get_cp_vip_address', lambda cluster_spec: vips[cluster_spec.name])
+    ctx = Context(config=Config(overrides={'core': {'jobs': 4}, 'run': {'in_stream': False}}))
+
+    talosctl_gen_config(ctx)
+    talosctl_gen_config(ctx)
+    log = (tmp_path / 'talosctl.log').read_text().splitlines()
+    assert sorted(log) == sorted(
+        'gen config --force {} https://{}:6443'.format(name, vip) for name, vip in vips.items())
+
+    vips[clusters[0].name] = '192.0.2.100'
+    talosctl_gen_config(ctx)
+    log = (tmp_path / 'talosctl.log').read_text().splitlines()
+    assert log[-1] == 'gen config --force {} https://192.0.2.100:6443'.format(clusters[0].name)
+    assert len(log) == len(vips) + 1
+    with open(os.path.join(get_secrets_dir(), clusters[0].name, 'worker.yaml')) as worker_config_file:
+        assert 'https://192.0.2.100:6443' in worker_config_file.read()
+
+    # configs generated before they were tracked are kept while they match
+    get_build_state().forget([
+        os.path.join(get_secrets_dir(), cluster_spec.name, '{}.yaml'.format(role))
+        for cluster_spec in clusters for role in ('controlplane', 'worker')])
+    talosctl_gen_config(ctx)
+    assert (tmp_path / 'talosctl.log').read_text().splitlines() == log
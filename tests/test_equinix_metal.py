@@ -0,0 +1,67 @@
+import os
+import random
+
+from tasks.constellation_v01 import VipRole
+from tasks.equinix_metal import get_capacity_demand, render_capacity_matrix, ProjectIpIndex, GlobalReservationIndex
+from tests.test_v01_constellation_cfg import get_demo_constellation
+
+
+def test_capacity_demand_is_aggregated_over_constellations():
+    demo = get_demo_constellation()
+    other = get_demo_constellation()
+    other.satellites[0].metro = 'pa'
+
+    assert get_capacity_demand([demo]) == {
+        ('pa', 'm3.small.x86'): 3,
+        ('md', 'm3.small.x86'): 3,
+        ('fr', 'm3.small.x86'): 3
+    }
+    assert get_capacity_demand([demo, other])[('pa', 'm3.small.x86')] == 9
+    assert len(demo.bary.control_nodes) == 1
+
+
+def test_capacity_matrix():
+    matrix = render_capacity_matrix([
+        {'metro': 'pa', 'plan': 'm3.small.x86', 'quantity': 3, 'available': True},
+        {'metro': 'md', 'plan': 'c3.small.x86', 'quantity': 1, 'available': False}
+    ])
+    assert 'c3.small.x86' in matrix.splitlines()[0]
+    assert '1 FAILED' in matrix
+    assert '3 ok' in matrix
+
+
+def _linear_lookup(project_ips, tag, metro):
+    for ip_spec in project_ips:
+        if (ip_spec['global_ip'] or ('metro' in ip_spec and ip_spec['metro']['code'] == metro)) \
+                and 'tags' in ip_spec and len(ip_spec.get('tags')) > 0 and ip_spec.get('tags')[0] == tag:
+            return ip_spec
+
+
+def test_project_ip_index_matches_linear_scan():
+    rng = random.Random(7)
+    metros = ['pa', 'md', 'fr']
+    tags = ['cluster-api-provider-packet:cluster-id:jupiter', 'gocy:vip:ingress', 'gocy:vip:mesh', 'other']
+    project_ips = list()
+    for index in range(500):
+        ip_spec = {'address': '10.0.{}.{}'.format(index // 256, index % 256), 'global_ip': rng.random() < 0.1}
+        if not ip_spec['global_ip'] or rng.random() < 0.5:
+            ip_spec['metro'] = {'code': rng.choice(metros)}
+        if rng.random() < 0.9:
+            ip_spec['tags'] = rng.sample(tags, rng.randint(0, 2))
+        project_ips.append(ip_spec)
+
+    index = ProjectIpIndex(project_ips)
+    for tag in tags:
+        for metro in metros + ['sv']:
+            assert index.lookup(tag, metro) is _linear_lookup(project_ips, tag, metro)
+
+
+def test_global_reservation_index(tmp_path):
+    for cluster_name, ip_type in (('jupiter', 'public_ipv4'), ('ganymede', 'global_ipv4')):
+        os.makedirs(tmp_path / cluster_name)
+        (tmp_path / cluster_name / 'ip-ingress-reservation.yaml').write_text('type: {}\n'.format(ip_type))
+
+    global_reservations = GlobalReservationIndex(str(tmp_path))
+    assert global_reservations.lookup_other(VipRole.ingress, 'callisto') == {'type': 'global_ipv4'}
+    assert global_reservations.lookup_other(VipRole.ingress, 'ganymede') is None
+    assert global_reservations.lookup_other('mesh', 'callisto') is None
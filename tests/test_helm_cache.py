@@ -0,0 +1,77 @@
+import os
+import stat
+import threading
+
+from invoke import Context, Config
+
+from tasks.helm_cache import ensure_helm_dependencies, render_chart
+
+FAKE_HELM = """#!/bin/sh
+echo "$@" >> "{log}"
+case "$1" in
+  version) echo v3.11.3 ;;
+  dependency) mkdir -p charts && echo cilium > charts/cilium-1.13.2.tgz ;;
+  template) echo "kind: ConfigMap" ;;
+esac
+"""
+
+
+def get_context():
+    return Context(config=Config(overrides={'run': {'in_stream': False}}))
+
+
+def setup_chart(monkeypatch, tmp_path):
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    helm = bin_directory / 'helm'
+    helm.write_text(FAKE_HELM.format(log=tmp_path / 'helm.log'))
+    helm.chmod(helm.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', "{}{}{}".format(bin_directory, os.pathsep, os.environ['PATH']))
+    monkeypatch.setenv('GOCY_DEFAULT_ROOT', str(tmp_path / 'gocy'))
+
+    chart_directory = tmp_path / 'chart'
+    chart_directory.mkdir()
+    (chart_directory / 'Chart.yaml').write_text('name: chart\n')
+    (chart_directory / 'Chart.lock').write_text('digest: sha256:1\n')
+    (chart_directory / 'values.yaml').write_text('replicas: 1\n')
+    return str(chart_directory), tmp_path / 'helm.log'
+
+
+def helm_calls(log, command):
+    return [line for line in log.read_text().splitlines() if line.startswith(command)]
+
+
+def test_dependencies_are_fetched_once(monkeypatch, tmp_path):
+    chart_directory, log = setup_chart(monkeypatch, tmp_path)
+    ensure_helm_dependencies(get_context(), chart_directory)
+    os.remove(os.path.join(chart_directory, 'charts', 'cilium-1.13.2.tgz'))
+    ensure_helm_dependencies(get_context(), chart_directory)
+    assert os.path.isfile(os.path.join(chart_directory, 'charts', 'cilium-1.13.2.tgz'))
+    assert len(helm_calls(log, 'dependency')) == 1
+
+
+def test_concurrent_installs_fetch_dependencies_once(monkeypatch, tmp_path):
+    chart_directory, log = setup_chart(monkeypatch, tmp_path)
+    installs = [threading.Thread(target=ensure_helm_dependencies, args=(get_context(), chart_directory))
+                for _ in range(4)]
+    for install in installs:
+        install.start()
+    for install in installs:
+        install.join()
+    assert len(helm_calls(log, 'dependency')) == 1
+
+
+def test_renders_are_keyed_by_chart_and_values(monkeypatch, tmp_path):
+    chart_directory, log = setup_chart(monkeypatch, tmp_path)
+    ctx = get_context()
+    jupiter = render_chart(ctx, chart_directory, 'cni', 'network-services', ['cilium.k8sServiceHost=10.0.0.1'])
+    assert render_chart(ctx, chart_directory, 'cni', 'network-services', ['cilium.k8sServiceHost=10.0.0.1']) == jupiter
+    ganymede = render_chart(ctx, chart_directory, 'cni', 'network-services', ['cilium.k8sServiceHost=10.0.0.2'])
+    assert ganymede != jupiter
+    assert open(ganymede).read() == 'kind: ConfigMap\n'
+    assert len(helm_calls(log, 'template')) == 2
+
+    (tmp_path / 'chart' / 'values.yaml').write_text('replicas: 2\n')
+    render_chart(ctx, chart_directory, 'cni', 'network-services', ['cilium.k8sServiceHost=10.0.0.1'])
+    assert len(helm_calls(log, 'template')) == 3
+    assert len(helm_calls(log, 'dependency')) == 1
@@ -1,4 +1,8 @@
-from tasks.helpers import get_config_dir
+import os
+import shutil
+
+from tasks.helpers import find_git_work_tree, get_config_dir, get_constellation, get_ccontext, get_cluster_spec, \
+    get_constellation_clusters, get_project_root, clear_cache
 
 
 def test_get_config_dir(monkeypatch):
@@ -12,3 +16,47 @@ def test_get_config_dir(monkeypatch):
     assert config_dir != ''
 
 
+def test_constellation_is_memoized_until_changed(monkeypatch, tmp_path):
+    monkeypatch.setenv('GOCY_DEFAULT_ROOT', str(tmp_path))
+    shutil.copy(os.path.join('tests', 'demo.v0.1.constellation.yaml'), tmp_path / 'demo.constellation.yaml')
+    (tmp_path / 'ccontext').write_text('demo')
+    clear_cache()
+
+    constellation = get_constellation()
+    assert get_ccontext() == 'demo'
+    assert get_constellation() is constellation
+    assert get_cluster_spec(None, 'callisto') is constellation.satellites[1]
+    assert get_cluster_spec(None, 'io') is None
+    assert [cluster.name for cluster in get_constellation_clusters()] == ['jupiter', 'ganymede', 'callisto']
+
+    with open(tmp_path / 'demo.constellation.yaml', 'a') as constellation_file:
+        constellation_file.write("- name: io\n  metro: da\n")
+    assert get_constellation() is not constellation
+    assert get_cluster_spec(None, 'io').metro == 'da'
+
+    (tmp_path / 'ccontext').write_text('')
+    assert get_ccontext() == 'jupiter'
+
+    clear_cache()
+    assert get_ccontext() == 'jupiter'
+
+
+def test_project_root_is_found_without_git(monkeypatch, tmp_path):
+    monkeypatch.delenv('TOEM_PROJECT_ROOT', raising=False)
+    repository = tmp_path / 'repository'
+    (repository / '.git').mkdir(parents=True)
+    (repository / 'tasks').mkdir()
+    worktree = tmp_path / 'worktree'
+    (worktree / 'apps').mkdir(parents=True)
+    (worktree / '.git').write_text('gitdir: {}\n'.format(repository / '.git' / 'worktrees' / 'worktree'))
+
+    assert find_git_work_tree(str(repository / 'tasks')) == str(repository.resolve())
+    assert find_git_work_tree(str(worktree / 'apps')) == str(worktree.resolve())
+    (tmp_path / 'export').mkdir()
+    (tmp_path / 'export' / '.git').write_text('not a git file\n')
+    assert find_git_work_tree(str(tmp_path / 'export')) == find_git_work_tree(str(tmp_path))
+
+    monkeypatch.chdir(worktree / 'apps')
+    assert get_project_root() == str(worktree.resolve())
+    monkeypatch.setenv('TOEM_PROJECT_ROOT', str(repository))
+    assert get_project_root() == str(repository)
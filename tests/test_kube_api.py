@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tasks import kube_api as kube_api_module
+from tasks.kube_api import get_current_context, get_kube_api, KubeApi, KubeConfigError
+from tasks.yaml_io import safe_dump
+
+PODS = [
+    {'metadata': {'name': 'debug-{}'.format(index), 'labels': {'name': 'debug'}}, 'spec': {'nodeName': 'n{}'.format(index)}}
+    for index in range(3)
+] + [{'metadata': {'name': 'metallb-speaker', 'labels': {'name': 'speaker'}}, 'spec': {'nodeName': 'n0'}}]
+
+
+class FakeKubeApi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = list()
+
+    def log_message(self, *args):
+        pass
+
+    # Watches stay silent for this long before sending their events and ending
+    watch_silence = 0
+    watch_events = list()
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        FakeKubeApi.requests.append((url.path, query, self.headers.get('Authorization')))
+        if 'watch' in query:
+            return self._watch()
+        selector = query.get('labelSelector', [''])[0]
+        items = [pod for pod in PODS if selector == '' or selector == 'name=' + pod['metadata']['labels']['name']]
+        start = int(query.get('continue', ['0'])[0])
+        limit = int(query['limit'][0])
+        body = {'items': items[start:start + limit], 'metadata': dict()}
+        if start + limit < len(items):
+            body['metadata']['continue'] = str(start + limit)
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _watch(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        time.sleep(FakeKubeApi.watch_silence)
+        try:
+            for event in FakeKubeApi.watch_events:
+                self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except OSError:
+            pass  # the client gave up on the watch
+
+
+@pytest.fixture
+def kube_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeKubeApi)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    FakeKubeApi.requests.clear()
+    FakeKubeApi.watch_silence = 0
+    FakeKubeApi.watch_events = list()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def write_kubeconfig(file_name, server, current_context, token='secret'):
+    with open(file_name, 'w') as kubeconfig_file:
+        safe_dump({
+            'current-context': current_context,
+            'clusters': [{'name': 'jupiter', 'cluster': {'server': server}}],
+            'users': [{'name': 'admin@jupiter', 'user': {'token': token}}],
+            'contexts': [{'name': 'admin@jupiter', 'context': {'cluster': 'jupiter', 'user': 'admin@jupiter'}}],
+        }, kubeconfig_file)
+
+
+def test_kubeconfig_files_are_merged(monkeypatch, tmp_path):
+    write_kubeconfig(tmp_path / 'first', 'http://first', '')
+    write_kubeconfig(tmp_path / 'second', 'http://second', 'admin@jupiter')
+    monkeypatch.setenv('KUBECONFIG', '{}:{}'.format(tmp_path / 'first', tmp_path / 'second'))
+    assert get_current_context() == 'admin@jupiter'
+    assert get_kube_api().client.host == 'first'
+    with pytest.raises(KubeConfigError):
+        get_kube_api('admin@ganymede')
+
+
+def test_pods_are_listed_by_selector_across_pages(monkeypatch, tmp_path, kube_server):
+    write_kubeconfig(tmp_path / 'config', kube_server, 'admin@jupiter')
+    monkeypatch.setenv('KUBECONFIG', str(tmp_path / 'config'))
+    kube_api = get_kube_api()
+    kube_api.page_size = 2
+    pods = kube_api.list_pods('network-services', label_selector='name=debug')
+    assert [pod['metadata']['name'] for pod in pods] == ['debug-0', 'debug-1', 'debug-2']
+    assert len(FakeKubeApi.requests) == 2
+    assert FakeKubeApi.requests[0][2] == 'Bearer secret'
+    assert get_kube_api() is kube_api
+
+    write_kubeconfig(tmp_path / 'config', kube_server, 'admin@jupiter', token='rotated-secret')
+    assert get_kube_api() is not kube_api
+
+
+def test_watch_outlasts_the_client_timeout(kube_server):
+    event = {'type': 'MODIFIED', 'object': {'metadata': {'name': 'debug', 'resourceVersion': '12'}}}
+    FakeKubeApi.watch_silence = 2
+    FakeKubeApi.watch_events = [event]
+    kube_api = KubeApi(kube_server, timeout=1)
+    assert list(kube_api.watch('/api/v1/pods', timeout_seconds=5)) == [event]
+    assert kube_api.list_pods('network-services') == PODS
+    kube_api.close()
+
+
+def test_silent_watch_ends_instead_of_failing(monkeypatch, kube_server):
+    monkeypatch.setattr(kube_api_module, 'WATCH_READ_TIMEOUT_MARGIN', 0)
+    FakeKubeApi.watch_silence = 3
+    kube_api = KubeApi(kube_server, timeout=1)
+    started = time.monotonic()
+    assert list(kube_api.watch('/api/v1/pods', timeout_seconds=1)) == list()
+    assert time.monotonic() - started < 2.5
+    kube_api.close()
@@ -0,0 +1,84 @@
+import os
+import random
+import shutil
+
+import pytest
+import yaml
+
+from tasks.manifests import for_kind, process_manifest, read_documents, normalise_multiline_whitespace
+
+
+def test_process_manifest_in_place(tmp_path):
+    manifest_file_name = os.path.join(tmp_path, 'manifest.yaml')
+    shutil.copy(os.path.join('manifest-examples', 'talos-alloy-102.yaml'), manifest_file_name)
+    with open(manifest_file_name, 'a') as manifest_file:
+        manifest_file.write('---\n')
+    expected = [document for document in read_documents(manifest_file_name) if document is not None]
+
+    @for_kind('TalosControlPlane', 'TalosConfigTemplate')
+    def mark(document):
+        document['metadata']['labels'] = {'patched': 'true'}
+        return document
+
+    @for_kind('MachineDeployment')
+    def drop(document):
+        return None
+
+    process_manifest(manifest_file_name, manifest_file_name, mark, drop)
+
+    documents = list(read_documents(manifest_file_name))
+    assert [document['kind'] for document in documents] == \
+           [document['kind'] for document in expected if document['kind'] != 'MachineDeployment']
+    for document in documents:
+        if document['kind'] in ('TalosControlPlane', 'TalosConfigTemplate'):
+            assert document['metadata']['labels'] == {'patched': 'true'}
+        else:
+            assert document in expected
+    assert os.listdir(tmp_path) == ['manifest.yaml']
+
+
+def test_failed_transform_leaves_target_untouched(tmp_path):
+    manifest_file_name = os.path.join(tmp_path, 'manifest.yaml')
+    with open(manifest_file_name, 'w') as manifest_file:
+        yaml.safe_dump_all([{'kind': 'A'}, {'kind': 'B'}], manifest_file)
+
+    @for_kind('B')
+    def fail(document):
+        raise KeyError('spec')
+
+    with pytest.raises(KeyError):
+        process_manifest(manifest_file_name, manifest_file_name, fail)
+    assert list(read_documents(manifest_file_name)) == [{'kind': 'A'}, {'kind': 'B'}]
+    assert os.listdir(tmp_path) == ['manifest.yaml']
+
+
+def _strip_data_whitespace(value):
+    # the per line loop normalise_multiline_whitespace replaced
+    tmp_list = value.split('\n')
+    for index, _ in enumerate(tmp_list):
+        tmp_list[index] = tmp_list[index].rstrip()
+    return "\n".join(tmp_list).strip()
+
+
+def test_multiline_normaliser_matches_line_loop():
+    rng = random.Random(16)
+    alphabet = ['a', 'b', ' ', '\t', '\n', '\r', '\x0b', '\x0c', '\x1c', '\x85', '\xa0', '\u2028', '\u3000', '#', '\u00e9']
+    for _ in range(5000):
+        value = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 30))) + '\n'
+        document = {'kind': 'ConfigMap', 'data': {'key': value}}
+        normalise_multiline_whitespace()(document)
+        assert document['data']['key'] == _strip_data_whitespace(value), repr(value)
+
+
+def test_multiline_normaliser_reports_changed_documents():
+    changed = list()
+    normalise = normalise_multiline_whitespace(changed)
+    documents = [
+        {'kind': 'ConfigMap', 'metadata': {'name': 'cilium-config', 'namespace': 'kube-system'},
+         'data': {'config': 'a  \nb\t\n', 'single': 'x  '}},
+        {'kind': 'Secret', 'metadata': {'name': 'tls'}, 'stringData': {'crt': 'clean\nlines'}},
+        {'kind': 'Secret', 'metadata': {'name': 'ca'}, 'stringData': {'crt': 'dirty \nlines'}, 'data': {'n': 1}},
+    ]
+    documents = [normalise(document) for document in documents]
+    assert documents[0]['data'] == {'config': 'a\nb', 'single': 'x  '}
+    assert changed == ['ConfigMap/kube-system/cilium-config', 'Secret/ca']
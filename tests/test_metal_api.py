@@ -0,0 +1,77 @@
+import http.client
+
+import pytest
+
+from tasks.http_client import HttpError
+from tasks.metal_api import MetalApi
+from tests.fake_metal_api import FakeMetalApi
+
+
+def get_metal_api(fake, token='token'):
+    return MetalApi(token, 'project', fake.url, per_page=2, workers=3, backoff=0)
+
+
+def test_paginated_lists_are_fetched_completely():
+    devices = [{'hostname': 'jupiter-worker-{}'.format(index), 'ip_addresses': []} for index in range(7)]
+    with FakeMetalApi(devices=devices) as fake:
+        metal_api = get_metal_api(fake)
+        assert metal_api.get_devices() == devices
+        assert len(fake.requests) == 4
+        metal_api.close()
+
+
+def test_connection_is_kept_alive_and_throttling_is_retried():
+    with FakeMetalApi() as fake:
+        metal_api = get_metal_api(fake)
+        fake.failures = 2
+        reservation = metal_api.request_ips('public_ipv4', 1, ['gocy:vip:mesh'], 'pa')
+        assert reservation['metro']['code'] == 'pa'
+        assert metal_api.get_project_ips() == [reservation]
+        assert len(fake.requests) == 4
+        assert len(fake.connections) == 1
+        metal_api.close()
+
+
+def test_errors_are_raised():
+    with FakeMetalApi() as fake:
+        metal_api = get_metal_api(fake, token='wrong')
+        with pytest.raises(HttpError) as error:
+            metal_api.get_project_ips()
+        assert error.value.status == 401
+        metal_api.close()
+
+
+def test_capacity_is_checked_in_batches():
+    with FakeMetalApi() as fake:
+        fake.capacity[('pa', 'm3.small.x86')] = 3
+        metal_api = get_metal_api(fake)
+        servers = [{'metro': 'pa', 'plan': 'm3.small.x86', 'quantity': quantity} for quantity in range(1, 6)]
+        results = metal_api.check_capacity(servers, batch_size=2)
+        assert [server['available'] for server in results] == [True, True, True, False, False]
+        assert len(fake.requests) == 3
+        metal_api.close()
+
+
+def test_requests_use_a_fresh_connection_once_the_server_closed_the_kept_alive_one():
+    with FakeMetalApi() as fake:
+        metal_api = get_metal_api(fake)
+        fake.drop_connections = True
+        first = metal_api.request_ips('public_ipv4', 1, ['gocy:vip:mesh'], 'pa')
+        assert fake.dropped.acquire(timeout=5)
+        second = metal_api.request_ips('public_ipv4', 1, ['gocy:vip:ingress'], 'pa')
+        assert first != second
+        assert [method for method, path, body in fake.requests] == ['POST', 'POST']
+        assert len(fake.connections) == 2
+        metal_api.close()
+
+
+def test_requests_the_server_may_have_processed_are_not_resent():
+    with FakeMetalApi() as fake:
+        metal_api = get_metal_api(fake)
+        metal_api.get_devices()
+        fake.lost_responses = 1
+        with pytest.raises(http.client.RemoteDisconnected):
+            metal_api.request_ips('public_ipv4', 1, ['gocy:vip:mesh'], 'pa')
+        assert [method for method, path, body in fake.requests] == ['GET', 'POST']
+        assert len(fake.ips) == 1
+        metal_api.close()
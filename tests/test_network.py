@@ -0,0 +1,119 @@
+import base64
+import os
+import shutil
+import sys
+
+import pytest
+from invoke import Config, Context, MockContext, Result
+
+from tasks import network
+from tasks.helpers import clear_cache, get_constellation_clusters
+from tasks.manifests import read_documents
+from tasks.network import _patch_node, _plan_node_patches, _render_bgp_patch, \
+    build_network_service_dependencies_manifest, get_network_manifest_file_name
+
+
+def test_bgp_patch_routes_use_node_gateway():
+    templates_directory = 'patch-templates/bgp'
+    cp_patch = _render_bgp_patch(templates_directory, 'jupiter-control-plane-abcde', '10.68.0.1')
+    worker_patch = _render_bgp_patch(templates_directory, 'jupiter-worker-abcde', '10.68.0.2')
+    assert {route['gateway'] for route in cp_patch[0]['value']['routes']} == {'10.68.0.1'}
+    assert {route['gateway'] for route in worker_patch[1]['value']['routes']} == {'10.68.0.2'}
+    assert _render_bgp_patch(templates_directory, 'jupiter-bastion', '10.68.0.3') is None
+
+
+def test_every_node_address_is_patched_despite_failures():
+    command = "talosctl --talosconfig talosconfig patch mc --nodes {} --patch @node.yaml"
+    ctx = MockContext(run={
+        command.format('10.0.0.1'): Result(exited=1),
+        command.format('10.0.0.2'): Result(),
+        command.format('10.0.0.3'): Result(exited=1),
+    })
+    node = {'hostname': 'jupiter-worker-abcde', 'addresses': ['10.0.0.1', '10.0.0.2', '10.0.0.3'], 'patch_file_name': 'node.yaml'}
+    with pytest.raises(RuntimeError, match='10.0.0.1, 10.0.0.3'):
+        _patch_node(ctx, node, 'talosconfig')
+
+
+def test_nodes_that_can_not_be_patched_are_failed(tmp_path):
+    node_patch_data = {
+        'jupiter-worker-abcde': {'gateway': '10.68.0.1', 'addresses': ['10.0.0.1']},
+        'jupiter-worker-fghij': {'gateway': None, 'addresses': ['10.0.0.2']},
+        'jupiter-bastion': {'gateway': '10.68.0.3', 'addresses': ['10.0.0.3']},
+    }
+    nodes, skipped = _plan_node_patches(node_patch_data, 'patch-templates/bgp', str(tmp_path))
+    assert [node['hostname'] for node in nodes] == ['jupiter-worker-abcde']
+    assert os.listdir(tmp_path) == ['jupiter-worker-abcde.yaml']
+    assert [(result.label, result.ok) for result in skipped] == [
+        ('jupiter-worker-fghij', False), ('jupiter-bastion', False)]
+
+
+FAKE_HELM = """#!{python}
+import sys
+
+if sys.argv[1:2] == ['version']:
+    print('v3.12.0')
+elif sys.argv[1:2] == ['template']:
+    values = dict(value.split('=', 1) for flag, value in zip(sys.argv, sys.argv[1:]) if flag == '--set')
+    print('kind: ConfigMap')
+    print('metadata:')
+    print('  name: cilium-config')
+    print('data:')
+    print('  cluster-name: ' + values['cilium.cluster.name'])
+    print('  cluster-id: "' + values['cilium.cluster.id'] + '"')
+    print('  k8s-service-host: ' + values['cilium.k8sServiceHost'])
+    print('  script: "ip route   \\\\nip addr"')
+"""
+
+
+def _network_manifests_build(monkeypatch, tmp_path):
+    shutil.copy(os.path.join('tests', 'demo.v0.1.constellation.yaml'), tmp_path / 'demo.constellation.yaml')
+    (tmp_path / 'ccontext').write_text('demo')
+    monkeypatch.setenv('GOCY_DEFAULT_ROOT', str(tmp_path))
+    clear_cache()
+    clusters = get_constellation_clusters()
+    monkeypatch.setattr(network, 'get_cp_vip_address', lambda cluster_spec: '192.0.2.{}'.format(
+        clusters.index(cluster_spec)))
+    return clusters, Context(config=Config(overrides={'core': {'jobs': 4}, 'run': {'in_stream': False}}))
+
+
+def test_network_manifest_is_rendered_per_cluster(monkeypatch, tmp_path):
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    helm = bin_directory / 'helm'
+    helm.write_text(FAKE_HELM.format(python=sys.executable))
+    helm.chmod(0o755)
+    monkeypatch.setenv('PATH', "{}{}{}".format(bin_directory, os.pathsep, os.environ['PATH']))
+    clusters, ctx = _network_manifests_build(monkeypatch, tmp_path)
+
+    build_network_service_dependencies_manifest(ctx)
+
+    for index, cluster_spec in enumerate(clusters):
+        [config_map] = read_documents(get_network_manifest_file_name(cluster_spec))
+        assert config_map['data'] == {
+            'cluster-name': cluster_spec.name,
+            'cluster-id': str(index + 1),
+            'k8s-service-host': '192.0.2.{}'.format(index),
+            'script': 'ip route\nip addr'}
+
+
+def _certificate(secret, key):
+    pem = base64.b64decode(secret['data'][key]).decode('ascii')
+    return base64.b64decode(''.join(line for line in pem.splitlines() if not line.startswith('-----')))
+
+
+@pytest.mark.skipif(shutil.which('helm') is None, reason='needs helm and the chart repositories')
+def test_hubble_certificates_are_issued_per_cluster(monkeypatch, tmp_path):
+    clusters, ctx = _network_manifests_build(monkeypatch, tmp_path)
+
+    build_network_service_dependencies_manifest(ctx)
+
+    certificate_authorities = set()
+    for cluster_spec in clusters:
+        secrets = {
+            document['metadata']['name']: document
+            for document in read_documents(get_network_manifest_file_name(cluster_spec))
+            if document['kind'] == 'Secret'}
+        server_certificate = _certificate(secrets['hubble-server-certs'], 'tls.crt')
+        assert '*.{}.hubble-grpc.cilium.io'.format(cluster_spec.name).encode('ascii') in server_certificate
+        certificate_authorities.add(_certificate(secrets['hubble-server-certs'], 'ca.crt'))
+    assert len(certificate_authorities) == len(clusters)
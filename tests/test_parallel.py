@@ -0,0 +1,77 @@
+import pytest
+from invoke import Context, Config
+from invoke.exceptions import Exit
+
+from tasks.parallel import run_graph, run_parallel
+
+
+def get_context(jobs=4):
+    return Context(config=Config(overrides={'core': {'jobs': jobs}}))
+
+
+def test_run_parallel_keeps_order_and_labels_output(capsys):
+    def job(ctx, item):
+        ctx.run("echo hello {}".format(item), echo=True)
+        return item * 2
+
+    results = run_parallel(get_context(), job, [1, 2, 3], label=lambda item: "c{}".format(item))
+
+    assert [result.value for result in results] == [2, 4, 6]
+    out = capsys.readouterr().out
+    assert "[c1] $ echo hello 1" in out
+    assert "[c2] hello 2" in out
+    assert "[c3] hello 3" in out
+
+
+def test_run_parallel_reports_failures_per_item(capsys):
+    def job(ctx, item):
+        ctx.run("exit {}".format(item))
+
+    with pytest.raises(Exit):
+        run_parallel(get_context(jobs=2), job, [0, 3, 0], label=lambda item: "c{}".format(item))
+
+    results = run_parallel(get_context(jobs=2), job, [0, 3], raise_on_error=False)
+    assert [result.ok for result in results] == [True, False]
+    assert "FAILED" in capsys.readouterr().out
+
+
+def test_run_graph_respects_dependencies_and_skips_dependants_of_failures(capsys):
+    graph = {'cni': [], 'dns-deps': ['cni'], 'dns': ['dns-deps'], 'multitool': ['cni'], 'broken': ['cni'],
+             'app': ['dns', 'broken']}
+    finished = list()
+
+    def job(ctx, item):
+        if item == 'broken':
+            raise RuntimeError('boom')
+        for dependency in graph[item]:
+            assert dependency in finished
+        finished.append(item)
+
+    results = run_graph(get_context(), job, list(graph), lambda item: graph[item], raise_on_error=False)
+    assert [result.ok for result in results] == [True, True, True, True, False, False]
+    assert 'app' not in finished
+    assert 'skipped, depends on failed: broken' in capsys.readouterr().out
+
+    # dependants listed before the items they depend on are skipped too
+    chain = {'C': ['B'], 'B': ['A'], 'A': []}
+
+    def chain_job(ctx, item):
+        if item == 'A':
+            raise RuntimeError('boom')
+
+    results = run_graph(get_context(), chain_job, ['C', 'B', 'A'], lambda item: chain[item], raise_on_error=False)
+    assert [str(result.error) for result in results] == [
+        'skipped, depends on failed: B', 'skipped, depends on failed: A', 'boom']
+
+    with pytest.raises(ValueError, match='cycle between: a, b'):
+        run_graph(get_context(), job, ['a', 'b'], lambda item: {'a': ['b'], 'b': ['a']}[item])
+
+
+def test_nested_jobs_inherit_kube_context():
+    def cluster_job(ctx, cluster_name):
+        ctx._set(kube_context='admin@' + cluster_name)
+        return run_parallel(ctx, lambda job_ctx, step: (job_ctx.label, job_ctx.kube_context), ['cni'], report=False)
+
+    results = run_parallel(get_context(), cluster_job, ['jupiter', 'ganymede'], report=False)
+    assert [result.value[0].value for result in results] == [
+        ('jupiter/cni', 'admin@jupiter'), ('ganymede/cni', 'admin@ganymede')]
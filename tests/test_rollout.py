@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from tasks.http_client import HttpError
+from tasks.rollout import is_ready, _wait_for_kind
+
+
+def daemon_set(name, available, release='network-multitool', generation=1, resource_version='1'):
+    return {
+        'kind': 'DaemonSet',
+        'metadata': {'name': name, 'generation': generation, 'resourceVersion': resource_version,
+                     'annotations': {'meta.helm.sh/release-name': release}},
+        'status': {'observedGeneration': 1, 'desiredNumberScheduled': 3, 'updatedNumberScheduled': 3,
+                   'numberAvailable': available}
+    }
+
+
+class FakeKubeApi:
+    def __init__(self, items, watches):
+        self.items = items
+        self.watches = list(watches)
+        self.watched_from = list()
+
+    def list_collection(self, path, label_selector=None, field_selector=None):
+        return self.items, '10'
+
+    def watch(self, path, resource_version=None, label_selector=None, field_selector=None, timeout_seconds=60):
+        self.watched_from.append(resource_version)
+        events = self.watches.pop(0)
+        if isinstance(events, Exception):
+            raise events
+        yield from events
+
+
+def test_readiness_follows_rollout_status():
+    assert is_ready(daemon_set('debug', 3))
+    assert not is_ready(daemon_set('debug', 2))
+    assert not is_ready(daemon_set('debug', 3, generation=2))
+    deployment = {'kind': 'Deployment', 'metadata': {}, 'spec': {'replicas': 2},
+                  'status': {'updatedReplicas': 2, 'availableReplicas': 1}}
+    assert not is_ready(deployment)
+
+
+def test_wait_returns_on_the_event_making_the_release_ready():
+    deadline = time.monotonic() + 60
+    kube_api = FakeKubeApi(
+        [daemon_set('debug', 1), daemon_set('speaker', 0, release='metallb')],
+        [
+            [{'type': 'MODIFIED', 'object': daemon_set('debug', 2, resource_version='11')}],
+            HttpError('WATCH', '/daemonsets', 410, 'too old'),
+            [{'type': 'MODIFIED', 'object': daemon_set('debug', 3)},
+             {'type': 'MODIFIED', 'object': daemon_set('never-consumed', 0)}],
+        ])
+    assert _wait_for_kind(kube_api, 'DaemonSet', 'network-multitool', 'network-services', deadline) == ['debug']
+    assert kube_api.watched_from == ['10', '11', '10']
+
+
+def test_wait_times_out():
+    kube_api = FakeKubeApi([daemon_set('debug', 1)], [])
+    with pytest.raises(TimeoutError, match='debug'):
+        _wait_for_kind(kube_api, 'DaemonSet', 'network-multitool', 'network-services', 0)
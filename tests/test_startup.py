@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+CHECK = """
+import sys
+import tasks
+heavy = [module for module in ('git', 'pydantic', 'pydantic_yaml', 'tabulate') if module in sys.modules]
+assert heavy == [], heavy
+assert tasks.ns.configuration()['core']['jobs'] > 0
+"""
+
+
+def test_listing_tasks_does_not_load_models_or_config(tmp_path):
+    subprocess.run([sys.executable, '-c', CHECK], check=True, env=dict(os.environ, GOCY_DEFAULT_ROOT=str(tmp_path)))
@@ -0,0 +1,61 @@
+import pytest
+
+from tasks.manifests import read_documents
+from tasks.talos_patch import TalosPatchError, apply_config_patches, apply_json_patch, patch_talos_config_file, \
+    render_talos_config
+
+
+def _talos_alloy_102(manifest_file_name):
+    for document in read_documents(manifest_file_name):
+        if document['kind'] == 'TalosControlPlane':
+            controlplane = document['spec']['controlPlaneConfig']['controlplane']
+        if document['kind'] == 'TalosConfigTemplate':
+            worker = document['spec']['template']['spec']
+    return controlplane, worker
+
+
+@pytest.mark.parametrize('role', ['controlplane', 'worker'])
+def test_patched_config_matches_talosctl_output(role):
+    controlplane, worker = _talos_alloy_102('manifest-examples/talos-alloy-102.yaml')
+    patches = (controlplane if role == 'controlplane' else worker)['configPatches']
+    for patch in patches:
+        # the two examples were redacted with different placeholders
+        if patch['path'] == '/cluster/inlineManifests/0':
+            patch['value']['contents'] = patch['value']['contents'].replace(
+                'REDACTED_CPEM_CONFIG', 'REDACTED_CPEM_CONFIGURATION')
+    controlplane, worker = _talos_alloy_102('manifest-examples/talos-alloy-102.static-config.yaml')
+    expected = (controlplane if role == 'controlplane' else worker)['data']
+
+    assert patch_talos_config_file('tests/talos-alloy-102.{}.yaml'.format(role), patches) == expected
+
+
+def test_json_patch_operations():
+    document = {'a': {'b': [1, 2], 'c~/d': 'x'}}
+    patched = apply_json_patch(document, [
+        {'op': 'add', 'path': '/a/b/-', 'value': 3},
+        {'op': 'add', 'path': '/a/b/0', 'value': 0},
+        {'op': 'test', 'path': '/a/c~0~1d', 'value': 'x'},
+        {'op': 'copy', 'from': '/a/b', 'path': '/e'},
+        {'op': 'move', 'from': '/a/c~0~1d', 'path': '/f'},
+        {'op': 'replace', 'path': '/e/1', 'value': 'one'},
+        {'op': 'remove', 'path': '/a/b/3'}
+    ])
+    assert patched == {'a': {'b': [0, 1, 2]}, 'e': [0, 'one', 2, 3], 'f': 'x'}
+    assert document == {'a': {'b': [1, 2], 'c~/d': 'x'}}
+
+    for operation in ({'op': 'replace', 'path': '/missing', 'value': 1},
+                      {'op': 'add', 'path': '/missing/key', 'value': 1},
+                      {'op': 'add', 'path': '/a/b/5', 'value': 1},
+                      {'op': 'test', 'path': '/a/b/0', 'value': 2}):
+        with pytest.raises(TalosPatchError):
+            apply_json_patch(document, [operation])
+
+
+def test_merge_patches_and_rendering():
+    config = apply_config_patches(
+        {'machine': {'certSANs': ['a'], 'kubelet': {'image': 'kubelet'}}},
+        [{'machine': {'certSANs': ['b'], 'kubelet': {'extraArgs': {'cloud-provider': 'external'}}}}])
+    assert config == {'machine': {
+        'certSANs': ['a', 'b'], 'kubelet': {'image': 'kubelet', 'extraArgs': {'cloud-provider': 'external'}}}}
+    assert render_talos_config({'key': '', 'enabled': 'true', 'version': 'v1alpha1'}) == \
+           '#!talos\nenabled: "true"\nkey: ""\nversion: v1alpha1\n'
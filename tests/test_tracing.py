@@ -0,0 +1,106 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+from invoke import Collection, Config, Context, Executor, task
+
+from tasks import helpers, tracing
+from tasks.parallel import run_parallel
+from tasks.tracing import Span, TracingLocal, chrome_trace, critical_path
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = tracing.Tracer()
+    monkeypatch.setattr(tracing, '_tracer', tracer)
+    # undone after the test: instrument patches invoke's Executor and exports the trace at exit
+    monkeypatch.setattr(Executor, 'expand_calls', Executor.expand_calls)
+    exports = list()
+    monkeypatch.setattr(tracing, 'atexit', SimpleNamespace(register=lambda *args: exports.append(args)))
+    tracer.exports = exports
+    return tracer
+
+
+def get_config():
+    return Config(overrides={'runners': {'local': TracingLocal}, 'run': {'in_stream': False, 'hide': True},
+                             'core': {'jobs': 2}})
+
+
+def test_pre_tasks_and_commands_nest_below_the_task(tracer, tmp_path):
+    @task
+    def prepare(ctx):
+        ctx.run("true")
+
+    @task(prepare)
+    def build(ctx):
+        ctx.run("false", warn=True)
+
+    collection = Collection(prepare, build)
+    trace_file_name = str(tmp_path / 'build.trace.json')
+    tracing.instrument(collection, trace_file_name)
+    # as invoke's Program runs tasks, the runner comes from the collection's configuration
+    Executor(collection, Config(overrides={'run': {'in_stream': False, 'hide': True}})).execute('build')
+
+    [build_span] = tracer.root.children
+    assert build_span.args == {'task': 'build'}
+    assert [child.name for child in build_span.children] == ['prepare', 'false']
+    prepare_span, false_span = build_span.children
+    assert prepare_span.start >= build_span.start and prepare_span.end <= false_span.start
+    assert prepare_span.children[0].args == {'command': 'true', 'exit_code': 0}
+    assert false_span.args == {'command': 'false', 'exit_code': 1}
+    assert tracer.exports == [(tracing.export, tracer, trace_file_name)]
+
+
+def test_parallel_jobs_nest_below_the_span_that_started_them(tracer):
+    tracer.enable()
+    with tracer.span('build', 'task') as build_span:
+        run_parallel(Context(config=get_config()), lambda ctx, item: ctx.run("true"), ['a', 'b'])
+
+    assert sorted(child.name for child in build_span.children) == ['a', 'b']
+    for job_span in build_span.children:
+        assert job_span.category == 'job'
+        assert job_span.children[0].args['label'] == job_span.name
+
+
+def _span(name, parent, start, end):
+    span = Span(name, 'run', parent)
+    span.start, span.end = start, end
+    parent.children.append(span)
+    return span
+
+
+def test_critical_path_and_chrome_trace():
+    root = Span('invoke', 'invoke')
+    root.start, root.end = 0.0, 10.0
+    prepare = _span('prepare', root, 0.0, 2.0)
+    build = _span('build', root, 2.0, 10.0)
+    _span('cilium', build, 2.0, 5.0)
+    fast_job = _span('fast', build, 5.0, 6.0)
+    slow_job = _span('slow', build, 5.0, 10.0)
+    fast_job.thread = slow_job.thread + 1
+
+    assert [span.name for span in critical_path(root)] == ['prepare', 'cilium', 'slow']
+
+    tracer = tracing.Tracer()
+    tracer.root = root
+    events = chrome_trace(tracer)['traceEvents']
+    [slow_event] = [event for event in events if event['name'] == 'slow']
+    assert (slow_event['ph'], slow_event['ts'], slow_event['dur']) == ('X', 5e6, 5e6)
+    assert [event['args']['name'] for event in events if event['ph'] == 'M'] == ['main', 'worker-1']
+
+
+def test_secrets_stay_out_of_the_trace(tracer, monkeypatch, tmp_path):
+    monkeypatch.setattr(helpers, '_secret_values', dict())
+    helpers.register_secret('PACKET_API_KEY', 's3cr3t-key')
+    tracer.enable()
+    with tracer.span('build', 'task'):
+        Context(config=get_config()).run("echo s3cr3t-key")
+
+    trace = json.dumps(chrome_trace(tracer))
+    assert 's3cr3t' not in trace
+    assert 'echo [REDACTED]' in trace
+
+    trace_file_name = str(tmp_path / 'build.trace.json')
+    tracing.export(tracer, trace_file_name)
+    assert os.stat(trace_file_name).st_mode & 0o777 == 0o600
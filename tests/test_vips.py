@@ -0,0 +1,32 @@
+import pytest
+
+from tasks.vips import VipAddresses, load_vip_addresses, vip_addresses_from_reservation
+from tasks.yaml_io import safe_dump, safe_load
+
+
+def test_addresses_match_rendered_lists():
+    assert list(VipAddresses('10.0.0.4', 32)) == ['10.0.0.4']
+    assert list(VipAddresses('10.0.0.4', 31)) == ['10.0.0.4', '10.0.0.5']
+    assert list(VipAddresses('10.0.0.5', 30)) == ['10.0.0.5', '10.0.0.6']
+    assert list(VipAddresses('10.0.0.0', 29)) == ['10.0.0.{}'.format(index) for index in range(1, 7)]
+    assert list(VipAddresses('2604:1380::10', 127)) == [
+        '2604:1380:0000:0000:0000:0000:0000:0010',
+        '2604:1380:0000:0000:0000:0000:0000:0011'
+    ]
+
+
+def test_large_networks_are_indexed_lazily():
+    addresses = VipAddresses('2604:1380:4641:c500::', 56)
+    assert addresses.size == 2 ** 72 - 2
+    assert addresses[0] == '2604:1380:4641:c500:0000:0000:0000:0001'
+    assert addresses[-1] == '2604:1380:4641:c5ff:ffff:ffff:ffff:fffe'
+    with pytest.raises(IndexError):
+        addresses[addresses.size]
+
+
+def test_compact_and_legacy_files_load():
+    reservation = {'address': '147.75.40.8', 'cidr': 30}
+    record = safe_load(safe_dump(vip_addresses_from_reservation(reservation).to_record()))
+    assert record == {'network': '147.75.40.8', 'prefix': 30}
+    assert load_vip_addresses(record)[0] == '147.75.40.9'
+    assert load_vip_addresses(['147.75.40.9', '147.75.40.10'])[0] == '147.75.40.9'
@@ -0,0 +1,19 @@
+import glob
+
+from tasks import yaml_io
+
+
+def test_multiline_strings_are_literal():
+    dumped = yaml_io.safe_dump({'contents': 'apiVersion: v1\nkind: Secret\n', 'name': 'cpem-secret'})
+    assert dumped == 'contents: |\n  apiVersion: v1\n  kind: Secret\nname: cpem-secret\n'
+    assert yaml_io.safe_dump({'a': 'b\nc'}, dumper=yaml_io.PurePythonDumper) == yaml_io.safe_dump({'a': 'b\nc'})
+
+
+def test_libyaml_and_pure_python_agree_on_templates():
+    for file_name in glob.glob('templates/*.yaml') + glob.glob('manifest-examples/*.yaml'):
+        with open(file_name) as yaml_file:
+            text = yaml_file.read()
+        documents = list(yaml_io.safe_load_all(text))
+        assert documents == list(yaml_io.safe_load_all(text, loader=yaml_io.PurePythonLoader))
+        assert yaml_io.safe_dump_all(documents) == \
+               yaml_io.safe_dump_all(documents, dumper=yaml_io.PurePythonDumper)